@@ -0,0 +1,78 @@
+# coding=utf-8
+"""A memoizing front end for BertTokenizer.
+
+News articles reuse the same few thousand words over and over, yet
+BertTokenizer runs the full basic tokenizer (cleaning, accent stripping,
+punctuation splitting) and the greedy WordPiece search for every occurrence,
+then looks every piece up in the vocabulary again. CachedWordPieceTokenizer
+splits text on the whitespace characters BERT itself treats as token
+boundaries and maps each chunk to its tuple of WordPiece ids through a bounded
+LRU cache, so a sequence of ids is assembled by concatenating cached tuples.
+The ids are exactly those BertTokenizer produces.
+"""
+
+import functools
+import re
+
+# BERT treats these as whitespace, so no WordPiece ever spans them and each
+# chunk between them can be tokenized (and cached) on its own. Other unicode
+# spaces and control characters are left to the basic tokenizer inside a chunk.
+_whitespace_rgx = re.compile(r'[ \t\n\r]+')
+
+
+class CachedWordPieceTokenizer(object):
+    """Wraps a BertTokenizer with a bounded word -> WordPiece ids cache."""
+
+    def __init__(self, tokenizer, cache_size=2 ** 18):
+        self.tokenizer = tokenizer
+        self.vocab = tokenizer.vocab
+        self.ids_to_tokens = tokenizer.ids_to_tokens
+        self.cache_size = cache_size
+        self._build_cache()
+
+    def _build_cache(self):
+        self._word_ids = functools.lru_cache(maxsize=self.cache_size)(self._tokenize_word)
+
+    def __getstate__(self):
+        # lru_cache wrappers do not pickle; every process starts with its own empty cache
+        state = self.__dict__.copy()
+        del state['_word_ids']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_cache()
+
+    def _tokenize_word(self, word):
+        vocab = self.vocab
+        return tuple(vocab[piece]
+                     for token in self.tokenizer.basic_tokenizer.tokenize(word)
+                     for piece in self.tokenizer.wordpiece_tokenizer.tokenize(token))
+
+    def encode(self, text):
+        """Returns the WordPiece ids of text as a list."""
+        ids = []
+        word_ids = self._word_ids
+        for word in _whitespace_rgx.split(text):
+            if word:
+                ids.extend(word_ids(word))
+        return ids
+
+    def batch_encode(self, texts):
+        """Returns a list of id lists, one per text."""
+        return [self.encode(text) for text in texts]
+
+    def tokenize(self, text):
+        """Same output as BertTokenizer.tokenize, served from the cache."""
+        return self.convert_ids_to_tokens(self.encode(text))
+
+    def convert_tokens_to_ids(self, tokens):
+        vocab = self.vocab
+        return [vocab[token] for token in tokens]
+
+    def convert_ids_to_tokens(self, ids):
+        ids_to_tokens = self.ids_to_tokens
+        return [ids_to_tokens[i] for i in ids]
+
+    def cache_info(self):
+        return self._word_ids.cache_info()
@@ -0,0 +1,638 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+#
+# benchmark.py: Micro-benchmarks for the hyperpartisan pipeline
+#
+
+import argparse
+import contextlib
+import functools
+import html
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import preprocess
+from corpus_io import iter_records
+
+#
+# Helpers
+#
+
+def reference_unescape(line):
+    """ The original fixpoint loop, kept around as the baseline to beat """
+    new = line
+    old = ''
+    while old != new:
+        old = new
+        new = html.unescape(old)
+    return new
+
+def reference_permutation(tokens, permute_ngrams):
+    """ The original n-gram shuffle, which rebuilds the list with a quadratic reduce """
+    ngrams = [tokens[i:i + permute_ngrams] for i in range(0, len(tokens), permute_ngrams)]
+    random.shuffle(ngrams)
+    return functools.reduce(lambda a, b: a + b, ngrams, [])
+
+def load_article_texts(fp, max_articles=None):
+    """ Pull the raw text of up to max_articles articles out of a SemEval XML file """
+    return [preprocess.Article(a).get_text() for a in preprocess.do_xml_parse([fp], 'article', max_articles)]
+
+def time_function(function, texts, repeat):
+    """ Best wall-clock time over `repeat` runs of function over every text """
+    return min(timeit.repeat(lambda: [function(text) for text in texts], number=1, repeat=repeat))
+
+def report(name, baseline, optimised, count):
+    print("%s: %d texts" % (name, count))
+    print("  baseline  %.4fs (%.1f texts/s)" % (baseline, count / baseline))
+    print("  optimised %.4fs (%.1f texts/s)" % (optimised, count / optimised))
+    print("  speedup   %.2fx" % (baseline / optimised))
+
+#
+# Benchmarks
+#
+
+def bench_unescape(args):
+    texts = load_article_texts(args.input_file, args.max_articles)
+    with_entities = sum(1 for text in texts if '&' in text)
+    print("%d of %d articles contain an '&'" % (with_entities, len(texts)), file=sys.stderr)
+
+    for text in texts:
+        assert preprocess.repeated_unescape(text) == reference_unescape(text)
+
+    baseline = time_function(reference_unescape, texts, args.repeat)
+    optimised = time_function(preprocess.repeated_unescape, texts, args.repeat)
+    report("repeated_unescape", baseline, optimised, len(texts))
+
+def bench_fast_preprocess(args):
+    texts = [preprocess.repeated_unescape(text) for text in load_article_texts(args.input_file, args.max_articles)]
+
+    nlp = preprocess.get_nlp()
+    spacy_tokenize = lambda text: [x.text for x in nlp(text)]
+    baseline = time_function(spacy_tokenize, texts, args.repeat)
+    optimised = time_function(preprocess.fast_tokenize, texts, args.repeat)
+    report("spacy vs fast tokenization", baseline, optimised, len(texts))
+
+    # compare on whitespace-split tokens, which is what the spacy field holds
+    agreement = [preprocess.tokenization_agreement(" ".join(spacy_tokenize(text)).split(),
+                                                   preprocess.fast_tokenize(text))
+                 for text in texts]
+    print("  token agreement with spacy: mean %.4f, min %.4f" % (sum(agreement) / len(agreement), min(agreement)))
+
+def bench_imports(args):
+    for module in args.modules:
+        # a fresh interpreter per run so nothing is already in sys.modules
+        command = [sys.executable, '-c', 'import %s' % module]
+        interpreter = [sys.executable, '-c', 'pass']
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        total = min(timeit.repeat(lambda: subprocess.run(command, check=True, cwd=cwd), number=1, repeat=args.repeat))
+        startup = min(timeit.repeat(lambda: subprocess.run(interpreter, check=True, cwd=cwd), number=1, repeat=args.repeat))
+        print("import %s: %.3fs (%.3fs over interpreter startup)" % (module, total, total - startup))
+
+def bench_tokenize(args):
+    from pytorch_pretrained_bert.tokenization import BertTokenizer
+    from batch_tokenizer import CachedWordPieceTokenizer
+
+    with open(args.input_file) as fp:
+        texts = [line.strip() for _, line in zip(range(args.max_articles), fp)]
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    cached = CachedWordPieceTokenizer(tokenizer)
+
+    reference = lambda text: tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
+    for text in texts:
+        assert cached.encode(text) == reference(text)
+
+    baseline = time_function(reference, texts, args.repeat)
+    # a fresh cache per run, so the first pass over the sample pays for its misses
+    optimised = min(timeit.repeat(lambda: CachedWordPieceTokenizer(tokenizer).batch_encode(texts), number=1, repeat=args.repeat))
+    report("WordPiece tokenization", baseline, optimised, len(texts))
+    print("  cache: %s" % (cached.cache_info(),))
+
+def bench_permute(args):
+    import numpy as np
+    from run_classifier import permutation_index
+
+    articles = [np.random.randint(1000, 30000, size=args.length) for _ in range(args.num_articles)]
+    as_lists = [article.tolist() for article in articles]
+    baseline = time_function(lambda tokens: reference_permutation(tokens, args.permute_ngrams), as_lists, args.repeat)
+    optimised = time_function(lambda ids: ids[permutation_index(len(ids), args.permute_ngrams)], articles, args.repeat)
+    report("n-gram permutation (%d tokens, n=%d)" % (args.length, args.permute_ngrams), baseline, optimised, len(articles))
+
+def small_bert_config(args):
+    """ A BertConfig sized by the --hidden_size/--num_layers/--num_heads flags """
+    from pytorch_pretrained_bert.modeling import BertConfig
+    return BertConfig(args.vocab_size, hidden_size=args.hidden_size, num_hidden_layers=args.num_layers,
+                      num_attention_heads=args.num_heads, intermediate_size=4 * args.hidden_size)
+
+def random_batch(args, device):
+    import torch
+    input_ids = torch.randint(1, args.vocab_size, (args.batch_size, args.max_seq_length), device=device)
+    input_mask = torch.ones_like(input_ids)
+    segment_ids = torch.zeros_like(input_ids)
+    label_ids = torch.randint(0, 2, (args.batch_size,), device=device)
+    return input_ids, input_mask, segment_ids, label_ids
+
+def time_train_steps(mode, args, device):
+    """ Mean seconds per optimizer step of BertForSequenceClassification under a precision mode """
+    import torch
+    from pytorch_pretrained_bert.modeling import BertForSequenceClassification
+    from pytorch_pretrained_bert.optimization import BertAdam
+    from mixed_precision import MixedPrecision
+    from run_classifier import copy_optimizer_params_to_model, set_optimizer_params_grad
+
+    torch.manual_seed(0)
+    model = BertForSequenceClassification(small_bert_config(args), num_labels=2)
+    precision = MixedPrecision(device, bf16=(mode == 'autocast' and device.type == 'cpu'),
+                               fp16=(mode == 'autocast' and device.type == 'cuda'))
+    if mode == 'master-weights':
+        # the scheme autocast replaced: half weights on the device, float32 master copies on the host
+        model.half()
+        param_optimizer = [(n, param.clone().detach().to('cpu').float().requires_grad_()) for n, param in model.named_parameters()]
+    model.to(device)
+    if mode != 'master-weights':
+        param_optimizer = list(model.named_parameters())
+    optimizer = BertAdam([p for n, p in param_optimizer], lr=5e-5, warmup=0.1, t_total=args.warmup_steps + args.steps)
+
+    input_ids, input_mask, segment_ids, label_ids = random_batch(args, device)
+    def step():
+        with precision.autocast():
+            loss = model(input_ids, segment_ids, input_mask, label_ids)
+        precision.backward(loss)
+        if mode == 'master-weights':
+            set_optimizer_params_grad(param_optimizer, model.named_parameters())
+            optimizer.step()
+            copy_optimizer_params_to_model(model.named_parameters(), param_optimizer)
+        else:
+            precision.step(optimizer)
+        model.zero_grad()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    for _ in range(args.warmup_steps):
+        step()
+    return min(timeit.repeat(step, number=args.steps, repeat=args.repeat)) / args.steps
+
+def bench_train_step(args):
+    import torch
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    modes = ['fp32', 'autocast'] + (['master-weights'] if device.type == 'cuda' else [])
+    timings = {mode: time_train_steps(mode, args, device) for mode in modes}
+
+    print("train step on %s: batch %d x %d tokens" % (device, args.batch_size, args.max_seq_length))
+    for mode in modes:
+        print("  %-15s %8.1f ms/step (%.2fx vs fp32)" % (mode, 1000 * timings[mode], timings['fp32'] / timings[mode]))
+
+def time_optimizer_steps(mode, args, device):
+    """ Mean seconds per optimizer update (gradients already computed) under an optimizer mode """
+    import torch
+    from pytorch_pretrained_bert.modeling import BertForSequenceClassification
+    from pytorch_pretrained_bert.optimization import BertAdam
+    from flat_optimizer import FlatBertAdam
+    from run_classifier import copy_optimizer_params_to_model, set_optimizer_params_grad
+
+    torch.manual_seed(0)
+    model = BertForSequenceClassification(small_bert_config(args), num_labels=2).to(device)
+    if mode == 'cpu-copies':
+        param_optimizer = [(n, param.clone().detach().to('cpu').requires_grad_()) for n, param in model.named_parameters()]
+    else:
+        param_optimizer = list(model.named_parameters())
+    groups = [{'params': [p for n, p in param_optimizer], 'weight_decay_rate': 0.01}]
+    if mode.startswith('flat'):
+        optimizer = FlatBertAdam(groups, lr=5e-5, warmup=0.1, t_total=1000, offload=(mode == 'flat-offload'))
+    else:
+        optimizer = BertAdam(groups, lr=5e-5, warmup=0.1, t_total=1000)
+
+    input_ids, input_mask, segment_ids, label_ids = random_batch(args, device)
+    model(input_ids, segment_ids, input_mask, label_ids).backward()
+    def step():
+        if mode == 'cpu-copies':
+            set_optimizer_params_grad(param_optimizer, model.named_parameters())
+            optimizer.step()
+            copy_optimizer_params_to_model(model.named_parameters(), param_optimizer)
+        else:
+            optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    step()
+    return min(timeit.repeat(step, number=args.steps, repeat=args.repeat)) / args.steps
+
+def bench_optimizer_step(args):
+    import torch
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    modes = ['bert-adam', 'flat'] + (['cpu-copies', 'flat-offload'] if device.type == 'cuda' else [])
+    timings = {mode: time_optimizer_steps(mode, args, device) for mode in modes}
+
+    print("optimizer step on %s" % device)
+    for mode in modes:
+        print("  %-15s %8.1f ms/step (%.2fx vs bert-adam)" % (mode, 1000 * timings[mode], timings['bert-adam'] / timings[mode]))
+
+def measure_checkpointing(checkpointing, args, results):
+    """ Seconds per train step and peak extra memory in MB, run in a fresh process so peaks don't mix """
+    import resource
+    import torch
+    from pytorch_pretrained_bert.modeling import BertForSequenceClassification
+    from bertaverager import enable_gradient_checkpointing
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    torch.manual_seed(0)
+    model = BertForSequenceClassification(small_bert_config(args), num_labels=2)
+    if checkpointing:
+        enable_gradient_checkpointing(model)
+    model.to(device).train()
+    input_ids, input_mask, segment_ids, label_ids = random_batch(args, device)
+
+    def step():
+        loss = model(input_ids, segment_ids, input_mask, label_ids)
+        loss.backward()
+        model.zero_grad()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    # memory held outside the step (weights, batch) is the baseline; gradients are
+    # allocated on the first backward pass and so count towards the peak
+    if device.type == 'cuda':
+        baseline = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        with open("/proc/self/statm") as fp:
+            baseline = int(fp.read().split()[1]) * resource.getpagesize()
+    step()
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated(device)
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    seconds = min(timeit.repeat(step, number=args.steps, repeat=args.repeat)) / args.steps
+    results.put((seconds, (peak - baseline) / 2 ** 20))
+
+def bench_checkpointing(args):
+    import multiprocessing
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for checkpointing in (False, True):
+        queue = context.Queue()
+        process = context.Process(target=measure_checkpointing, args=(checkpointing, args, queue))
+        process.start()
+        results[checkpointing] = queue.get()
+        process.join()
+
+    print("train step, batch %d x %d tokens, %d layers of %d" % (args.batch_size, args.max_seq_length, args.num_layers, args.hidden_size))
+    for checkpointing, name in ((False, 'stored'), (True, 'checkpointed')):
+        seconds, memory = results[checkpointing]
+        print("  %-13s %8.1f ms/step %9.1f MB peak step memory" % (name, 1000 * seconds, memory))
+    (base_seconds, base_memory), (seconds, memory) = results[False], results[True]
+    print("  checkpointing: %.2fx time, %.2fx memory" % (seconds / base_seconds, memory / base_memory))
+
+def add_model_arguments(parser):
+    parser.add_argument('--vocab_size', type=int, default=30522)
+    parser.add_argument('--hidden_size', type=int, default=256)
+    parser.add_argument('--num_layers', type=int, default=4)
+    parser.add_argument('--num_heads', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--max_seq_length', type=int, default=128)
+    parser.add_argument('--no_cuda', action='store_true', help='benchmark on the CPU even if CUDA is available')
+
+#
+# Suite: every stage of the pipeline on a synthetic corpus
+#
+
+SYNTHETIC_WORDS = ("the a of to and in that is for on with as was by he said it from at his an be have has "
+                   "are but not this who they were had which been would their we will more its after one "
+                   "new president government people state year trump clinton house senate media vote party "
+                   "policy economy campaign news report election democrats republicans court law war police "
+                   "tax health america american world country week time official reporters percent").split()
+
+def synthetic_sentence(rng):
+    words = [rng.choice(SYNTHETIC_WORDS) for _ in range(rng.randint(6, 25))]
+    words[0] = words[0].capitalize()
+    if rng.random() < 0.1:
+        words.insert(rng.randrange(len(words)), "&amp;")
+    return " ".join(words) + rng.choice(".!?")
+
+def write_synthetic_corpus(directory, num_articles, sentences_per_article, seed=0):
+    """
+    Write a SemEval-style articles XML file and its ground truth file, returning
+    their paths. Articles are paragraphs of random sentences with the odd link.
+    """
+    rng = random.Random(seed)
+    articles_path = os.path.join(directory, "articles-synthetic.xml")
+    ground_truth_path = os.path.join(directory, "ground-truth-synthetic.xml")
+    with open(articles_path, "w") as articles, open(ground_truth_path, "w") as ground_truth:
+        articles.write("<articles>\n")
+        ground_truth.write("<articles>\n")
+        for i in range(num_articles):
+            article_id = "%07d" % i
+            title = synthetic_sentence(rng).rstrip(".!?")
+            articles.write('<article id="%s" published-at="2018-01-01" title="%s">\n' % (article_id, title))
+            sentences = [synthetic_sentence(rng) for _ in range(rng.randint(1, 2 * sentences_per_article))]
+            for start in range(0, len(sentences), 5):
+                paragraph = " ".join(sentences[start:start + 5])
+                if rng.random() < 0.3:
+                    paragraph += ' <a href="https://example.com/%d" type="external">%s</a>' % (start, synthetic_sentence(rng))
+                articles.write("<p>%s</p>\n" % paragraph)
+            articles.write("</article>\n")
+            ground_truth.write('<article id="%s" hyperpartisan="%s" url="https://example.com/%s"/>\n'
+                               % (article_id, rng.choice(["true", "false"]), article_id))
+        articles.write("</articles>\n")
+        ground_truth.write("</articles>\n")
+    return articles_path, ground_truth_path
+
+def write_synthetic_vocab(path):
+    """ A WordPiece vocabulary covering the synthetic corpus, including a few split words """
+    pieces = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + list(".!?,;&-'\"")
+    pieces += sorted(set(word for word in SYNTHETIC_WORDS if len(word) <= 6))
+    pieces += sorted(set(word[:6] for word in SYNTHETIC_WORDS if len(word) > 6))
+    pieces += sorted(set("##" + word[6:] for word in SYNTHETIC_WORDS if len(word) > 6))
+    pieces += ["-", "eos", "##s"]
+    with open(path, "w") as fp:
+        fp.write("\n".join(pieces) + "\n")
+    return path
+
+class StageTimer(object):
+    """ Collects wall-clock time and throughput per stage """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def time(self, name, unit):
+        result = {}
+        start = time.perf_counter()
+        yield result
+        self.record(name, unit, result.pop("items", 0), time.perf_counter() - start, **result)
+
+    def record(self, name, unit, items, seconds, **extra):
+        result = dict(extra, unit=unit, items=items, seconds=seconds,
+                      items_per_second=items / seconds if seconds > 0 else None)
+        self.stages[name] = result
+        print("%-28s %10.3fs %12.1f %s/s" % (name, seconds, result["items_per_second"] or 0, unit), file=sys.stderr)
+        return result
+
+def resident_mb():
+    """ Current resident set size of this process """
+    import resource
+    with open("/proc/self/statm") as fp:
+        return int(fp.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+def measure_xml_memory(streaming, path, num_articles, samples, results):
+    """ RSS after every num_articles / samples articles, run in a fresh process """
+    from lxml import etree
+    from xml_stream import iter_elements
+
+    if streaming:
+        elements = iter_elements(path, 'article')
+    else:
+        # the loop every copy of do_xml_parse used to run
+        def clear_only():
+            for event, elem in etree.iterparse(path, tag='article'):
+                yield elem
+                elem.clear()
+        elements = clear_only()
+
+    every = max(1, num_articles // samples)
+    rss = [resident_mb()]
+    start = time.perf_counter()
+    for i, article in enumerate(elements, 1):
+        if i % every == 0:
+            rss.append(resident_mb())
+    results.put((rss, time.perf_counter() - start))
+
+def bench_xml_memory(args):
+    import multiprocessing
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        path, _ = write_synthetic_corpus(directory, args.num_articles, args.sentences_per_article)
+        print("%d articles, %.1f MB of XML" % (args.num_articles, os.path.getsize(path) / 2 ** 20))
+        for streaming, name in ((False, "clear only"), (True, "iter_elements")):
+            queue = context.Queue()
+            process = context.Process(target=measure_xml_memory,
+                                      args=(streaming, path, args.num_articles, args.samples, queue))
+            process.start()
+            rss, seconds = queue.get()
+            process.join()
+            print("  %-14s %6.2fs  RSS MB: %s  (growth %.1f MB)" % (name, seconds, " ".join("%.0f" % x for x in rss),
+                                                                 rss[-1] - rss[1]))
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_suite(args):
+    import torch
+    import extract_articles
+    import run_classifier
+    import unsupervised_pretraining
+    from torch.utils.data import DataLoader
+    from pytorch_pretrained_bert.modeling import BertForSequenceClassification
+    from pytorch_pretrained_bert.tokenization import BertTokenizer
+
+    torch.set_num_threads(args.threads)
+    timer = StageTimer()
+    directory = tempfile.mkdtemp(prefix="hyperpartisan-bench-")
+
+    with timer.time("generate_corpus", "articles") as result:
+        articles_path, ground_truth_path = write_synthetic_corpus(directory, args.num_articles, args.sentences_per_article, args.seed)
+        result["items"] = args.num_articles
+        result["bytes"] = os.path.getsize(articles_path)
+
+    engines = ["fast"] if args.skip_spacy else ["fast", "spacy"]
+    for engine in engines:
+        preprocessed_path = os.path.join(directory, "articles-%s.xml" % engine)
+        with timer.time("process_articles_%s" % engine, "articles") as result, \
+                open(articles_path, "rb") as fp_in, open(preprocessed_path, "wb") as fp_out:
+            preprocess.process_articles([fp_in], fp_out, ["spacy", "links"], fast=(engine == "fast"))
+            result["items"] = args.num_articles
+
+    prep_path = os.path.join(directory, "articles-synthetic.prep.txt")
+    with timer.time("extract_articles", "articles") as result, \
+            open(preprocessed_path, "rb") as fp_in, open(prep_path, "w") as fp_out:
+        for article in extract_articles.do_xml_parse(fp_in, 'article'):
+            fp_out.write(" ".join(extract_articles.extract_text2(article).split()) + "\n")
+        result["items"] = args.num_articles
+
+    # the same two stages through the JSONL format, which skips the second XML parse
+    jsonl_path = os.path.join(directory, "articles-fast.jsonl")
+    with timer.time("process_articles_fast_jsonl", "articles") as result, \
+            open(articles_path, "rb") as fp_in, open(jsonl_path, "wb") as fp_out:
+        preprocess.process_articles([fp_in], fp_out, ["spacy", "links"], fast=True, output_format="jsonl")
+        result["items"] = args.num_articles
+
+    with timer.time("extract_articles_jsonl", "articles") as result, open(jsonl_path, "rb") as fp_in:
+        for record in iter_records(fp_in):
+            " ".join(extract_articles.extract_record_text(record).split())
+        result["items"] = args.num_articles
+
+    with open(ground_truth_path, "rb") as fp:
+        labels = [article.get("hyperpartisan") for article in extract_articles.do_xml_parse(fp, 'article')]
+    with open(prep_path) as fp:
+        lines = [line.strip() for line in fp]
+    examples = [run_classifier.InputExample(guid="bench-%d" % i, text_a=line, label=label)
+                for i, (line, label) in enumerate(zip(lines, labels))]
+
+    tokenizer = BertTokenizer(write_synthetic_vocab(os.path.join(directory, "vocab.txt")), do_lower_case=True)
+    with timer.time("convert_examples_to_features", "articles") as result:
+        features = run_classifier.convert_examples_to_features(examples, ["false", "true"], args.max_seq_length, tokenizer)
+        result["items"] = len(features)
+    timer.stages["convert_examples_to_features"]["tokens"] = sum(sum(f.input_mask) for f in features)
+
+    pretraining_examples = []
+    for datapoint in enumerate(lines):
+        pretraining_examples.extend(unsupervised_pretraining.extract_examples(datapoint))
+    pretraining_data = unsupervised_pretraining.PretrainingDataset(pretraining_examples, args.pretraining_seq_length, tokenizer)
+    with timer.time("pretraining_dataset", "examples") as result:
+        for batch in DataLoader(pretraining_data, batch_size=args.batch_size):
+            pass
+        result["items"] = len(pretraining_data)
+
+    # the same pairs packed several to a sequence: fewer, fuller rows per epoch
+    packed_data = unsupervised_pretraining.PretrainingDataset(pretraining_examples, args.pretraining_seq_length, tokenizer,
+                                                              pack_sequences=True)
+    with timer.time("pretraining_dataset_packed", "examples") as result:
+        for batch in DataLoader(packed_data, batch_size=args.batch_size):
+            pass
+        result["items"] = len(pretraining_examples)
+        result["sequences"] = len(packed_data)
+
+    device = torch.device("cpu")
+    timer.record("classifier_train_step", "examples", args.batch_size, time_train_steps("fp32", args, device))
+
+    torch.manual_seed(0)
+    model = BertForSequenceClassification(small_bert_config(args), num_labels=2).eval()
+    input_ids, input_mask, segment_ids, label_ids = random_batch(args, device)
+    with timer.time("classifier_inference", "examples") as result, torch.no_grad():
+        for _ in range(args.steps):
+            model(input_ids, segment_ids, input_mask)
+        result["items"] = args.steps * args.batch_size
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "config": {k: v for k, v in vars(args).items() if k not in ("function", "output")},
+        "stages": timer.stages,
+    }
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
+    print("Wrote %s" % args.output, file=sys.stderr)
+
+def bench_compare(args):
+    """ Compare the per-stage throughput of two suite results """
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    with open(args.candidate) as fp:
+        candidate = json.load(fp)
+
+    regressions = 0
+    print("%-28s %12s %12s %8s" % ("stage", "baseline/s", "candidate/s", "ratio"))
+    for name in sorted(set(baseline["stages"]) & set(candidate["stages"])):
+        old = baseline["stages"][name].get("items_per_second")
+        new = candidate["stages"][name].get("items_per_second")
+        if not old or not new:
+            continue
+        ratio = new / old
+        flag = ""
+        if ratio < 1 - args.tolerance:
+            flag = "  REGRESSION"
+            regressions += 1
+        print("%-28s %12.1f %12.1f %7.2fx%s" % (name, old, new, ratio, flag))
+    sys.exit(1 if regressions else 0)
+
+#
+# CLI
+#
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for pipeline stages")
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    unescape_parser = subparsers.add_parser('unescape', help='time repeated_unescape against the original fixpoint loop')
+    unescape_parser.add_argument('input_file', type=argparse.FileType('rb'), help='a SemEval XML file with articles')
+    unescape_parser.add_argument('--max_articles', type=int, default=1000, help='number of articles to sample')
+    unescape_parser.add_argument('--repeat', type=int, default=5, help='timing repetitions, the best one is reported')
+    unescape_parser.set_defaults(function=bench_unescape)
+
+    fast_parser = subparsers.add_parser('fast-preprocess', help='time and compare the regex tokenizer against spacy')
+    fast_parser.add_argument('input_file', type=argparse.FileType('rb'), help='a SemEval XML file with articles')
+    fast_parser.add_argument('--max_articles', type=int, default=200, help='number of articles to sample')
+    fast_parser.add_argument('--repeat', type=int, default=3, help='timing repetitions, the best one is reported')
+    fast_parser.set_defaults(function=bench_fast_preprocess)
+
+    imports_parser = subparsers.add_parser('imports', help='time a cold import of pipeline modules')
+    imports_parser.add_argument('modules', nargs='*', default=['preprocess', 'predict', 'run_classifier', 'unsupervised_pretraining'])
+    imports_parser.add_argument('--repeat', type=int, default=5, help='timing repetitions, the best one is reported')
+    imports_parser.set_defaults(function=bench_imports)
+
+    tokenize_parser = subparsers.add_parser('tokenize', help='time BertTokenizer against the cached WordPiece tokenizer')
+    tokenize_parser.add_argument('input_file', help='a .prep.txt file with one article per line')
+    tokenize_parser.add_argument('--bert_model', default='bert-base-uncased')
+    tokenize_parser.add_argument('--do_lower_case', action='store_true')
+    tokenize_parser.add_argument('--max_articles', type=int, default=2000, help='number of articles to sample')
+    tokenize_parser.add_argument('--repeat', type=int, default=3, help='timing repetitions, the best one is reported')
+    tokenize_parser.set_defaults(function=bench_tokenize)
+
+    permute_parser = subparsers.add_parser('permute', help='time the original n-gram permutation against the index shuffle')
+    permute_parser.add_argument('--num_articles', type=int, default=200)
+    permute_parser.add_argument('--length', type=int, default=2000, help='WordPieces per synthetic article')
+    permute_parser.add_argument('--permute_ngrams', type=int, default=3)
+    permute_parser.add_argument('--repeat', type=int, default=3, help='timing repetitions, the best one is reported')
+    permute_parser.set_defaults(function=bench_permute)
+
+    train_step_parser = subparsers.add_parser('train-step', help='time classifier train steps in fp32, autocast and (on CUDA) the old master-weight fp16')
+    add_model_arguments(train_step_parser)
+    train_step_parser.add_argument('--warmup_steps', type=int, default=3)
+    train_step_parser.add_argument('--steps', type=int, default=10)
+    train_step_parser.add_argument('--repeat', type=int, default=3, help='timing repetitions, the best one is reported')
+    train_step_parser.set_defaults(function=bench_train_step)
+
+    xml_memory_parser = subparsers.add_parser('xml-memory', help='resident memory while streaming a large XML corpus, old loop vs iter_elements')
+    xml_memory_parser.add_argument('--num_articles', type=int, default=50000)
+    xml_memory_parser.add_argument('--sentences_per_article', type=int, default=10)
+    xml_memory_parser.add_argument('--samples', type=int, default=10, help='number of RSS samples over the corpus')
+    xml_memory_parser.set_defaults(function=bench_xml_memory)
+
+    checkpointing_parser = subparsers.add_parser('checkpointing', help='time and memory of a train step with and without gradient checkpointing')
+    add_model_arguments(checkpointing_parser)
+    checkpointing_parser.add_argument('--steps', type=int, default=3)
+    checkpointing_parser.add_argument('--repeat', type=int, default=2, help='timing repetitions, the best one is reported')
+    checkpointing_parser.set_defaults(function=bench_checkpointing)
+
+    optimizer_step_parser = subparsers.add_parser('optimizer-step', help='time BertAdam, the optimize_on_cpu copies and FlatBertAdam updates')
+    add_model_arguments(optimizer_step_parser)
+    optimizer_step_parser.add_argument('--steps', type=int, default=10)
+    optimizer_step_parser.add_argument('--repeat', type=int, default=3, help='timing repetitions, the best one is reported')
+    optimizer_step_parser.set_defaults(function=bench_optimizer_step)
+
+    suite_parser = subparsers.add_parser('suite', help='time every pipeline stage on a synthetic corpus and write JSON results')
+    add_model_arguments(suite_parser)
+    suite_parser.add_argument('--output', default='bench_output.json', help='where to write the JSON results')
+    suite_parser.add_argument('--num_articles', type=int, default=500, help='size of the synthetic corpus')
+    suite_parser.add_argument('--sentences_per_article', type=int, default=20, help='average sentences per synthetic article')
+    suite_parser.add_argument('--pretraining_seq_length', type=int, default=60)
+    suite_parser.add_argument('--skip_spacy', action='store_true', help='only time the fast preprocessing engine')
+    suite_parser.add_argument('--threads', type=int, default=1, help='torch intra-op threads, fixed for comparable numbers')
+    suite_parser.add_argument('--seed', type=int, default=0)
+    suite_parser.add_argument('--warmup_steps', type=int, default=2)
+    suite_parser.add_argument('--steps', type=int, default=5)
+    suite_parser.add_argument('--repeat', type=int, default=1)
+    suite_parser.set_defaults(function=bench_suite)
+
+    compare_parser = subparsers.add_parser('compare', help='compare two suite results and flag regressions')
+    compare_parser.add_argument('baseline', help='JSON results from the baseline commit')
+    compare_parser.add_argument('candidate', help='JSON results from the candidate commit')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown fraction tolerated before flagging')
+    compare_parser.set_defaults(function=bench_compare)
+
+    args = parser.parse_args()
+    args.function(args)
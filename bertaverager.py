@@ -4,6 +4,7 @@
 
 from pytorch_pretrained_bert.modeling import *
 import torch
+import torch.utils.checkpoint
 from torch import nn
 from torch.nn import NLLLoss
 
@@ -54,3 +55,153 @@ class BertForSplicedSequenceClassification(BertForSequenceClassification):
         else:
             return overall_probabilities
 
+
+class CheckpointedBertEncoder(BertEncoder):
+    """BertEncoder that recomputes each layer's activations during the backward pass
+    instead of keeping them, trading roughly one extra forward pass for memory that
+    no longer grows with the number of layers."""
+    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
+        if not (self.training and torch.is_grad_enabled()):
+            return super(CheckpointedBertEncoder, self).forward(hidden_states, attention_mask, output_all_encoded_layers)
+
+        all_encoder_layers = []
+        for layer_module in self.layer:
+            # the dropout masks are replayed from the saved RNG state, so the recomputation matches
+            hidden_states = torch.utils.checkpoint.checkpoint(layer_module, hidden_states, attention_mask, use_reentrant=False)
+            if output_all_encoded_layers:
+                all_encoder_layers.append(hidden_states)
+        if not output_all_encoded_layers:
+            all_encoder_layers.append(hidden_states)
+        return all_encoder_layers
+
+
+def enable_gradient_checkpointing(model):
+    """Switches the encoder of a BERT model (BertForSequenceClassification,
+    BertForSplicedSequenceClassification, BertForPreTraining, ...) to activation
+    checkpointing. Parameters and state_dict keys are unchanged."""
+    model.bert.encoder.__class__ = CheckpointedBertEncoder
+    return model
+
+
+class EarlyExitHead(nn.Module):
+    """A small classifier on the [CLS] state of an intermediate encoder layer."""
+    def __init__(self, config, num_labels, head_size=128):
+        super(EarlyExitHead, self).__init__()
+        self.dense = nn.Linear(config.hidden_size, head_size)
+        self.activation = nn.Tanh()
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.classifier = nn.Linear(head_size, num_labels)
+
+    def forward(self, hidden_states):
+        return self.classifier(self.dropout(self.activation(self.dense(hidden_states[:, 0]))))
+
+
+class BertForEarlyExitClassification(BertForSequenceClassification):
+    """BertForSequenceClassification with an exit head after every encoder layer but
+    the last. Its state_dict is a superset of BertForSequenceClassification's, so a
+    fine-tuned checkpoint loads with strict=False and only the heads need training.
+
+    With `exit_threshold` set, inference (eval mode, no labels) stops for each
+    example at the first head whose softmax confidence reaches the threshold;
+    examples no head is sure about go through every layer to the usual pooler and
+    classifier. Training with labels always runs the full model.
+    """
+    def __init__(self, config, num_labels=2, head_size=128):
+        super(BertForEarlyExitClassification, self).__init__(config=config, num_labels=num_labels)
+        self.exit_heads = nn.ModuleList([EarlyExitHead(config, num_labels, head_size)
+                                         for _ in range(config.num_hidden_layers - 1)])
+        self.exit_heads.apply(self.init_bert_weights)
+        self.exit_threshold = None
+
+    def _embed(self, input_ids, token_type_ids, attention_mask):
+        # the inputs and additive attention mask BertModel.forward builds
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype)
+        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        return self.bert.embeddings(input_ids, token_type_ids), extended_attention_mask
+
+    def all_exit_logits(self, input_ids, token_type_ids=None, attention_mask=None):
+        """Logits of every exit head, then of the full model: a list of num_hidden_layers [batch, num_labels] tensors."""
+        encoded_layers, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=True)
+        logits = [head(hidden_states) for head, hidden_states in zip(self.exit_heads, encoded_layers)]
+        logits.append(self.classifier(self.dropout(pooled_output)))
+        return logits
+
+    def early_exit(self, input_ids, token_type_ids=None, attention_mask=None, threshold=None):
+        """Returns the logits and the number of encoder layers each example went through.
+
+        Confident examples leave the batch at their exit, so later layers only run on
+        the ones still undecided.
+        """
+        threshold = self.exit_threshold if threshold is None else threshold
+        hidden_states, extended_attention_mask = self._embed(input_ids, token_type_ids, attention_mask)
+        active = torch.arange(input_ids.size(0), device=input_ids.device)
+        exited, exit_logits, exit_layers = [], [], []
+        for depth, layer_module in enumerate(self.bert.encoder.layer, 1):
+            hidden_states = layer_module(hidden_states, extended_attention_mask)
+            if depth == len(self.bert.encoder.layer):
+                logits = self.classifier(self.dropout(self.bert.pooler(hidden_states)))
+                confident = torch.ones_like(active, dtype=torch.bool)
+            else:
+                logits = self.exit_heads[depth - 1](hidden_states)
+                confident = torch.softmax(logits.float(), dim=-1).max(dim=-1)[0] >= threshold
+            if confident.any():
+                exited.append(active[confident])
+                exit_logits.append(logits[confident])
+                exit_layers.append(torch.full_like(active[confident], depth))
+                undecided = ~confident
+                active = active[undecided]
+                hidden_states = hidden_states[undecided]
+                extended_attention_mask = extended_attention_mask[undecided]
+            if active.numel() == 0:
+                break
+        # back to the input order
+        order = torch.argsort(torch.cat(exited))
+        return torch.cat(exit_logits)[order], torch.cat(exit_layers)[order]
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
+        if labels is None and self.exit_threshold is not None and not self.training:
+            return self.early_exit(input_ids, token_type_ids, attention_mask)[0]
+        return super(BertForEarlyExitClassification, self).forward(input_ids, token_type_ids, attention_mask, labels)
+
+
+class BertForPackedPreTraining(BertForPreTraining):
+    """BertForPreTraining over sequences that pack several sentence pairs.
+
+    `attention_mask` holds the 1-based number of each token's pair (0 for
+    padding): tokens only attend within their own pair, so the packed pairs
+    are encoded as if each were alone. `position_ids` restart with every pair,
+    and the next-sentence head is applied to the [CLS] token of each pair at
+    `cls_positions` [batch_size, max_pairs], with -1 labels for unused slots.
+    The parameters are those of BertForPreTraining, so checkpoints are shared.
+    """
+    def forward(self, input_ids, token_type_ids, attention_mask, masked_lm_labels=None, next_sentence_label=None,
+                position_ids=None, cls_positions=None):
+        embeddings = self.bert.embeddings
+        embedding_output = embeddings.word_embeddings(input_ids) + embeddings.position_embeddings(position_ids) \
+            + embeddings.token_type_embeddings(token_type_ids)
+        embedding_output = embeddings.dropout(embeddings.LayerNorm(embedding_output))
+
+        # block-diagonal [batch_size, 1, seq_length, seq_length] mask
+        same_pair = (attention_mask.unsqueeze(2) == attention_mask.unsqueeze(1)) & (attention_mask.unsqueeze(1) > 0)
+        extended_attention_mask = same_pair.unsqueeze(1).to(dtype=next(self.parameters()).dtype)
+        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        sequence_output = self.bert.encoder(embedding_output, extended_attention_mask,
+                                            output_all_encoded_layers=False)[-1]
+
+        cls_states = sequence_output.gather(1, cls_positions.unsqueeze(-1).expand(-1, -1, sequence_output.size(-1)))
+        pooled_output = self.bert.pooler.activation(self.bert.pooler.dense(cls_states))
+        prediction_scores = self.cls.predictions(sequence_output)
+        seq_relationship_score = self.cls.seq_relationship(pooled_output)
+
+        if masked_lm_labels is not None and next_sentence_label is not None:
+            loss_fct = CrossEntropyLoss(ignore_index=-1)
+            masked_lm_loss = loss_fct(prediction_scores.view(-1, self.config.vocab_size), masked_lm_labels.view(-1))
+            next_sentence_loss = loss_fct(seq_relationship_score.view(-1, 2), next_sentence_label.view(-1))
+            return masked_lm_loss + next_sentence_loss
+        else:
+            return prediction_scores, seq_relationship_score
@@ -0,0 +1,198 @@
+# coding=utf-8
+"""A two-stage cascade: a hashed n-gram linear prefilter in front of BERT.
+
+Most articles are easy: their vocabulary alone gives the label away. The
+prefilter is a linear model over hashed word unigrams and bigrams (an
+EmbeddingBag with one output per label), trained on the same examples as the
+classifier in a few seconds per epoch on CPU. At prediction time it scores
+every article first and only those whose confidence falls inside an
+uncertain band around 0.5 are sent to BERT; the others keep the prefilter's
+label.
+
+The band width w sends an article to BERT when the prefilter's top
+probability is at most 0.5 + w / 2, so w = 0 trusts the prefilter everywhere
+and w = 1 sends every article to BERT. `band_report` shows, for a range of
+widths, the share of BERT calls saved and the accuracy of the cascade.
+"""
+
+import logging
+import time
+import zlib
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, SequentialSampler
+from tqdm import tqdm, trange
+
+logger = logging.getLogger(__name__)
+
+PREFILTER_NAME = "prefilter.pt"
+BAND_WIDTHS = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+
+def add_cascade_arguments(parser):
+    """Adds the --train_prefilter/--prefilter_path/--cascade_band_width flags to an argparse parser."""
+    parser.add_argument('--train_prefilter',
+                        default=False,
+                        action='store_true',
+                        help="Whether to also train a hashed n-gram linear prefilter on the training examples, "
+                             "saved as %s in the output directory." % PREFILTER_NAME)
+    parser.add_argument('--prefilter_path',
+                        default=None,
+                        type=str,
+                        help="A prefilter trained before, for --cascade_band_width and the cascade report.")
+    parser.add_argument('--cascade_band_width',
+                        default=None,
+                        type=float,
+                        help="With --predict and --prefilter_path, only articles whose prefilter confidence is at most "
+                             "0.5 + width / 2 go to BERT; the rest keep the prefilter's label.")
+    parser.add_argument('--prefilter_buckets',
+                        type=int,
+                        default=2 ** 20,
+                        help="Number of hash buckets of the prefilter's n-gram features.")
+    parser.add_argument('--prefilter_epochs',
+                        type=int,
+                        default=5,
+                        help="Training epochs of the prefilter.")
+
+
+def hash_ngrams(text, num_buckets, ngram_range=2):
+    """Bucket ids of the word 1..ngram_range-grams of a text.
+
+    crc32 rather than hash(), which is salted per process.
+    """
+    tokens = text.lower().split()
+    grams = list(tokens)
+    for n in range(2, ngram_range + 1):
+        grams.extend(" ".join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+    return [zlib.crc32(gram.encode("utf-8")) % num_buckets for gram in grams] or [0]
+
+
+class HashedNgramClassifier(nn.Module):
+    """Logistic regression over the mean of hashed n-gram features."""
+
+    def __init__(self, num_labels=2, num_buckets=2 ** 20, ngram_range=2):
+        super(HashedNgramClassifier, self).__init__()
+        self.num_labels = num_labels
+        self.num_buckets = num_buckets
+        self.ngram_range = ngram_range
+        self.weights = nn.EmbeddingBag(num_buckets, num_labels, mode="mean")
+        nn.init.zeros_(self.weights.weight)
+        self.bias = nn.Parameter(torch.zeros(num_labels))
+
+    def encode(self, texts):
+        """The flat bucket ids and bag offsets of a batch of texts."""
+        ids = [hash_ngrams(text, self.num_buckets, self.ngram_range) for text in texts]
+        offsets = np.cumsum([0] + [len(bag) for bag in ids[:-1]])
+        return (torch.tensor([i for bag in ids for i in bag], dtype=torch.long),
+                torch.tensor(offsets, dtype=torch.long))
+
+    def forward(self, ids, offsets):
+        return self.weights(ids, offsets) + self.bias
+
+
+def train_prefilter(texts, label_ids, num_labels, num_buckets, epochs, batch_size=64, learning_rate=0.05, seed=42):
+    """Fits a HashedNgramClassifier to texts and their label ids."""
+    torch.manual_seed(seed)
+    rng = np.random.RandomState(seed)
+    model = HashedNgramClassifier(num_labels, num_buckets)
+    # only the rows of the n-grams in a batch get gradients
+    model.weights.sparse = True
+    optimizers = [torch.optim.SparseAdam(list(model.weights.parameters()), lr=learning_rate),
+                  torch.optim.Adam([model.bias], lr=learning_rate)]
+    encoded = [model.encode([text]) for text in tqdm(texts, desc="Hashing")]
+    labels = torch.tensor(label_ids, dtype=torch.long)
+    loss_fct = nn.CrossEntropyLoss()
+    model.train()
+    for epoch in trange(epochs, desc="Prefilter epoch"):
+        order = rng.permutation(len(texts))
+        total_loss = 0.0
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            ids = torch.cat([encoded[i][0] for i in batch])
+            offsets = torch.tensor(np.cumsum([0] + [len(encoded[i][0]) for i in batch[:-1]]), dtype=torch.long)
+            loss = loss_fct(model(ids, offsets), labels[batch])
+            for optimizer in optimizers:
+                optimizer.zero_grad()
+            loss.backward()
+            for optimizer in optimizers:
+                optimizer.step()
+            total_loss += loss.item() * len(batch)
+        logger.info("Prefilter epoch %d: loss %.4f", epoch, total_loss / max(1, len(order)))
+    model.weights.sparse = False
+    model.eval()
+    return model
+
+
+def prefilter_probabilities(model, texts, batch_size=1024):
+    """Label probabilities [N, num_labels] of the prefilter for texts."""
+    probabilities = []
+    with torch.no_grad():
+        for start in range(0, len(texts), batch_size):
+            ids, offsets = model.encode(texts[start:start + batch_size])
+            probabilities.append(torch.softmax(model(ids, offsets), dim=1).numpy())
+    if not probabilities:
+        return np.zeros((0, model.num_labels), dtype=np.float32)
+    return np.concatenate(probabilities)
+
+
+def save_prefilter(model, path):
+    torch.save({"num_labels": model.num_labels, "num_buckets": model.num_buckets,
+                "ngram_range": model.ngram_range, "state_dict": model.state_dict()}, path)
+
+
+def load_prefilter(path):
+    checkpoint = torch.load(path, map_location="cpu")
+    model = HashedNgramClassifier(checkpoint["num_labels"], checkpoint["num_buckets"], checkpoint["ngram_range"])
+    model.load_state_dict(checkpoint["state_dict"])
+    model.eval()
+    return model
+
+
+def uncertain(probabilities, band_width):
+    """Which articles the cascade sends to BERT at a band width."""
+    return probabilities.max(axis=1) <= 0.5 + band_width / 2
+
+
+def bert_probabilities(model, dataset, batch_size, device, precision):
+    """Label probabilities of BERT over a dataset in order, with the seconds it took."""
+    model.eval()
+    dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=batch_size)
+    probabilities = []
+    start = time.perf_counter()
+    for batch in tqdm(dataloader, desc="Cascade report"):
+        input_ids, input_mask, segment_ids = (t.to(device) for t in batch[:3])
+        with torch.no_grad(), precision.autocast():
+            logits = model(input_ids, segment_ids, input_mask)
+        probabilities.append(torch.softmax(logits.float(), dim=1).cpu().numpy())
+    return np.concatenate(probabilities), time.perf_counter() - start
+
+
+def band_report(prefilter_probs, prefilter_seconds, bert_probs, bert_seconds, label_ids, widths=BAND_WIDTHS):
+    """BERT calls saved, cascade accuracy and estimated throughput at each band width."""
+    label_ids = np.asarray(label_ids)
+    num_articles = len(label_ids)
+    prefilter_pred = prefilter_probs.argmax(axis=1)
+    bert_pred = bert_probs.argmax(axis=1)
+    report = {
+        "num_articles": num_articles,
+        "bert_accuracy": float(np.mean(bert_pred == label_ids)),
+        "prefilter_accuracy": float(np.mean(prefilter_pred == label_ids)),
+        "bert_articles_per_second": num_articles / bert_seconds,
+        "prefilter_articles_per_second": num_articles / prefilter_seconds,
+        "bands": [],
+    }
+    for width in widths:
+        routed = uncertain(prefilter_probs, width)
+        cascade_pred = np.where(routed, bert_pred, prefilter_pred)
+        # every article pays for the prefilter, only the routed ones for BERT
+        seconds = prefilter_seconds + bert_seconds * routed.mean()
+        report["bands"].append({
+            "band_width": width,
+            "bert_fraction": float(routed.mean()),
+            "bert_call_reduction": float(1 - routed.mean()),
+            "accuracy": float(np.mean(cascade_pred == label_ids)),
+            "articles_per_second": num_articles / seconds,
+        })
+    return report
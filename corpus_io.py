@@ -0,0 +1,199 @@
+import gzip
+import io
+import json
+import lzma
+import os
+import shutil
+import subprocess
+
+#
+# corpus_io.py: Read and write corpus files as gzip/xz/zstd streams
+#
+# The codec comes from the file extension (.gz, .xz, .zst); anything else is
+# opened as a plain file. Where the command-line tool is installed (pigz,
+# xz, zstd) the data goes through it in a separate process, so decompression
+# overlaps with parsing and uses several threads where the tool can: pigz
+# and zstd compress with -p/-T threads, xz compresses and decompresses
+# multi-block files with -T threads. Otherwise the stream is (de)compressed
+# in-process with gzip, lzma or the zstandard package.
+#
+# iter_records reads the JSONL article files that preprocess.py writes with
+# --format jsonl, compressed or not.
+#
+
+CODECS = {
+    '.gz': 'gzip',
+    '.gzip': 'gzip',
+    '.xz': 'xz',
+    '.lzma': 'xz',
+    '.zst': 'zstd',
+    '.zstd': 'zstd',
+}
+
+# command-line tools for each codec, in order of preference, and their thread flags
+TOOLS = {
+    'gzip': [('pigz', lambda threads: ['-p', str(threads)]), ('gzip', lambda threads: [])],
+    'xz': [('xz', lambda threads: ['-T%d' % threads])],
+    'zstd': [('zstd', lambda threads: ['-q', '-T%d' % threads])],
+}
+
+def compression_suffix(path):
+    """ The compression extension of path ('.gz', '.xz', ...), or '' for plain files """
+    ext = os.path.splitext(path)[1].lower()
+    return ext if ext in CODECS else ''
+
+def find_corpus(path):
+    """
+    Returns path if it exists, otherwise the first compressed version of it
+    (path + '.gz', '.xz', ...) that does, so readers can ask for the plain
+    name of a file that is stored compressed. Returns path unchanged if none
+    exists, so the caller's open fails with the name it expected.
+    """
+    if os.path.exists(path):
+        return path
+    for ext in CODECS:
+        if os.path.exists(path + ext):
+            return path + ext
+    return path
+
+def file_signature(path):
+    """
+    Path, size and mtime of a file, which the on-disk caches use in their keys
+    to notice that a corpus or checkpoint changed.
+    """
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, int(stat.st_mtime)]
+
+def open_corpus(path, mode='rb', threads=None, encoding=None):
+    """
+    Opens path for reading ('r', 'rb') or writing ('w', 'wb'), compressing
+    or decompressing on the fly according to its extension. Text modes use
+    encoding (utf-8 for compressed files if not given).
+    """
+    if mode not in ('r', 'rb', 'w', 'wb', 'rt', 'wt'):
+        raise ValueError("Unsupported mode %r for %s" % (mode, path))
+    suffix = compression_suffix(path)
+    if not suffix:
+        return open(path, mode, encoding=encoding)
+
+    codec = CODECS[suffix]
+    writing = mode.startswith('w')
+    threads = threads or os.cpu_count() or 1
+    fp = _open_with_tool(path, codec, writing, threads)
+    if fp is None:
+        fp = _open_in_process(path, codec, writing, threads)
+    if 'b' in mode:
+        return fp
+    return io.TextIOWrapper(fp, encoding=encoding or 'utf-8')
+
+def is_jsonl(path):
+    """ Whether path names a JSONL file, e.g. articles.jsonl or articles.jsonl.gz """
+    suffix = compression_suffix(path)
+    return path[:len(path) - len(suffix)].lower().endswith('.jsonl')
+
+def iter_records(fps, max_records=None, offset=0):
+    """
+    Yields the JSON object on each non-blank line of one or more JSONL files
+    (file objects, in text or binary mode, or paths). offset and max_records
+    select a window across the files, as in xml_stream.iter_elements.
+    """
+    if not isinstance(fps, (list, tuple)):
+        fps = [fps]
+
+    seen = 0
+    yielded = 0
+    for fp in fps:
+        opened = isinstance(fp, str)
+        if opened:
+            fp = open_corpus(fp, 'rb')
+        try:
+            for line in fp:
+                if max_records is not None and yielded >= max_records:
+                    return
+                if not line.strip():
+                    continue
+                if seen >= offset:
+                    yield json.loads(line)
+                    yielded += 1
+                seen += 1
+        finally:
+            if opened:
+                fp.close()
+
+#
+# Helpers
+#
+
+def _open_with_tool(path, codec, writing, threads):
+    for tool, thread_flags in TOOLS[codec]:
+        executable = shutil.which(tool)
+        if executable is None:
+            continue
+        if writing:
+            command = [executable, '-c'] + thread_flags(threads)
+            with open(path, 'wb') as out:
+                process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=out, bufsize=0)
+            return io.BufferedWriter(_ProcessStream(process, process.stdin, path))
+        command = [executable, '-dc'] + thread_flags(threads) + [path]
+        if not os.path.exists(path):
+            raise FileNotFoundError(2, "No such file or directory", path)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=0)
+        return io.BufferedReader(_ProcessStream(process, process.stdout, path))
+    return None
+
+def _open_in_process(path, codec, writing, threads):
+    mode = 'wb' if writing else 'rb'
+    if codec == 'gzip':
+        return gzip.open(path, mode)
+    if codec == 'xz':
+        fp = lzma.open(path, mode)
+        fp.name = path
+        return fp
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading or writing %s needs the zstd command or the zstandard package "
+                          "(pip install zstandard)" % path)
+    raw = open(path, mode)
+    if writing:
+        fp = zstandard.ZstdCompressor(threads=threads).stream_writer(raw, closefd=True)
+    else:
+        fp = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+    return io.BufferedWriter(fp) if writing else io.BufferedReader(fp)
+
+class _ProcessStream(io.RawIOBase):
+    """ The stdin or stdout pipe of a (de)compressor process, as a raw file """
+    def __init__(self, process, pipe, name):
+        self.process = process
+        self.pipe = pipe
+        self.name = name
+        self.eof = False
+
+    def readable(self):
+        return self.pipe is self.process.stdout
+
+    def writable(self):
+        return self.pipe is self.process.stdin
+
+    def readinto(self, buffer):
+        n = self.pipe.readinto(buffer)
+        if not n:
+            self.eof = True
+        return n
+
+    def write(self, data):
+        return self.pipe.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.pipe.close()
+        if self.readable() and not self.eof:
+            # the reader stopped early, so the tool is killed rather than left blocked on a full pipe
+            self.process.kill()
+            self.process.wait()
+            return
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise IOError("%s exited with %d on %s" % (os.path.basename(self.process.args[0]), returncode, self.name))
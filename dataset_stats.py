@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+#
+# dataset_stats.py: WordPiece length statistics for picking max_seq_length
+#
+# For each split this reports the distribution of article lengths after
+# WordPiece tokenization and, for every candidate max_seq_length, the share of
+# compute spent on padding and the share of tokens lost to truncation. It also
+# recommends bucket boundaries that minimise padding when batches are grouped
+# by length.
+#
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+
+from corpus_io import find_corpus, open_corpus
+
+#
+# Helpers
+#
+
+DEFAULT_SPLITS = {
+    "train-byarticle": "training/preprocessed/articles-training-byarticle-20181122.prep.txt",
+    "validation": "validation/preprocessed/articles-validation.prep.txt",
+    "train-bypublisher": "training/preprocessed/articles-training-bypublisher-20181122.prep.txt",
+}
+
+def wordpiece_lengths(path, tokenizer, max_articles=None):
+    """ Number of WordPieces per article, counting [CLS] and [SEP] """
+    lengths = []
+    with open_corpus(path, "r") as fp:
+        for i, line in enumerate(fp):
+            if max_articles is not None and i >= max_articles:
+                break
+            lengths.append(len(tokenizer.tokenize(line.strip())) + 2)
+            if i % 1000 == 0:
+                print("%s: %d" % (os.path.basename(path), i), file=sys.stderr, end='\r')
+    print(file=sys.stderr)
+    return np.array(lengths, dtype=np.int64)
+
+def padding_fraction(lengths, max_seq_length):
+    """ Share of the padded [N, max_seq_length] batch that is padding """
+    used = np.minimum(lengths, max_seq_length)
+    return 1.0 - used.sum() / float(len(lengths) * max_seq_length)
+
+def truncation_fraction(lengths, max_seq_length):
+    """ Share of all real tokens that do not fit into max_seq_length """
+    return np.maximum(lengths - max_seq_length, 0).sum() / float(lengths.sum())
+
+def bucket_boundaries(lengths, max_seq_length, num_buckets):
+    """
+    Choose up to num_buckets upper bounds (the last one is max_seq_length) so that
+    padding every article to its bucket's bound wastes as little as possible.
+    Solved exactly by dynamic programming over the histogram of capped lengths.
+    """
+    capped = np.minimum(lengths, max_seq_length)
+    values, counts = np.unique(capped, return_counts=True)
+    if values[-1] != max_seq_length:
+        values = np.append(values, max_seq_length)
+        counts = np.append(counts, 0)
+    prefix_counts = np.concatenate([[0], np.cumsum(counts)])
+    prefix_tokens = np.concatenate([[0], np.cumsum(counts * values)])
+
+    def cost(i, j):
+        # padding when values[i..j] are all padded up to values[j]
+        n = prefix_counts[j + 1] - prefix_counts[i]
+        return n * values[j] - (prefix_tokens[j + 1] - prefix_tokens[i])
+
+    m = len(values)
+    num_buckets = min(num_buckets, m)
+    best = np.full((num_buckets + 1, m), np.inf)
+    choice = np.zeros((num_buckets + 1, m), dtype=np.int64)
+    for j in range(m):
+        best[1][j] = cost(0, j)
+    for k in range(2, num_buckets + 1):
+        for j in range(1, m):
+            # the last bucket covers values[i..j] for every possible start i
+            i = np.arange(1, j + 1)
+            candidates = best[k - 1][i - 1] + cost(i, j)
+            best[k][j] = candidates.min()
+            choice[k][j] = i[candidates.argmin()]
+
+    k = int(np.argmin(best[1:, m - 1])) + 1
+    bounds = []
+    j = m - 1
+    while k > 0:
+        bounds.append(int(values[j]))
+        i = choice[k][j] if k > 1 else 0
+        j = i - 1
+        k -= 1
+    bounds = sorted(bounds)
+    padded = best[len(bounds)][m - 1]
+    return bounds, float(padded / (capped.sum() + padded))
+
+def split_statistics(lengths, max_seq_lengths, num_buckets):
+    stats = {
+        "articles": int(len(lengths)),
+        "tokens": int(lengths.sum()),
+        "mean": float(lengths.mean()),
+        "percentiles": dict((str(p), float(np.percentile(lengths, p))) for p in (50, 75, 90, 95, 99)),
+        "max": int(lengths.max()),
+        "candidates": {},
+    }
+    for max_seq_length in max_seq_lengths:
+        bounds, bucketed_padding = bucket_boundaries(lengths, max_seq_length, num_buckets)
+        stats["candidates"][str(max_seq_length)] = {
+            "padding_fraction": float(padding_fraction(lengths, max_seq_length)),
+            "truncation_fraction": float(truncation_fraction(lengths, max_seq_length)),
+            "buckets": bounds,
+            "bucketed_padding_fraction": bucketed_padding,
+        }
+    return stats
+
+def print_statistics(name, stats):
+    print("== %s: %d articles, %d WordPieces, mean %.1f, max %d" % (name, stats["articles"], stats["tokens"], stats["mean"], stats["max"]))
+    print("   percentiles: " + ", ".join("p%s=%d" % (p, v) for p, v in stats["percentiles"].items()))
+    print("   %8s %9s %10s %10s  %s" % ("max_len", "padding", "truncated", "bucketed", "bucket bounds"))
+    for max_seq_length, candidate in stats["candidates"].items():
+        print("   %8s %8.1f%% %9.1f%% %9.1f%%  %s" % (max_seq_length, 100 * candidate["padding_fraction"],
+                                                  100 * candidate["truncation_fraction"],
+                                                  100 * candidate["bucketed_padding_fraction"],
+                                                  " ".join(str(b) for b in candidate["buckets"])))
+
+#
+# CLI
+#
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report WordPiece length, padding and truncation statistics per split")
+    parser.add_argument('--data_dir', default='../semeval/', help='the SemEval data directory used by run_classifier.py')
+    parser.add_argument('--split', action='append', default=None, metavar='NAME=PATH',
+                        help='a .prep.txt file to analyse (repeatable); defaults to the standard SemEval splits that exist')
+    parser.add_argument('--bert_model', default='bert-large-uncased', help='model whose WordPiece vocabulary to use')
+    parser.add_argument('--do_lower_case', action='store_true')
+    parser.add_argument('--max_seq_lengths', type=int, nargs='+', default=[64, 128, 256, 384, 500, 512])
+    parser.add_argument('--num_buckets', type=int, default=4, help='number of length buckets to recommend')
+    parser.add_argument('--max_articles', type=int, default=None, help='only look at the first N articles of each split')
+    parser.add_argument('--output', default=None, help='also write the statistics as JSON here')
+    args = parser.parse_args()
+
+    if args.split:
+        splits = dict(split.split("=", 1) for split in args.split)
+    else:
+        splits = dict((name, find_corpus(os.path.join(args.data_dir, path))) for name, path in DEFAULT_SPLITS.items()
+                      if os.path.exists(find_corpus(os.path.join(args.data_dir, path))))
+    if not splits:
+        raise ValueError("No splits found in %s, pass them with --split NAME=PATH" % args.data_dir)
+
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    results = {}
+    for name, path in splits.items():
+        lengths = wordpiece_lengths(path, tokenizer, args.max_articles)
+        results[name] = split_statistics(lengths, args.max_seq_lengths, args.num_buckets)
+        print_statistics(name, results[name])
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
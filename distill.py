@@ -0,0 +1,337 @@
+# coding=utf-8
+"""Distils a fine-tuned BERT classifier into a much smaller student.
+
+The teacher is the checkpoint written by `train.sh` (bert-large fine-tuned by
+run_classifier.py). It is run once over the by-article and by-publisher
+training corpora and its logits are cached to disk, keyed by the teacher
+checkpoint, corpus and sequence length, so later runs (e.g. trying other
+student sizes or temperatures) skip the teacher entirely. The student is a
+BertForSequenceClassification with fewer and narrower layers, trained on
+
+    alpha * T^2 * KL(teacher / T || student / T) + (1 - alpha) * CE(student, label)
+
+and saved as a directory that `--bert_model` accepts. A report compares the
+accuracy and inference throughput of teacher and student on the validation set.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from itertools import islice
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from tqdm import tqdm, trange
+
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+from pytorch_pretrained_bert.modeling import BertConfig, BertForSequenceClassification, CONFIG_NAME, WEIGHTS_NAME
+from pytorch_pretrained_bert.optimization import BertAdam
+from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
+from corpus_io import file_signature, find_corpus, open_corpus
+from mixed_precision import MixedPrecision, add_precision_arguments
+from prefetch import DevicePrefetcher, add_prefetch_arguments
+from run_classifier import convert_examples_to_features, create_example_semeval2
+
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+LABELS = ["false", "true"]
+
+# (articles, labels) for each corpus the teacher labels, relative to --data_dir
+CORPORA = {
+    "byarticle": ("training/preprocessed/articles-training-byarticle-20181122.prep.txt",
+                  "training/preprocessed/ground-truth-training-byarticle-20181122.txt"),
+    "bypublisher": ("training/preprocessed/articles-training-bypublisher-20181122.prep.txt",
+                    "training/preprocessed/ground-truth-training-bypublisher-20181122.txt"),
+}
+VALIDATION = ("validation/preprocessed/articles-validation.prep.txt",
+              "validation/preprocessed/ground-truth-validation.txt")
+
+
+def load_examples(data_dir, paths, set_type, max_articles=None):
+    text_path, label_path = (find_corpus(os.path.join(data_dir, path)) for path in paths)
+    with open_corpus(text_path, "r") as text_file, open_corpus(label_path, "r") as label_file:
+        return [create_example_semeval2((i, text_line, label, set_type))
+                for i, (text_line, label) in enumerate(islice(zip(text_file, label_file), max_articles))]
+
+
+def load_tensors(examples, max_seq_length, tokenizer):
+    """input_ids, input_mask, segment_ids and label_ids tensors for a list of examples."""
+    features = convert_examples_to_features(examples, LABELS, max_seq_length, tokenizer)
+    return (torch.tensor([f.input_ids for f in features], dtype=torch.long),
+            torch.tensor([f.input_mask for f in features], dtype=torch.long),
+            torch.tensor([f.segment_ids for f in features], dtype=torch.long),
+            torch.tensor([f.label_id for f in features], dtype=torch.long))
+
+
+def cache_key(args, data_dir, paths, max_articles):
+    """Identifies one corpus as labelled by one teacher checkpoint."""
+    key = {
+        "teacher": args.teacher_bert_model,
+        "checkpoint": file_signature(args.teacher_model_path),
+        "corpus": [file_signature(find_corpus(os.path.join(data_dir, path))) for path in paths],
+        "max_articles": max_articles,
+        "max_seq_length": args.max_seq_length,
+        "do_lower_case": args.do_lower_case,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def predict_logits(model, tensors, batch_size, device, precision):
+    """Logits of the model over every example, as a float32 [N, num_labels] array."""
+    model.eval()
+    data = TensorDataset(*tensors[:3])
+    logits = []
+    for input_ids, input_mask, segment_ids in tqdm(DataLoader(data, sampler=SequentialSampler(data), batch_size=batch_size),
+                                                   desc="Teacher"):
+        with torch.no_grad(), precision.autocast():
+            batch_logits = model(input_ids.to(device), segment_ids.to(device), input_mask.to(device))
+        logits.append(batch_logits.float().cpu().numpy())
+    return np.concatenate(logits)
+
+
+def evaluate(model, tensors, batch_size, device, precision):
+    """Accuracy and inference throughput (examples/sec) on a labelled set."""
+    model.eval()
+    data = TensorDataset(*tensors)
+    correct = 0
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for input_ids, input_mask, segment_ids, label_ids in DataLoader(data, sampler=SequentialSampler(data), batch_size=batch_size):
+        with torch.no_grad(), precision.autocast():
+            logits = model(input_ids.to(device), segment_ids.to(device), input_mask.to(device))
+        correct += (logits.argmax(dim=1) == label_ids.to(device)).sum().item()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+    return correct / len(data), len(data) / elapsed
+
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature, alpha):
+    soft = F.kl_div(F.log_softmax(student_logits / temperature, dim=-1),
+                    F.softmax(teacher_logits / temperature, dim=-1),
+                    reduction="batchmean")
+    # T^2 keeps the soft-label gradients on the same scale as the hard-label ones
+    hard = F.cross_entropy(student_logits, labels)
+    return alpha * temperature ** 2 * soft + (1 - alpha) * hard
+
+
+def num_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def save_student(model, tokenizer, directory):
+    """Writes the student in the layout BertForSequenceClassification.from_pretrained expects."""
+    os.makedirs(directory, exist_ok=True)
+    torch.save(model.state_dict(), os.path.join(directory, WEIGHTS_NAME))
+    with open(os.path.join(directory, CONFIG_NAME), "w") as fp:
+        fp.write(model.config.to_json_string())
+    with open(os.path.join(directory, "vocab.txt"), "w") as fp:
+        for token, _ in sorted(tokenizer.vocab.items(), key=lambda item: item[1]):
+            fp.write(token + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    ## Required parameters
+    parser.add_argument("--data_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The SemEval data directory, with training/ and validation/ subdirectories of preprocessed articles.")
+    parser.add_argument("--teacher_model_path",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The fine-tuned teacher checkpoint, e.g. the model.pth written by train.sh.")
+    parser.add_argument("--output_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The output directory for the student model and the report.")
+
+    ## Other parameters
+    parser.add_argument("--teacher_bert_model", default="bert-large-uncased", type=str,
+                        help="The architecture and vocabulary of the teacher.")
+    parser.add_argument("--student_bert_model", default=None, type=str,
+                        help="Start the student from this pre-trained model instead of a randomly initialised one "
+                             "sized by the --student_* flags. It must share the teacher's vocabulary.")
+    parser.add_argument("--student_hidden_size", default=384, type=int)
+    parser.add_argument("--student_layers", default=4, type=int)
+    parser.add_argument("--student_heads", default=6, type=int)
+    parser.add_argument("--corpora",
+                        default=["byarticle", "bypublisher"],
+                        nargs="+",
+                        choices=sorted(CORPORA),
+                        help="Corpora the teacher labels for the student.")
+    parser.add_argument("--max_articles_per_corpus", default=None, type=int,
+                        help="Only use the first N articles of each corpus.")
+    parser.add_argument("--max_eval_articles", default=None, type=int,
+                        help="Only evaluate on the first N validation articles.")
+    parser.add_argument("--cache_dir", default=None, type=str,
+                        help="Where to cache the teacher logits, by default <data_dir>/distill_cache.")
+    parser.add_argument("--max_seq_length",
+                        default=500,
+                        type=int,
+                        help="The maximum total input sequence length after WordPiece tokenization.")
+    parser.add_argument("--do_lower_case",
+                        default=False,
+                        action='store_true',
+                        help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--temperature", default=2.0, type=float,
+                        help="Softmax temperature for the soft labels.")
+    parser.add_argument("--alpha", default=0.5, type=float,
+                        help="Weight of the soft-label (KL) loss; the hard-label loss gets 1 - alpha.")
+    parser.add_argument("--train_batch_size", default=32, type=int)
+    parser.add_argument("--eval_batch_size", default=32, type=int)
+    parser.add_argument("--learning_rate", default=1e-4, type=float)
+    parser.add_argument("--num_train_epochs", default=3.0, type=float)
+    parser.add_argument("--warmup_proportion",
+                        default=0.1,
+                        type=float,
+                        help="Proportion of training to perform linear learning rate warmup for. "
+                             "E.g., 0.1 = 10%% of training.")
+    parser.add_argument("--no_cuda",
+                        default=False,
+                        action='store_true',
+                        help="Whether not to use CUDA when available")
+    parser.add_argument('--seed',
+                        type=int,
+                        default=42,
+                        help="random seed for initialization")
+    add_precision_arguments(parser)
+    add_prefetch_arguments(parser)
+
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    precision = MixedPrecision(device, fp16=args.fp16, bf16=args.bf16, loss_scale=args.loss_scale)
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    cache_dir = args.cache_dir or os.path.join(args.data_dir, "distill_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    tokenizer = BertTokenizer.from_pretrained(args.teacher_bert_model, do_lower_case=args.do_lower_case)
+    teacher = BertForSequenceClassification.from_pretrained(args.teacher_bert_model,
+                                                            cache_dir=PYTORCH_PRETRAINED_BERT_CACHE / 'distributed_-1',
+                                                            num_labels=len(LABELS))
+    teacher.load_state_dict(torch.load(args.teacher_model_path, map_location="cpu"))
+    teacher.to(device)
+
+    # Soft labels: the teacher runs only over corpora it has not labelled before
+    train_tensors = []
+    for corpus in args.corpora:
+        tensors = load_tensors(load_examples(args.data_dir, CORPORA[corpus], corpus, args.max_articles_per_corpus),
+                               args.max_seq_length, tokenizer)
+        cache_path = os.path.join(cache_dir, "%s-%s.npy" % (corpus, cache_key(args, args.data_dir, CORPORA[corpus],
+                                                                              args.max_articles_per_corpus)))
+        if os.path.exists(cache_path):
+            logger.info("Loading cached teacher logits for %s from %s", corpus, cache_path)
+            logits = np.load(cache_path)
+        else:
+            logits = predict_logits(teacher, tensors, args.eval_batch_size, device, precision)
+            np.save(cache_path, logits)
+            logger.info("Cached teacher logits for %s in %s", corpus, cache_path)
+        if len(logits) != len(tensors[0]):
+            raise ValueError("Cached logits in %s cover %d articles, the corpus has %d" % (cache_path, len(logits), len(tensors[0])))
+        train_tensors.append(tensors + (torch.from_numpy(logits),))
+
+    eval_tensors = load_tensors(load_examples(args.data_dir, VALIDATION, "validation", args.max_eval_articles),
+                                args.max_seq_length, tokenizer)
+    teacher_accuracy, teacher_throughput = evaluate(teacher, eval_tensors, args.eval_batch_size, device, precision)
+    teacher_parameters = num_parameters(teacher)
+    vocab_size = teacher.config.vocab_size
+    logger.info("Teacher: accuracy %.4f, %.1f examples/sec", teacher_accuracy, teacher_throughput)
+    del teacher
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+
+    # Student
+    if args.student_bert_model is not None:
+        student = BertForSequenceClassification.from_pretrained(args.student_bert_model, num_labels=len(LABELS))
+    else:
+        config = BertConfig(vocab_size,
+                            hidden_size=args.student_hidden_size,
+                            num_hidden_layers=args.student_layers,
+                            num_attention_heads=args.student_heads,
+                            intermediate_size=4 * args.student_hidden_size)
+        student = BertForSequenceClassification(config, num_labels=len(LABELS))
+    student.to(device)
+
+    train_data = TensorDataset(*(torch.cat(columns) for columns in zip(*train_tensors)))
+    train_dataloader = DevicePrefetcher(DataLoader(train_data, sampler=RandomSampler(train_data),
+                                                   batch_size=args.train_batch_size), device, args.prefetch_batches)
+    num_train_steps = int(len(train_dataloader) * args.num_train_epochs)
+
+    no_decay = ['bias', 'gamma', 'beta']
+    param_optimizer = list(student.named_parameters())
+    optimizer_grouped_parameters = [
+        {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.01},
+        {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.0}
+        ]
+    optimizer = BertAdam(optimizer_grouped_parameters,
+                         lr=args.learning_rate,
+                         warmup=args.warmup_proportion,
+                         t_total=num_train_steps)
+
+    logger.info("***** Distilling *****")
+    logger.info("  Num examples = %d", len(train_data))
+    logger.info("  Teacher parameters = %d, student parameters = %d", teacher_parameters, num_parameters(student))
+
+    with open(os.path.join(args.output_dir, "eval_results.txt"), "w") as output_eval_file:
+        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
+            student.train()
+            for input_ids, input_mask, segment_ids, label_ids, teacher_logits in tqdm(train_dataloader, desc="Iteration"):
+                with precision.autocast():
+                    student_logits = student(input_ids, segment_ids, input_mask)
+                loss = distillation_loss(student_logits.float(), teacher_logits, label_ids, args.temperature, args.alpha)
+                precision.backward(loss)
+                precision.step(optimizer)
+                student.zero_grad()
+            train_dataloader.log_waits()
+
+            accuracy, _ = evaluate(student, eval_tensors, args.eval_batch_size, device, precision)
+            print("\nEpoch %d: Validation Accuracy=%.4f\n" % (epoch, accuracy))
+            output_eval_file.write("Epoch %d: Validation Accuracy=%.4f\n" % (epoch, accuracy))
+            output_eval_file.flush()
+
+    save_student(student, tokenizer, os.path.join(args.output_dir, "student"))
+
+    student_accuracy, student_throughput = evaluate(student, eval_tensors, args.eval_batch_size, device, precision)
+    report = {
+        "device": str(device),
+        "eval_examples": len(eval_tensors[0]),
+        "max_seq_length": args.max_seq_length,
+        "teacher": {"parameters": teacher_parameters, "accuracy": teacher_accuracy, "examples_per_sec": teacher_throughput},
+        "student": {"parameters": num_parameters(student), "accuracy": student_accuracy, "examples_per_sec": student_throughput},
+        "speedup": student_throughput / teacher_throughput,
+    }
+    with open(os.path.join(args.output_dir, "distill_report.json"), "w") as fp:
+        json.dump(report, fp, indent=2)
+
+    logger.info("***** Distillation report *****")
+    for name in ("teacher", "student"):
+        logger.info("  %-7s %11d parameters, accuracy %.4f, %8.1f examples/sec", name, report[name]["parameters"],
+                    report[name]["accuracy"], report[name]["examples_per_sec"])
+    logger.info("  student speedup %.2fx", report["speedup"])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# coding=utf-8
+"""Data-parallel training across processes, on GPUs or CPU-only nodes.
+
+The training scripts used to hard-code the nccl backend and take a CUDA device
+from `--local_rank`, so distributed runs were impossible without GPUs. Here the
+backend follows the device: nccl when each process drives a GPU, gloo on CPU.
+Start one process per GPU (or per group of cores) with `launch.py` or torchrun;
+both set the rendezvous environment variables read by `init_process_group`.
+
+Each rank trains on its own shard of the data (DistributedSampler) and
+DistributedDataParallel all-reduces the gradients. Evaluation is sharded too
+(ShardedSampler) and the per-rank counts are summed with `all_reduce_sum`.
+Only rank 0 writes checkpoints and result files.
+"""
+
+import contextlib
+import logging
+import os
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+logger = logging.getLogger(__name__)
+
+
+def add_distributed_arguments(parser):
+    """Adds the --local_rank/--dist_backend flags to an argparse parser."""
+    parser.add_argument("--local_rank",
+                        type=int,
+                        default=int(os.environ.get("LOCAL_RANK", -1)),
+                        help="local_rank for distributed training, set by launch.py or torchrun")
+    parser.add_argument("--dist_backend",
+                        default=None,
+                        choices=["nccl", "gloo"],
+                        help="torch.distributed backend; defaults to nccl on GPUs and gloo on CPU")
+
+
+def setup_distributed(args):
+    """Picks the device and, for distributed runs, joins the process group.
+
+    Returns (device, n_gpu) as the training scripts used to compute them.
+    """
+    use_cuda = torch.cuda.is_available() and not args.no_cuda
+    if args.local_rank == -1:
+        device = torch.device("cuda" if use_cuda else "cpu")
+        n_gpu = torch.cuda.device_count() if use_cuda else 0
+        return device, n_gpu
+
+    if use_cuda:
+        device = torch.device("cuda", args.local_rank)
+        torch.cuda.set_device(device)
+        n_gpu = 1
+    else:
+        device = torch.device("cpu")
+        n_gpu = 0
+        # every local process gets its share of the cores rather than all of them
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    backend = args.dist_backend or ("nccl" if use_cuda else "gloo")
+    # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
+    dist.init_process_group(backend=backend)
+    logger.info("rank %d of %d, backend %s, %d threads", dist.get_rank(), dist.get_world_size(), backend,
+                torch.get_num_threads())
+    return device, n_gpu
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def wrap_model(model, device, n_gpu):
+    """DistributedDataParallel when distributed, DataParallel over several local GPUs, else the model itself."""
+    if is_distributed():
+        if device.type == "cuda":
+            return torch.nn.parallel.DistributedDataParallel(model, device_ids=[device.index],
+                                                             output_device=device.index)
+        return torch.nn.parallel.DistributedDataParallel(model)
+    if n_gpu > 1:
+        return torch.nn.DataParallel(model)
+    return model
+
+
+def unwrap_model(model):
+    """The module inside a (Distributed)DataParallel wrapper, e.g. for its state_dict."""
+    return model.module if hasattr(model, "module") else model
+
+
+def gradient_sync(model, sync):
+    """Context for a forward/backward pass; with sync=False DDP skips the all-reduce.
+
+    Used for all but the last micro-batch of a gradient accumulation window, so
+    the gradients cross the network once per optimizer step.
+    """
+    if sync or not isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return contextlib.suppress()
+    return model.no_sync()
+
+
+def all_reduce_sum(values, device):
+    """Sums a list of numbers over all ranks, returning a list of floats."""
+    if not is_distributed():
+        return [float(v) for v in values]
+    # gloo reduces CPU tensors, nccl needs them on the GPU
+    tensor = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+class ShardedSampler(Sampler):
+    """Splits a dataset into disjoint, strided per-rank shards without padding.
+
+    Unlike DistributedSampler no example is repeated to even out the shards, so
+    counts summed over ranks are exact. Order within a shard is sequential.
+    """
+
+    def __init__(self, data_source, num_replicas=None, rank=None):
+        self.data_source = data_source
+        self.num_replicas = get_world_size() if num_replicas is None else num_replicas
+        self.rank = get_rank() if rank is None else rank
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.data_source), self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.data_source), self.num_replicas))
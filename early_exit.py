@@ -0,0 +1,265 @@
+# coding=utf-8
+"""Trains early-exit heads on a fine-tuned BERT classifier and reports the tradeoff.
+
+Most articles are decided long before the last of bert-large's 24 layers.
+BertForEarlyExitClassification adds a small classifier head after every
+encoder layer but the last; this script loads a fine-tuned checkpoint (the
+`model.pth` written by `train.sh`) into it, freezes everything else and trains
+only the heads, each on
+
+    alpha * T^2 * KL(final classifier / T || head / T) + (1 - alpha) * CE(head, label)
+
+so the heads learn to agree with the full model. The checkpoint with the heads
+is saved as `model.pth`, which `run_classifier.py --early_exit_threshold`
+loads through `--model_path`. `early_exit_report.json` lists, for the full
+model and each confidence threshold, the validation accuracy, the mean number
+of encoder layers executed and the articles/sec.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import random
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from tqdm import tqdm, trange
+
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+from pytorch_pretrained_bert.optimization import BertAdam
+from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
+from bertaverager import BertForEarlyExitClassification
+from distill import CORPORA, LABELS, VALIDATION, distillation_loss, evaluate, load_examples, load_tensors
+from mixed_precision import MixedPrecision, add_precision_arguments
+from prefetch import DevicePrefetcher, add_prefetch_arguments
+
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def head_accuracies(model, tensors, batch_size, device, precision):
+    """Validation accuracy of every exit head and of the full model, shallowest first."""
+    model.eval()
+    data = TensorDataset(*tensors)
+    correct = np.zeros(model.config.num_hidden_layers)
+    for input_ids, input_mask, segment_ids, label_ids in DataLoader(data, sampler=SequentialSampler(data), batch_size=batch_size):
+        with torch.no_grad(), precision.autocast():
+            logits = model.all_exit_logits(input_ids.to(device), segment_ids.to(device), input_mask.to(device))
+        label_ids = label_ids.to(device)
+        correct += [(layer_logits.argmax(dim=1) == label_ids).sum().item() for layer_logits in logits]
+    return correct / len(data)
+
+
+def evaluate_early_exit(model, tensors, batch_size, device, precision, threshold):
+    """Accuracy, articles/sec, mean encoder layers and exits per layer at a confidence threshold."""
+    model.eval()
+    data = TensorDataset(*tensors)
+    correct = 0
+    exit_layers = []
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for input_ids, input_mask, segment_ids, label_ids in DataLoader(data, sampler=SequentialSampler(data), batch_size=batch_size):
+        with torch.no_grad(), precision.autocast():
+            logits, layers = model.early_exit(input_ids.to(device), segment_ids.to(device), input_mask.to(device),
+                                              threshold=threshold)
+        correct += (logits.argmax(dim=1) == label_ids.to(device)).sum().item()
+        exit_layers.append(layers.cpu())
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+    exit_layers = torch.cat(exit_layers).numpy()
+    return {
+        "threshold": threshold,
+        "accuracy": correct / len(data),
+        "articles_per_sec": len(data) / elapsed,
+        "mean_layers": float(exit_layers.mean()),
+        "exits_per_layer": np.bincount(exit_layers, minlength=model.config.num_hidden_layers + 1)[1:].tolist(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    ## Required parameters
+    parser.add_argument("--data_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The SemEval data directory, with training/ and validation/ subdirectories of preprocessed articles.")
+    parser.add_argument("--model_path",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The fine-tuned checkpoint, e.g. the model.pth written by train.sh.")
+    parser.add_argument("--output_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The output directory for the checkpoint with exit heads and the report.")
+
+    ## Other parameters
+    parser.add_argument("--bert_model", default="bert-large-uncased", type=str,
+                        help="The architecture and vocabulary of the fine-tuned model.")
+    parser.add_argument("--corpora",
+                        default=["byarticle"],
+                        nargs="+",
+                        choices=sorted(CORPORA),
+                        help="Corpora to train the exit heads on.")
+    parser.add_argument("--max_articles_per_corpus", default=None, type=int,
+                        help="Only use the first N articles of each corpus.")
+    parser.add_argument("--max_eval_articles", default=None, type=int,
+                        help="Only evaluate on the first N validation articles.")
+    parser.add_argument("--max_seq_length",
+                        default=500,
+                        type=int,
+                        help="The maximum total input sequence length after WordPiece tokenization.")
+    parser.add_argument("--do_lower_case",
+                        default=False,
+                        action='store_true',
+                        help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--head_size", default=128, type=int,
+                        help="Hidden size of each exit head.")
+    parser.add_argument("--thresholds",
+                        default=[0.6, 0.7, 0.8, 0.9, 0.95, 0.99],
+                        nargs="+",
+                        type=float,
+                        help="Confidence thresholds to report.")
+    parser.add_argument("--temperature", default=2.0, type=float,
+                        help="Softmax temperature for the final classifier's soft labels.")
+    parser.add_argument("--alpha", default=0.5, type=float,
+                        help="Weight of the soft-label (KL) loss; the hard-label loss gets 1 - alpha.")
+    parser.add_argument("--train_batch_size", default=32, type=int)
+    parser.add_argument("--eval_batch_size", default=32, type=int)
+    parser.add_argument("--learning_rate", default=1e-3, type=float)
+    parser.add_argument("--num_train_epochs", default=2.0, type=float)
+    parser.add_argument("--warmup_proportion",
+                        default=0.1,
+                        type=float,
+                        help="Proportion of training to perform linear learning rate warmup for. "
+                             "E.g., 0.1 = 10%% of training.")
+    parser.add_argument("--no_cuda",
+                        default=False,
+                        action='store_true',
+                        help="Whether not to use CUDA when available")
+    parser.add_argument('--seed',
+                        type=int,
+                        default=42,
+                        help="random seed for initialization")
+    add_precision_arguments(parser)
+    add_prefetch_arguments(parser)
+
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    precision = MixedPrecision(device, fp16=args.fp16, bf16=args.bf16, loss_scale=args.loss_scale)
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    model = BertForEarlyExitClassification.from_pretrained(args.bert_model,
+                                                           cache_dir=PYTORCH_PRETRAINED_BERT_CACHE / 'distributed_-1',
+                                                           num_labels=len(LABELS),
+                                                           head_size=args.head_size)
+    incompatible = model.load_state_dict(torch.load(args.model_path, map_location="cpu"), strict=False)
+    missing = [key for key in incompatible.missing_keys if not key.startswith("exit_heads.")]
+    if missing or incompatible.unexpected_keys:
+        raise ValueError("%s is not a BertForSequenceClassification checkpoint for %s: missing %s, unexpected %s"
+                         % (args.model_path, args.bert_model, missing[:5], incompatible.unexpected_keys[:5]))
+    model.to(device)
+
+    # only the heads train; the fine-tuned model is their (frozen) teacher
+    for param in model.parameters():
+        param.requires_grad = False
+    for param in model.exit_heads.parameters():
+        param.requires_grad = True
+
+    train_tensors = [load_tensors(load_examples(args.data_dir, CORPORA[corpus], corpus, args.max_articles_per_corpus),
+                                  args.max_seq_length, tokenizer)
+                     for corpus in args.corpora]
+    train_data = TensorDataset(*(torch.cat(columns) for columns in zip(*train_tensors)))
+    eval_tensors = load_tensors(load_examples(args.data_dir, VALIDATION, "validation", args.max_eval_articles),
+                                args.max_seq_length, tokenizer)
+
+    train_dataloader = DevicePrefetcher(DataLoader(train_data, sampler=RandomSampler(train_data),
+                                                   batch_size=args.train_batch_size), device, args.prefetch_batches)
+    num_train_steps = int(len(train_dataloader) * args.num_train_epochs)
+    no_decay = ['bias', 'gamma', 'beta']
+    param_optimizer = list(model.exit_heads.named_parameters())
+    optimizer_grouped_parameters = [
+        {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.01},
+        {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.0}
+        ]
+    optimizer = BertAdam(optimizer_grouped_parameters,
+                         lr=args.learning_rate,
+                         warmup=args.warmup_proportion,
+                         t_total=num_train_steps)
+
+    logger.info("***** Training exit heads *****")
+    logger.info("  Num examples = %d", len(train_data))
+    logger.info("  Exit heads = %d, parameters = %d", len(model.exit_heads),
+                sum(p.numel() for p in model.exit_heads.parameters()))
+
+    with open(os.path.join(args.output_dir, "eval_results.txt"), "w") as output_eval_file:
+        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
+            # the encoder stays in eval mode (no dropout), so the soft labels are the ones inference sees
+            model.eval()
+            model.exit_heads.train()
+            for input_ids, input_mask, segment_ids, label_ids in tqdm(train_dataloader, desc="Iteration"):
+                with precision.autocast():
+                    with torch.no_grad():
+                        encoded_layers, pooled_output = model.bert(input_ids, segment_ids, input_mask)
+                        final_logits = model.classifier(model.dropout(pooled_output)).float()
+                    loss = sum(distillation_loss(head(hidden_states).float(), final_logits, label_ids,
+                                                 args.temperature, args.alpha)
+                               for head, hidden_states in zip(model.exit_heads, encoded_layers))
+                precision.backward(loss / len(model.exit_heads))
+                precision.step(optimizer)
+                model.zero_grad()
+            train_dataloader.log_waits()
+
+            accuracies = head_accuracies(model, eval_tensors, args.eval_batch_size, device, precision)
+            line = "Epoch %d: Validation Accuracy by layer=%s" % (epoch, " ".join("%.4f" % a for a in accuracies))
+            print("\n" + line + "\n")
+            output_eval_file.write(line + "\n")
+            output_eval_file.flush()
+
+    torch.save(model.state_dict(), os.path.join(args.output_dir, "model.pth"))
+
+    model.exit_threshold = None
+    full_accuracy, full_throughput = evaluate(model, eval_tensors, args.eval_batch_size, device, precision)
+    report = {
+        "device": str(device),
+        "eval_examples": len(eval_tensors[0]),
+        "max_seq_length": args.max_seq_length,
+        "layer_accuracy": head_accuracies(model, eval_tensors, args.eval_batch_size, device, precision).tolist(),
+        "full": {"accuracy": full_accuracy, "articles_per_sec": full_throughput,
+                 "mean_layers": model.config.num_hidden_layers},
+        "thresholds": [evaluate_early_exit(model, eval_tensors, args.eval_batch_size, device, precision, threshold)
+                       for threshold in args.thresholds],
+    }
+    with open(os.path.join(args.output_dir, "early_exit_report.json"), "w") as fp:
+        json.dump(report, fp, indent=2)
+
+    logger.info("***** Early exit report *****")
+    logger.info("  full model     accuracy %.4f, %5.1f layers, %8.1f articles/sec", full_accuracy,
+                model.config.num_hidden_layers, full_throughput)
+    for result in report["thresholds"]:
+        logger.info("  threshold %.2f accuracy %.4f, %5.1f layers, %8.1f articles/sec", result["threshold"],
+                    result["accuracy"], result["mean_layers"], result["articles_per_sec"])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# coding=utf-8
+"""Frozen-encoder training from a memory-mapped cache of encoder outputs.
+
+When a grid-search trial only changes the learning rate or the number of
+epochs, running the whole of bert-large forward and backward every epoch is
+wasted work. In frozen-encoder mode the encoder runs once, in eval mode, over
+a dataset, and its outputs are stored in a .npy file that is memory-mapped on
+later reads:
+
+* with no trainable layers: the pooled [CLS] output, [N, hidden];
+* with k trainable layers: the hidden states that enter the top k layers,
+  [N, max_seq_length, hidden] in float16.
+
+Only FrozenEncoderHead, which is the top k encoder layers (if any), the
+pooler and the classifier, is trained from the cache. The head shares its
+modules with the full model, so saving the model afterwards gives a normal
+checkpoint. Cache files are keyed by the encoder weights, the features and
+k, so every trial over the same data reuses them.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+from torch import nn
+from torch.nn import CrossEntropyLoss
+from torch.utils.data import DataLoader, SequentialSampler
+from tqdm import tqdm
+
+from corpus_io import file_signature
+
+logger = logging.getLogger(__name__)
+
+
+def add_frozen_encoder_arguments(parser):
+    """Adds the --frozen_encoder/--trainable_layers/--encoder_cache_dir flags to an argparse parser."""
+    parser.add_argument('--frozen_encoder',
+                        default=False,
+                        action='store_true',
+                        help="Whether to run the encoder once, cache its outputs and train only the classifier head "
+                             "(plus the top --trainable_layers layers) from the cache.")
+    parser.add_argument('--trainable_layers',
+                        type=int,
+                        default=0,
+                        help="With --frozen_encoder, how many of the top encoder layers to train. 0 caches only the pooled output.")
+    parser.add_argument('--encoder_cache_dir',
+                        default=None,
+                        type=str,
+                        help="Where to keep the encoder output caches, shared between runs. Defaults to <data_dir>/encoder_cache.")
+
+
+def encoder_cache_key(bert_model, model_path, dataset, trainable_layers):
+    """Identifies the encoder outputs of one set of weights over one set of features."""
+    digest = hashlib.sha1()
+    digest.update(json.dumps({
+        "bert_model": bert_model,
+        "model_path": file_signature(model_path) if model_path is not None else None,
+        "trainable_layers": trainable_layers,
+    }, sort_keys=True).encode("utf-8"))
+    # input_ids, input_mask and segment_ids fix what the encoder sees
+    for tensor in dataset.tensors[:3]:
+        digest.update(tensor.numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def _encode_batch(bert, input_ids, segment_ids, input_mask, trainable_layers):
+    if trainable_layers == 0:
+        _, pooled_output = bert(input_ids, segment_ids, input_mask, output_all_encoded_layers=False)
+        return pooled_output
+    encoded_layers, _ = bert(input_ids, segment_ids, input_mask, output_all_encoded_layers=True)
+    num_layers = len(encoded_layers)
+    if trainable_layers >= num_layers:
+        raise ValueError("Cannot train %d of %d encoder layers from a cache" % (trainable_layers, num_layers))
+    # the input of the first trainable layer is the output of the layer below it
+    return encoded_layers[num_layers - trainable_layers - 1]
+
+
+def build_encoder_cache(bert, dataset, path, trainable_layers, batch_size, device, precision):
+    """Runs the encoder over a TensorDataset of features once and memory-maps the outputs.
+
+    An existing cache at path is reused as is.
+    """
+    if not os.path.exists(path):
+        bert.eval()
+        num_examples = len(dataset)
+        max_seq_length = dataset.tensors[0].size(1)
+        hidden_size = bert.config.hidden_size
+        if trainable_layers == 0:
+            shape, dtype = (num_examples, hidden_size), np.float32
+        else:
+            shape, dtype = (num_examples, max_seq_length, hidden_size), np.float16
+
+        tmp_path = path + ".tmp.npy"
+        cache = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+        dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=batch_size)
+        offset = 0
+        for batch in tqdm(dataloader, desc="Encoding"):
+            input_ids, input_mask, segment_ids = (t.to(device) for t in batch[:3])
+            with torch.no_grad(), precision.autocast():
+                encoded = _encode_batch(bert, input_ids, segment_ids, input_mask, trainable_layers)
+            cache[offset:offset + encoded.size(0)] = encoded.float().cpu().numpy()
+            offset += encoded.size(0)
+        cache.flush()
+        del cache
+        os.replace(tmp_path, path)
+        logger.info("Cached encoder outputs %s in %s", shape, path)
+    else:
+        logger.info("Using cached encoder outputs from %s", path)
+    # copy-on-write keeps torch.from_numpy happy without ever writing to the file
+    return np.load(path, mmap_mode="c")
+
+
+class FrozenEncoderHead(nn.Module):
+    """The trainable top of a BertForSequenceClassification, fed from an encoder cache.
+
+    Shares (not copies) the top `trainable_layers` encoder layers, the pooler,
+    dropout and classifier of `model`.
+    """
+
+    def __init__(self, model, trainable_layers=0):
+        super(FrozenEncoderHead, self).__init__()
+        self.trainable_layers = trainable_layers
+        self.layers = nn.ModuleList(model.bert.encoder.layer[len(model.bert.encoder.layer) - trainable_layers:]
+                                    if trainable_layers > 0 else [])
+        self.pooler = model.bert.pooler
+        self.dropout = model.dropout
+        self.classifier = model.classifier
+        self.num_labels = model.num_labels if hasattr(model, "num_labels") else model.classifier.out_features
+
+    def forward(self, encoded, attention_mask, labels=None):
+        encoded = encoded.float()
+        if self.trainable_layers == 0:
+            pooled_output = encoded
+        else:
+            # the same additive mask BertModel builds: 0 for real tokens, -10000 for padding
+            extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2).to(dtype=encoded.dtype)
+            extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+            hidden_states = encoded
+            for layer_module in self.layers:
+                hidden_states = layer_module(hidden_states, extended_attention_mask)
+            pooled_output = self.pooler(hidden_states)
+        logits = self.classifier(self.dropout(pooled_output))
+
+        if labels is not None:
+            loss_fct = CrossEntropyLoss()
+            return loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+        return logits
@@ -1,9 +1,10 @@
 import argparse
 import sys
-from lxml import etree
-from itertools import islice
 from html import unescape
 
+from corpus_io import is_jsonl, iter_records, open_corpus
+from xml_stream import iter_elements, print_progress
+
 #
 # extract_articles.py: Extract the text from articles 
 #
@@ -16,38 +17,42 @@ def do_xml_parse(fp, tag, max_elements=None, progress_message=None):
     """
     Parses cleaned up spacy-processed XML files. This is done by having
     the function be a generator so that it never has to store the entire
-    data in memory.
+    data in memory; see xml_stream.iter_elements.
     """
-    fp.seek(0)
-
-    # Constructs an iterator that only includes at most max_elements from the iterator
-    # etree.iterparse along with the current index.
-    elements = enumerate(islice(etree.iterparse(fp, tag=tag), max_elements))
-    for i, (event, elem) in elements:
-        yield elem   # Returns the current element.
-        elem.clear() # Empties out the list contained in elem to save memory.
-        if progress_message and (i % 1000 == 0):
-            print(progress_message.format(i), file=sys.stderr, end='\r')
+    progress = print_progress(progress_message) if progress_message else None
+    for elem in iter_elements(fp, tag, max_elements, progress=progress):
+        yield elem
     if progress_message: print(file=sys.stderr)
 
 def extract_text2(article):
     return unescape("".join([x for x in article.find("spacy").itertext()]).lower())
 
+def extract_record_text(record):
+    """ extract_text2 for an article read from a JSONL file written by preprocess.py """
+    return unescape(record['tokens'].lower())
+
 #
 # CLI
 #
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('input_file', type=argparse.FileType('rb'), help='input xml file')
-    parser.add_argument('output_file', type=argparse.FileType('w'), help='output file')
+    parser.add_argument('input_file', help='input xml (or preprocess.py jsonl) file, optionally .gz/.xz/.zst-compressed')
+    parser.add_argument('output_file', help='output file, compressed if it ends in .gz/.xz/.zst')
     parser.add_argument('--max_articles', type=int, default=-1, help='maximum number of articles to process')
     parser.add_argument('--gt', action='store_true', help='whether your input is a ground truth file and you seek to have the article classifications')
 
     args = parser.parse_args()
     
+    input_file = open_corpus(args.input_file, 'rb')
+    output_file = open_corpus(args.output_file, 'w')
+
+    # JSONL input needs no XML parse at all
+    jsonl = is_jsonl(args.input_file)
+    articles = iter_records(input_file) if jsonl else do_xml_parse(input_file, 'article')
+
     max_len = -1
-    for index, article in enumerate(do_xml_parse(args.input_file, 'article')):
+    for index, article in enumerate(articles):
         if args.max_articles == index:
             break
 
@@ -55,14 +60,14 @@ if __name__ == '__main__':
             print(index, end='\r')
         
         if args.gt:
-            article_text = article.get('hyperpartisan')
+            article_text = article['attributes'].get('hyperpartisan') if jsonl else article.get('hyperpartisan')
         else:
-            article_text = " ".join(extract_text2(article).split())
+            article_text = " ".join((extract_record_text(article) if jsonl else extract_text2(article)).split())
             if len(article_text.split(" ")) > max_len:
                 max_len = len(article_text.split(" "))
 
-        args.output_file.write(article_text + "\n")
+        output_file.write(article_text + "\n")
     
     print("Longest length:", max_len)
-    args.input_file.close()
-    args.output_file.close()
+    input_file.close()
+    output_file.close()
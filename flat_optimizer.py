@@ -0,0 +1,163 @@
+# coding=utf-8
+"""BertAdam over flattened, contiguous parameter buffers.
+
+`--optimize_on_cpu` used to keep one CPU copy per parameter and sync
+gradients and weights through Python loops over `named_parameters()` on
+every step. FlatBertAdam instead moves every parameter (and its gradient)
+of a weight decay group into one contiguous buffer, so the Adam update is a
+handful of vectorized ops over a few large tensors. With `offload=True` the
+float32 master weights and Adam moments live in pinned host memory and the
+buffers are streamed across in chunks, overlapping the copies with the
+host-side update.
+
+The update matches BertAdam: per-parameter gradient clipping, no bias
+correction, decoupled weight decay and the warmup schedules from
+pytorch_pretrained_bert.
+"""
+
+import torch
+from torch.optim import Optimizer
+
+from pytorch_pretrained_bert.optimization import SCHEDULES
+
+
+def _norms(tensors):
+    if hasattr(torch, '_foreach_norm'):
+        return torch._foreach_norm(tensors)
+    return [t.norm() for t in tensors]
+
+
+class _FlatGroup(object):
+    """The contiguous buffers behind one parameter group."""
+
+    def __init__(self, params, offload, chunk_size):
+        device = params[0].device
+        dtype = params[0].dtype
+        self.numel = sum(p.numel() for p in params)
+        self.params = torch.zeros(self.numel, dtype=dtype, device=device)
+        self.grads = torch.zeros(self.numel, dtype=dtype, device=device)
+
+        # re-point every parameter and gradient at a slice of the flat buffers
+        self.grad_views = []
+        offset = 0
+        for p in params:
+            numel = p.numel()
+            self.params[offset:offset + numel].copy_(p.data.view(-1))
+            p.data = self.params[offset:offset + numel].view_as(p)
+            p.grad = self.grads[offset:offset + numel].view_as(p)
+            self.grad_views.append(p.grad)
+            offset += numel
+
+        self.offload = offload
+        state_device = 'cpu' if offload else device
+        pin = offload and torch.cuda.is_available()
+        if offload:
+            self.master = torch.empty(self.numel, dtype=torch.float32, pin_memory=pin)
+            self.master.copy_(self.params)
+            self.host_grads = torch.empty(self.numel, dtype=torch.float32, pin_memory=pin)
+        else:
+            self.master = self.params
+            self.host_grads = self.grads
+        self.next_m = torch.zeros(self.numel, dtype=torch.float32, device=state_device)
+        self.next_v = torch.zeros(self.numel, dtype=torch.float32, device=state_device)
+
+        self.chunks = [(start, min(start + chunk_size, self.numel)) for start in range(0, self.numel, chunk_size)]
+
+
+class FlatBertAdam(Optimizer):
+    """Implements BertAdam over contiguous parameter buffers.
+
+    Params:
+        param_groups: list of dicts with 'params' and 'weight_decay_rate', as passed to BertAdam.
+        lr, warmup, t_total, schedule, b1, b2, e, max_grad_norm: see BertAdam.
+        offload: keep the master weights and Adam moments in (pinned) host memory.
+        chunk_size: elements per host<->device copy when offloading; copies of one
+            chunk overlap with the update of the previous one.
+    """
+
+    def __init__(self, param_groups, lr, warmup=-1, t_total=-1, schedule='warmup_linear',
+                 b1=0.9, b2=0.999, e=1e-6, weight_decay_rate=0.01, max_grad_norm=1.0,
+                 offload=False, chunk_size=2 ** 24):
+        if not lr >= 0.0:
+            raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
+        if schedule not in SCHEDULES:
+            raise ValueError("Invalid schedule parameter: {}".format(schedule))
+        defaults = dict(lr=lr, schedule=schedule, warmup=warmup, t_total=t_total, b1=b1, b2=b2, e=e,
+                        weight_decay_rate=weight_decay_rate, max_grad_norm=max_grad_norm)
+        super(FlatBertAdam, self).__init__([g for g in param_groups if len(g['params']) > 0], defaults)
+
+        # offloading to the host only means something when the model lives elsewhere
+        self.offload = offload and self.param_groups[0]['params'][0].device.type != 'cpu'
+        self.flat_groups = [_FlatGroup(group['params'], self.offload, chunk_size) for group in self.param_groups]
+        self.copy_stream = torch.cuda.Stream() if self.offload else None
+        self.steps = 0
+
+    def zero_grad(self, set_to_none=False):
+        """Zeros the flat gradient buffers; gradients are never set to None so the views stay attached."""
+        for flat in self.flat_groups:
+            flat.grads.zero_()
+
+    def get_lr(self):
+        lr = []
+        for group in self.param_groups:
+            if group['t_total'] != -1:
+                schedule_fct = SCHEDULES[group['schedule']]
+                lr.append(group['lr'] * schedule_fct(self.steps / group['t_total'], group['warmup']))
+            else:
+                lr.append(group['lr'])
+        return lr
+
+    def _clip(self, group, flat):
+        """Per-parameter gradient norm clipping, as BertAdam does with clip_grad_norm_."""
+        if group['max_grad_norm'] <= 0:
+            return
+        norms = torch.stack(_norms(flat.grad_views))
+        clip = (group['max_grad_norm'] / (norms + 1e-6)).clamp_(max=1.0)
+        for view, coefficient in zip(flat.grad_views, clip.unbind()):
+            view.mul_(coefficient)
+
+    def _update(self, group, flat, lr, start, end):
+        grad = flat.host_grads[start:end]
+        param = flat.master[start:end]
+        next_m = flat.next_m[start:end]
+        next_v = flat.next_v[start:end]
+
+        next_m.mul_(group['b1']).add_(grad, alpha=1 - group['b1'])
+        next_v.mul_(group['b2']).addcmul_(grad, grad, value=1 - group['b2'])
+        denom = next_v.sqrt().add_(group['e'])
+        # p -= lr * (m / denom + weight_decay * p)
+        if group['weight_decay_rate'] > 0.0:
+            param.mul_(1 - lr * group['weight_decay_rate'])
+        param.addcdiv_(next_m, denom, value=-lr)
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group, flat, lr in zip(self.param_groups, self.flat_groups, self.get_lr()):
+            self._clip(group, flat)
+            if not self.offload:
+                for start, end in flat.chunks:
+                    self._update(group, flat, lr, start, end)
+                continue
+
+            # queue every gradient chunk for the host, then update each chunk as soon as
+            # it lands while the next ones are still in flight
+            self.copy_stream.wait_stream(torch.cuda.current_stream())
+            arrived = []
+            with torch.cuda.stream(self.copy_stream):
+                for start, end in flat.chunks:
+                    flat.host_grads[start:end].copy_(flat.grads[start:end], non_blocking=True)
+                    arrived.append(torch.cuda.Event())
+                    arrived[-1].record(self.copy_stream)
+            for (start, end), event in zip(flat.chunks, arrived):
+                event.synchronize()
+                self._update(group, flat, lr, start, end)
+                with torch.cuda.stream(self.copy_stream):
+                    flat.params[start:end].copy_(flat.master[start:end], non_blocking=True)
+            # the next forward pass must see the new weights, but the host need not wait for them
+            torch.cuda.current_stream().wait_stream(self.copy_stream)
+
+        self.steps += 1
+        return loss
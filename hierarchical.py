@@ -0,0 +1,348 @@
+# coding=utf-8
+"""Hierarchical classification: BERT sentence vectors, cached, then a small article model.
+
+BertForSplicedSequenceClassification averages over fixed token chunks that cut
+sentences in half, and every run pays for BERT over the whole article again.
+Here each -eos- delimited sentence is encoded by BERT on its own (the pooled
+[CLS] output of a pre-trained or fine-tuned checkpoint), so the cost grows
+linearly with the article rather than with the square of a long sequence. The
+sentence vectors are written once to a memory-mapped .npy file per corpus,
+keyed by the checkpoint, corpus and sentence settings. A small aggregator then
+classifies the article from its sentence vectors:
+
+* "attention": attention pooling over the sentences;
+* "transformer": a light transformer over the sentences, then attention pooling.
+
+Retraining the aggregator (other sizes, learning rates, epochs) reads the
+cache and never runs BERT again. The aggregator is saved as aggregator.pt and
+hierarchical_report.json records the encoding cost and validation accuracy.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.utils.data import Dataset, DataLoader, RandomSampler, SequentialSampler
+from tqdm import tqdm, trange
+
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+from pytorch_pretrained_bert.modeling import BertForSequenceClassification
+from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
+from batch_tokenizer import CachedWordPieceTokenizer
+from corpus_io import file_signature, find_corpus
+from distill import CORPORA, LABELS, VALIDATION, load_examples
+from mixed_precision import MixedPrecision, add_precision_arguments
+from prefetch import DevicePrefetcher, add_prefetch_arguments
+from sentence_selection import split_sentences
+
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def sentence_ids(examples, tokenizer, max_sentence_length, max_sentences):
+    """[CLS] sentence [SEP] WordPiece ids of the first max_sentences sentences of every
+    article, flattened, with the offsets of each article's sentences."""
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+    ids = []
+    offsets = [0]
+    for example in tqdm(examples, desc="Sentences"):
+        for sentence in split_sentences(example.text_a)[:max_sentences]:
+            ids.append([cls_id] + tokenizer.encode(sentence)[:max_sentence_length - 2] + [sep_id])
+        offsets.append(len(ids))
+    return ids, np.array(offsets, dtype=np.int64)
+
+
+def sentence_cache_key(args, paths):
+    """Identifies the sentence vectors of one corpus under one checkpoint and sentence settings."""
+    key = {
+        "bert_model": args.bert_model,
+        "model_path": file_signature(args.model_path) if args.model_path is not None else None,
+        "corpus": [file_signature(find_corpus(os.path.join(args.data_dir, path))) for path in paths],
+        "max_sentence_length": args.max_sentence_length,
+        "max_sentences": args.max_sentences,
+        "do_lower_case": args.do_lower_case,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def encode_sentences(bert, ids, path, batch_size, device, precision):
+    """Writes the pooled output of every sentence to a float16 .npy file at path.
+
+    Sentences are batched by length, so padding stays small.
+    """
+    bert.eval()
+    tmp_path = path + ".tmp.npy"
+    vectors = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float16,
+                                        shape=(len(ids), bert.config.hidden_size))
+    order = sorted(range(len(ids)), key=lambda i: len(ids[i]))
+    for start in tqdm(range(0, len(order), batch_size), desc="Encoding"):
+        batch = order[start:start + batch_size]
+        width = len(ids[batch[-1]])
+        input_ids = torch.zeros(len(batch), width, dtype=torch.long)
+        input_mask = torch.zeros(len(batch), width, dtype=torch.long)
+        for row, index in enumerate(batch):
+            input_ids[row, :len(ids[index])] = torch.tensor(ids[index])
+            input_mask[row, :len(ids[index])] = 1
+        input_ids, input_mask = input_ids.to(device), input_mask.to(device)
+        with torch.no_grad(), precision.autocast():
+            _, pooled_output = bert(input_ids, torch.zeros_like(input_ids), input_mask, output_all_encoded_layers=False)
+        vectors[batch] = pooled_output.float().cpu().numpy()
+    vectors.flush()
+    del vectors
+    os.replace(tmp_path, path)
+
+
+class SentenceVectorDataset(Dataset):
+    """The cached sentence vectors of each article, with its label id."""
+
+    def __init__(self, vectors, offsets, label_ids):
+        self.vectors = vectors
+        self.offsets = offsets
+        self.label_ids = label_ids
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    def __getitem__(self, index):
+        vectors = np.asarray(self.vectors[self.offsets[index]:self.offsets[index + 1]], dtype=np.float32)
+        if len(vectors) == 0:
+            # an article without sentences is a single zero vector
+            vectors = np.zeros((1, self.vectors.shape[1]), dtype=np.float32)
+        return torch.from_numpy(vectors), self.label_ids[index]
+
+
+def collate_articles(batch):
+    """Pads a batch of articles to its longest one: (vectors [B, S, H], mask [B, S], labels [B])."""
+    num_sentences = max(len(vectors) for vectors, _ in batch)
+    hidden_size = batch[0][0].size(1)
+    vectors = torch.zeros(len(batch), num_sentences, hidden_size)
+    mask = torch.zeros(len(batch), num_sentences, dtype=torch.bool)
+    for row, (article, _) in enumerate(batch):
+        vectors[row, :len(article)] = article
+        mask[row, :len(article)] = True
+    return vectors, mask, torch.tensor([label for _, label in batch], dtype=torch.long)
+
+
+class SentenceAggregator(nn.Module):
+    """Classifies an article from its sentence vectors: an optional light transformer
+    over the sentences, then attention pooling and a linear classifier."""
+
+    def __init__(self, hidden_size, num_labels=2, kind="attention", num_layers=1, num_heads=8, max_sentences=64,
+                 dropout=0.1):
+        super(SentenceAggregator, self).__init__()
+        self.kind = kind
+        if kind == "transformer":
+            self.position_embeddings = nn.Embedding(max_sentences, hidden_size)
+            layer = nn.TransformerEncoderLayer(hidden_size, num_heads, dim_feedforward=2 * hidden_size,
+                                               dropout=dropout, batch_first=True)
+            self.encoder = nn.TransformerEncoder(layer, num_layers)
+        elif kind != "attention":
+            raise ValueError("Unknown aggregator %r, expected attention or transformer" % kind)
+        self.attention = nn.Linear(hidden_size, 1)
+        self.dropout = nn.Dropout(dropout)
+        self.classifier = nn.Linear(hidden_size, num_labels)
+
+    def forward(self, vectors, mask):
+        if self.kind == "transformer":
+            positions = torch.arange(vectors.size(1), device=vectors.device)
+            vectors = self.encoder(vectors + self.position_embeddings(positions), src_key_padding_mask=~mask)
+        scores = self.attention(vectors).squeeze(-1).masked_fill(~mask, -10000.0)
+        pooled = (F.softmax(scores, dim=1).unsqueeze(-1) * vectors).sum(dim=1)
+        return self.classifier(self.dropout(pooled))
+
+
+def evaluate(aggregator, dataset, batch_size, device):
+    aggregator.eval()
+    correct = 0
+    for vectors, mask, label_ids in DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=batch_size,
+                                               collate_fn=collate_articles):
+        with torch.no_grad():
+            logits = aggregator(vectors.to(device), mask.to(device))
+        correct += (logits.argmax(dim=1) == label_ids.to(device)).sum().item()
+    return correct / len(dataset)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    ## Required parameters
+    parser.add_argument("--data_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The SemEval data directory, with training/ and validation/ subdirectories of preprocessed articles.")
+    parser.add_argument("--output_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The output directory for the aggregator and the report.")
+
+    ## Other parameters
+    parser.add_argument("--bert_model", default="bert-large-uncased", type=str,
+                        help="The sentence encoder: a pre-trained model name or directory.")
+    parser.add_argument("--model_path", default=None, type=str,
+                        help="A fine-tuned BertForSequenceClassification checkpoint to encode sentences with instead.")
+    parser.add_argument("--corpora",
+                        default=["byarticle"],
+                        nargs="+",
+                        choices=sorted(CORPORA),
+                        help="Corpora to train the aggregator on.")
+    parser.add_argument("--max_articles_per_corpus", default=None, type=int,
+                        help="Only use the first N articles of each corpus.")
+    parser.add_argument("--max_eval_articles", default=None, type=int,
+                        help="Only evaluate on the first N validation articles.")
+    parser.add_argument("--cache_dir", default=None, type=str,
+                        help="Where to cache the sentence vectors, by default <data_dir>/sentence_cache.")
+    parser.add_argument("--max_sentence_length", default=64, type=int,
+                        help="WordPieces per sentence, including [CLS] and [SEP].")
+    parser.add_argument("--max_sentences", default=64, type=int,
+                        help="Sentences per article; later ones are dropped.")
+    parser.add_argument("--do_lower_case",
+                        default=False,
+                        action='store_true',
+                        help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--aggregator", default="attention", choices=["attention", "transformer"])
+    parser.add_argument("--aggregator_layers", default=1, type=int,
+                        help="Transformer layers of the transformer aggregator.")
+    parser.add_argument("--aggregator_heads", default=8, type=int,
+                        help="Attention heads of the transformer aggregator.")
+    parser.add_argument("--encode_batch_size", default=128, type=int)
+    parser.add_argument("--train_batch_size", default=32, type=int)
+    parser.add_argument("--eval_batch_size", default=64, type=int)
+    parser.add_argument("--learning_rate", default=1e-3, type=float)
+    parser.add_argument("--num_train_epochs", default=10, type=int)
+    parser.add_argument("--no_cuda",
+                        default=False,
+                        action='store_true',
+                        help="Whether not to use CUDA when available")
+    parser.add_argument('--seed',
+                        type=int,
+                        default=42,
+                        help="random seed for initialization")
+    add_precision_arguments(parser)
+    add_prefetch_arguments(parser)
+
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    precision = MixedPrecision(device, fp16=args.fp16, bf16=args.bf16, loss_scale=args.loss_scale)
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    cache_dir = args.cache_dir or os.path.join(args.data_dir, "sentence_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    tokenizer = CachedWordPieceTokenizer(BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case))
+    model = None
+    bert = None
+    label_map = dict((label, i) for i, label in enumerate(LABELS))
+
+    # Sentence vectors: BERT only runs over corpora without a cache
+    datasets = {}
+    encoding = {}
+    for name, paths, max_articles in ([(corpus, CORPORA[corpus], args.max_articles_per_corpus) for corpus in args.corpora]
+                                      + [("validation", VALIDATION, args.max_eval_articles)]):
+        examples = load_examples(args.data_dir, paths, name, max_articles)
+        key = sentence_cache_key(args, paths)
+        cache_path = os.path.join(cache_dir, "%s-%s-%d.npy" % (name, key, len(examples)))
+        # the offsets are written last, so with them the vectors are complete
+        offsets_path = cache_path[:-len(".npy")] + ".offsets.npy"
+        seconds = 0.0
+        if os.path.exists(cache_path) and os.path.exists(offsets_path):
+            logger.info("Using cached sentence vectors for %s from %s", name, cache_path)
+            offsets = np.load(offsets_path)
+        else:
+            # only a miss needs the sentences tokenized
+            ids, offsets = sentence_ids(examples, tokenizer, args.max_sentence_length, args.max_sentences)
+            if bert is None:
+                model = BertForSequenceClassification.from_pretrained(args.bert_model, num_labels=len(LABELS),
+                                                                      cache_dir=PYTORCH_PRETRAINED_BERT_CACHE / 'distributed_-1')
+                if args.model_path is not None:
+                    model.load_state_dict(torch.load(args.model_path, map_location="cpu"))
+                bert = model.bert.to(device)
+            start = time.perf_counter()
+            encode_sentences(bert, ids, cache_path, args.encode_batch_size, device, precision)
+            seconds = time.perf_counter() - start
+            logger.info("Encoded %d sentences of %s in %.1fs", len(ids), name, seconds)
+            tmp_path = offsets_path + ".tmp.npy"
+            np.save(tmp_path, offsets)
+            os.replace(tmp_path, offsets_path)
+        vectors = np.load(cache_path, mmap_mode="r")
+        if len(offsets) != len(examples) + 1 or len(vectors) != offsets[-1]:
+            raise ValueError("Cached vectors in %s cover %d sentences of %d articles, expected %d sentences of %d articles"
+                             % (cache_path, len(vectors), len(examples), offsets[-1], len(offsets) - 1))
+        datasets[name] = SentenceVectorDataset(vectors, offsets, [label_map[example.label] for example in examples])
+        encoding[name] = {"articles": len(examples), "sentences": int(offsets[-1]), "encode_seconds": seconds,
+                          "cached": seconds == 0.0}
+    # the classifier holds the encoder too
+    del bert, model
+
+    train_data = torch.utils.data.ConcatDataset([datasets[corpus] for corpus in args.corpora])
+    eval_data = datasets["validation"]
+    hidden_size = eval_data.vectors.shape[1]
+    aggregator = SentenceAggregator(hidden_size, len(LABELS), args.aggregator, args.aggregator_layers,
+                                    args.aggregator_heads, args.max_sentences).to(device)
+    optimizer = torch.optim.Adam(aggregator.parameters(), lr=args.learning_rate)
+    train_dataloader = DevicePrefetcher(DataLoader(train_data, sampler=RandomSampler(train_data),
+                                                   batch_size=args.train_batch_size, collate_fn=collate_articles),
+                                        device, args.prefetch_batches)
+
+    logger.info("***** Training the %s aggregator *****", args.aggregator)
+    logger.info("  Num articles = %d", len(train_data))
+    logger.info("  Aggregator parameters = %d", sum(p.numel() for p in aggregator.parameters()))
+
+    accuracies = []
+    start = time.perf_counter()
+    with open(os.path.join(args.output_dir, "eval_results.txt"), "w") as output_eval_file:
+        for epoch in trange(args.num_train_epochs, desc="Epoch"):
+            aggregator.train()
+            for vectors, mask, label_ids in train_dataloader:
+                logits = aggregator(vectors, mask)
+                loss = F.cross_entropy(logits, label_ids)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            train_dataloader.log_waits()
+
+            accuracy = evaluate(aggregator, eval_data, args.eval_batch_size, device)
+            accuracies.append(accuracy)
+            print("\nEpoch %d: Validation Accuracy=%.4f\n" % (epoch, accuracy))
+            output_eval_file.write("Epoch %d: Validation Accuracy=%.4f\n" % (epoch, accuracy))
+            output_eval_file.flush()
+    train_seconds = time.perf_counter() - start
+
+    torch.save({"args": vars(args), "state_dict": aggregator.state_dict()}, os.path.join(args.output_dir, "aggregator.pt"))
+
+    report = {
+        "device": str(device),
+        "aggregator": args.aggregator,
+        "aggregator_parameters": sum(p.numel() for p in aggregator.parameters()),
+        "encoding": encoding,
+        "train_seconds": train_seconds,
+        "validation_accuracy": accuracies,
+        "best_validation_accuracy": max(accuracies) if accuracies else None,
+    }
+    with open(os.path.join(args.output_dir, "hierarchical_report.json"), "w") as fp:
+        json.dump(report, fp, indent=2)
+    logger.info("Aggregator trained in %.1fs, best validation accuracy %.4f", train_seconds,
+                report["best_validation_accuracy"] or 0.0)
+
+if __name__ == "__main__":
+    main()
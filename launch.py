@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+#
+# launch.py: start one training process per GPU or CPU share on this node
+#
+#   python3 launch.py --nproc_per_node 4 run_classifier.py --no_cuda --do_train ...
+#
+# Every process gets the rendezvous environment (MASTER_ADDR, MASTER_PORT,
+# RANK, WORLD_SIZE, LOCAL_RANK, LOCAL_WORLD_SIZE) and a --local_rank flag, so
+# run_classifier.py and unsupervised_pretraining.py join one process group.
+# Without CUDA (or with --no_cuda) they use the gloo backend and split the
+# node's cores between the local processes. For several nodes run this once
+# per node with the same --nnodes/--master_addr/--master_port and a distinct
+# --node_rank. If any process fails the others are stopped.
+#
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+#
+# CLI
+#
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Launch a data-parallel training script over several processes")
+    parser.add_argument('--nproc_per_node', type=int, default=1, help='processes on this node, e.g. one per GPU or per socket')
+    parser.add_argument('--nnodes', type=int, default=1, help='number of nodes taking part')
+    parser.add_argument('--node_rank', type=int, default=0, help='index of this node, 0 to nnodes - 1')
+    parser.add_argument('--master_addr', default='127.0.0.1', help='address of the node with node_rank 0')
+    parser.add_argument('--master_port', type=int, default=29500, help='free port on the node with node_rank 0')
+    parser.add_argument('script', help='the training script to run')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER, help='arguments passed through to the script')
+    args = parser.parse_args()
+
+    world_size = args.nproc_per_node * args.nnodes
+    threads = max(1, (os.cpu_count() or 1) // args.nproc_per_node)
+
+    processes = []
+    for local_rank in range(args.nproc_per_node):
+        env = dict(os.environ,
+                   MASTER_ADDR=args.master_addr,
+                   MASTER_PORT=str(args.master_port),
+                   WORLD_SIZE=str(world_size),
+                   RANK=str(args.node_rank * args.nproc_per_node + local_rank),
+                   LOCAL_RANK=str(local_rank),
+                   LOCAL_WORLD_SIZE=str(args.nproc_per_node))
+        env.setdefault("OMP_NUM_THREADS", str(threads))
+        command = [sys.executable, "-u", args.script, "--local_rank=%d" % local_rank] + args.script_args
+        processes.append(subprocess.Popen(command, env=env))
+
+    returncode = 0
+    try:
+        while processes:
+            for process in list(processes):
+                code = process.poll()
+                if code is None:
+                    continue
+                processes.remove(process)
+                if code != 0:
+                    returncode = code
+                    print("launch.py: %s exited with %d, stopping the other processes" % (process.args, code), file=sys.stderr)
+                    for other in processes:
+                        other.send_signal(signal.SIGTERM)
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        returncode = 1
+    for process in processes:
+        process.wait()
+    sys.exit(returncode)
@@ -0,0 +1,72 @@
+# coding=utf-8
+"""Autocast mixed precision shared by the training scripts.
+
+The model keeps float32 weights on the device; autocast runs the matmuls in
+float16 (CUDA) or bfloat16 (CUDA or CPU), and a GradScaler keeps the dynamic
+loss scale and the inf/nan checks on the device. This replaces the old
+`model.half()` + CPU master weights scheme, which copied every parameter and
+gradient between host and device on each update.
+"""
+
+import contextlib
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def add_precision_arguments(parser):
+    """Adds the --fp16/--bf16/--loss_scale flags to an argparse parser."""
+    parser.add_argument('--fp16',
+                        default=False,
+                        action='store_true',
+                        help="Whether to train with float16 autocast and dynamic loss scaling (CUDA only)")
+    parser.add_argument('--bf16',
+                        default=False,
+                        action='store_true',
+                        help="Whether to train with bfloat16 autocast (CUDA or CPU, no loss scaling needed)")
+    parser.add_argument('--loss_scale',
+                        type=float, default=128,
+                        help='Initial loss scale for --fp16, adjusted dynamically during training.')
+
+
+class MixedPrecision(object):
+    """Wraps autocast and loss scaling so the training loops stay precision agnostic."""
+
+    def __init__(self, device, fp16=False, bf16=False, loss_scale=128):
+        if fp16 and bf16:
+            raise ValueError("Only one of `fp16` or `bf16` can be set.")
+        if fp16 and device.type != 'cuda':
+            logger.info("float16 autocast needs CUDA, using bfloat16 on %s instead", device.type)
+            fp16, bf16 = False, True
+
+        self.device_type = device.type
+        self.dtype = torch.float16 if fp16 else torch.bfloat16 if bf16 else None
+        # bfloat16 has the exponent range of float32, so only float16 needs its loss scaled
+        if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+            self.scaler = torch.amp.GradScaler('cuda', init_scale=loss_scale, enabled=fp16)
+        else:
+            self.scaler = torch.cuda.amp.GradScaler(init_scale=loss_scale, enabled=fp16)
+
+    @property
+    def enabled(self):
+        return self.dtype is not None
+
+    @property
+    def scaling(self):
+        return self.scaler.is_enabled()
+
+    def autocast(self):
+        """Context manager for the forward pass (and the loss computation)."""
+        if not self.enabled:
+            return contextlib.suppress()
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype)
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer):
+        """Unscales the gradients, skips the update if any are inf/nan and adjusts the scale."""
+        self.scaler.step(optimizer)
+        self.scaler.update()
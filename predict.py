@@ -3,30 +3,38 @@
 import argparse
 import numpy as np
 import os
+import pickle
 import preprocess
 import run_classifier
+from corpus_io import open_corpus
 
-def do_preprocess(fp_ins, fp_out): 
+def do_preprocess(fp_ins, fp_out, fast=False, output_format="xml"): 
     ## Set these depending on which attributes you want to keep -- no need to generate things you're not using!
     features = ["spacy"] # links, tags, titles are the other options
-    return preprocess.process_articles(fp_ins, fp_out, features)
+    ## fast=True swaps spacy for the regex tokenizer, which is all BERT needs
+    ## output_format="jsonl" writes one JSON object per article instead of XML
+    preprocess.process_articles(fp_ins, fp_out, features, fast=fast, output_format=output_format)
+    ## a compressed output is only complete once closed, so read it back through a fresh handle
+    fp_out.close()
+    return open_corpus(fp_out.name, "rb")
 
 def do_predict(args): 
 
     # Preprocessing! (This takes a while...)
     input_dir_files = os.listdir(args.inputDataset)
-    input_file_handles = [open(os.path.join(args.inputDataset, x), "rb") for x in input_dir_files]
+    input_file_handles = [open_corpus(os.path.join(args.inputDataset, x), "rb") for x in input_dir_files]
     temp_dir = args.inputDataset.rstrip("/") + "_preprocessed"
     if not(os.path.exists(temp_dir)): 
         os.mkdir(temp_dir)
     temp_fname = os.path.join(temp_dir, "articles.xml")
     temp_fp = open(temp_fname, "wb")
-    temp_fp = do_preprocess(input_file_handles, temp_fp)
+    temp_fp = do_preprocess(input_file_handles, temp_fp, fast=args.fast)
 
     ## Read in all the important model things
-    feature_maker = pickle.load(args.model)
-    label_maker = pickle.load(args.model)
-    clf=pickle.load(args.model)
+    with open(args.modelPath, "rb") as model_file:
+        feature_maker = pickle.load(model_file)
+        label_maker = pickle.load(model_file)
+        clf=pickle.load(model_file)
 
     ## Get features for articles to predict on
     X_test, ids_test = feature_maker.process(temp_fp, max_instances=None)
@@ -47,6 +55,7 @@ if __name__ == '__main__':
     parser.add_argument("modelPath", help="Saved model")
     parser.add_argument("inputDataset", help="Directory with the xml file(s) to test")
     parser.add_argument("outputDir", help="Directory to put the predictions.txt file in")
+    parser.add_argument("--fast", action="store_true", help="Preprocess with the regex tokenizer instead of spacy")
 
     args = parser.parse_args()
     do_predict(args)
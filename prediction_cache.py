@@ -0,0 +1,169 @@
+# coding=utf-8
+"""A persistent cache of article predictions, keyed by model and content.
+
+The daily `--task_name semevalofficial --predict` runs see many articles that
+were already scored: syndicated reposts, re-crawls and so on. With
+`--prediction_cache PATH` every article is looked up in an SQLite file first,
+keyed by a hash of the model (checkpoint contents, base model and input
+settings) and a hash of its normalised text. Hits skip tokenization and the
+forward pass; only the misses are featurized and predicted, and their labels
+are added to the cache afterwards. The file is bounded to
+`--prediction_cache_size` entries by evicting the least recently used ones,
+and the hit/miss counts of each run go to `prediction_cache.json` in the
+output directory.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def add_prediction_cache_arguments(parser):
+    """Adds the --prediction_cache/--prediction_cache_size flags to an argparse parser."""
+    parser.add_argument('--prediction_cache',
+                        default=None,
+                        type=str,
+                        help="SQLite file caching --predict labels by model and article text, shared between runs.")
+    parser.add_argument('--prediction_cache_size',
+                        type=int,
+                        default=1000000,
+                        help="Maximum number of cached predictions; the least recently used are evicted.")
+
+
+def normalise_text(text, do_lower_case=False):
+    """Whitespace does not change what the model sees, nor does case for an uncased model."""
+    if do_lower_case:
+        text = text.lower()
+    return " ".join(text.split())
+
+
+def text_key(text, do_lower_case=False):
+    return hashlib.sha1(normalise_text(text, do_lower_case).encode("utf-8")).hexdigest()
+
+
+class PredictionCache(object):
+    """Predicted labels in an SQLite file, with least-recently-used eviction.
+
+    Entries of every model share the file and the size bound. Counts of this
+    run's lookups are kept in `hits` and `misses`.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # several ranks may read the file while rank 0 writes it
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS predictions (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                label TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            );
+            CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used);
+            CREATE TABLE IF NOT EXISTS checkpoint_hashes (
+                signature TEXT PRIMARY KEY,
+                digest TEXT NOT NULL
+            );
+        """)
+
+    def file_digest(self, path):
+        """sha1 of a (possibly multi-GB) checkpoint, remembered by path, size and mtime."""
+        stat = os.stat(path)
+        signature = json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+        row = self.connection.execute("SELECT digest FROM checkpoint_hashes WHERE signature = ?",
+                                      (signature,)).fetchone()
+        if row is not None:
+            return row[0]
+        digest = hashlib.sha1()
+        with open(path, "rb") as fp:
+            for block in iter(lambda: fp.read(1 << 20), b""):
+                digest.update(block)
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO checkpoint_hashes VALUES (?, ?)",
+                                    (signature, digest.hexdigest()))
+        return digest.hexdigest()
+
+    def model_key(self, args, weights_name="pytorch_model.bin"):
+        """Identifies the predictions of one checkpoint under one set of input settings."""
+        if args.model_path is not None:
+            checkpoint = self.file_digest(args.model_path)
+        elif os.path.isfile(os.path.join(args.bert_model, weights_name)):
+            checkpoint = self.file_digest(os.path.join(args.bert_model, weights_name))
+        else:
+            checkpoint = None
+        key = {
+            "bert_model": args.bert_model,
+            "checkpoint": checkpoint,
+            "max_seq_length": args.max_seq_length,
+            "do_lower_case": args.do_lower_case,
+            "permute_ngrams": args.permute_ngrams,
+            "early_exit_threshold": getattr(args, "early_exit_threshold", None),
+        }
+        # sentence selection changes the WordPieces BERT sees
+        if getattr(args, "select_sentences", False):
+            key["sentence_scorer"] = args.sentence_scorer
+            if args.sentence_scorer == "prefilter":
+                key["prefilter"] = self.file_digest(args.prefilter_path)
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    def lookup(self, model, text_hashes):
+        """Returns {text_hash: label} for the cached ones among text_hashes."""
+        found = {}
+        text_hashes = list(dict.fromkeys(text_hashes))
+        # stay under SQLite's limit on the number of bound parameters
+        for start in range(0, len(text_hashes), 500):
+            chunk = text_hashes[start:start + 500]
+            rows = self.connection.execute(
+                "SELECT text_hash, label FROM predictions WHERE model = ? AND text_hash IN (%s)"
+                % ",".join("?" * len(chunk)), [model] + chunk)
+            found.update(rows)
+        self.hits += len(found)
+        self.misses += len(text_hashes) - len(found)
+        return found
+
+    def update(self, model, labels, used=()):
+        """Stores {text_hash: label}, marks the text_hashes in used as just used and evicts down to size."""
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+                                        [(model, text_hash, label, now) for text_hash, label in labels.items()])
+            self.connection.executemany("UPDATE predictions SET last_used = ? WHERE model = ? AND text_hash = ?",
+                                        [(now, model, text_hash) for text_hash in used])
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                self.connection.execute("DELETE FROM predictions WHERE rowid IN "
+                                        "(SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)", (excess,))
+                self.evicted += excess
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    def write_stats(self, path, model):
+        stats = {
+            "model": model,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / (self.hits + self.misses) if self.hits + self.misses else None,
+            "evicted": self.evicted,
+            "entries": len(self),
+            "max_entries": self.max_entries,
+        }
+        with open(path, "w") as fp:
+            json.dump(stats, fp, indent=2)
+        logger.info("Prediction cache: %d hits, %d misses, %d entries", self.hits, self.misses, stats["entries"])
+        return stats
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,133 @@
+# coding=utf-8
+"""Asynchronous host-to-device batch prefetching for the training loops.
+
+A DataLoader hands out batches in host memory, and a blocking `t.to(device)`
+at the top of every step leaves the GPU idle while they are copied.
+DevicePrefetcher wraps a DataLoader and keeps the next `depth` batches in
+flight: each is pinned (unless the DataLoader already pinned it) and copied
+with non_blocking=True on a side CUDA stream, so the copies overlap the
+compute of the current step. The compute stream only waits for the copy of the
+batch it is about to use.
+
+On CPU there is nothing to overlap: batches are passed through as they are.
+Two waits are kept per step. `waits` is host time: fetching the batch from the
+DataLoader, pinning it and queueing its copy (or, without prefetching,
+copying it). `transfer_waits` is how long the step was held up by its copy:
+on CUDA, the time the compute stream stalled on the copy's event, measured
+with timing events; otherwise the time of the blocking copy. StepMetrics
+reports the latter as the h2d phase.
+"""
+
+import logging
+import time
+from collections import deque
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def add_prefetch_arguments(parser):
+    """Adds the --prefetch_batches flag to an argparse parser."""
+    parser.add_argument('--prefetch_batches',
+                        type=int,
+                        default=2,
+                        help="Number of batches copied to the device ahead of the current step; 0 copies each batch "
+                             "when it is needed.")
+
+
+def map_tensors(fn, batch):
+    """Applies fn to every tensor of a (nested) tuple, list or dict batch."""
+    if torch.is_tensor(batch):
+        return fn(batch)
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(map_tensors(fn, item) for item in batch)
+    if isinstance(batch, dict):
+        return dict((key, map_tensors(fn, value)) for key, value in batch.items())
+    return batch
+
+
+class DevicePrefetcher(object):
+    """Iterates over a DataLoader with the batches already on `device`."""
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+        self.asynchronous = device.type == 'cuda' and depth > 0
+        self.waits = []
+        # seconds, or (before, after) timing events on the compute stream when prefetching
+        self.transfer_waits = []
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.waits = []
+        self.transfer_waits = []
+        iterator = iter(self.loader)
+        if not self.asynchronous:
+            while True:
+                start = time.perf_counter()
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+                copy_start = time.perf_counter()
+                batch = map_tensors(lambda t: t.to(self.device), batch)
+                self.waits.append(copy_start - start)
+                self.transfer_waits.append(time.perf_counter() - copy_start)
+                yield batch
+
+        stream = torch.cuda.Stream(self.device)
+        in_flight = deque()
+
+        def copy_next():
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            batch = map_tensors(lambda t: t if t.is_pinned() else t.pin_memory(), batch)
+            with torch.cuda.stream(stream):
+                batch = map_tensors(lambda t: t.to(self.device, non_blocking=True), batch)
+                copied = torch.cuda.Event()
+                copied.record(stream)
+            in_flight.append((batch, copied))
+
+        start = time.perf_counter()
+        for _ in range(self.depth):
+            copy_next()
+        while in_flight:
+            batch, copied = in_flight.popleft()
+            compute_stream = torch.cuda.current_stream(self.device)
+            # the stall of the compute stream on the copy is the time between these two events
+            before, after = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            before.record(compute_stream)
+            compute_stream.wait_event(copied)
+            after.record(compute_stream)
+            self.transfer_waits.append((before, after))
+            # the copies were allocated on the side stream but are freed after use on this one
+            map_tensors(lambda t: t.record_stream(compute_stream), batch)
+            copy_next()
+            self.waits.append(time.perf_counter() - start)
+            yield batch
+            start = time.perf_counter()
+
+    def transfer_wait(self, step=-1):
+        """Seconds a step of the last pass was held up by its copy; waits for the copy to finish."""
+        wait = self.transfer_waits[step]
+        if isinstance(wait, tuple):
+            before, after = wait
+            after.synchronize()
+            return before.elapsed_time(after) / 1000.0
+        return wait
+
+    def log_waits(self, description="Training"):
+        """Logs how long the steps of the last pass waited for their batches, on the host and for the copies."""
+        if self.waits:
+            steps = len(self.waits)
+            transfer = sum(self.transfer_wait(step) for step in range(len(self.transfer_waits)))
+            logger.info("%s waited %.2fs on the host for data (%.1f ms per step) and %.2fs for copies to the device "
+                        "(%.1f ms per step, %s) over %d steps", description, sum(self.waits),
+                        1000.0 * sum(self.waits) / steps, transfer, 1000.0 * transfer / steps,
+                        "prefetched on a side stream" if self.asynchronous else "copied synchronously", steps)
@@ -1,31 +1,43 @@
 import argparse
 import html
+import json
 import os
 import re
 import sys
 from collections import Counter
-from itertools import islice
 
-import spacy
 from lxml import etree
 from tqdm import tqdm
 
-nlp=spacy.load('en', disable=['parser','ner','tagger'])
+from corpus_io import compression_suffix, is_jsonl, open_corpus
+from xml_stream import iter_elements, print_progress
+
 rgx = re.compile(r'\S')
+nested_amp_rgx = re.compile(r'&(?:amp;)+')
 
-def do_xml_parse(fps, tag, max_elements=None, progress_message=None):
-    """ Parses cleaned up spacy-processed XML files """
+# spacy pipelines loaded so far, keyed by whether they can parse and tag
+nlp_pipelines = {}
 
-    for fp in fps: 
-        fp.seek(0)
+def get_nlp(features=()):
+    """
+    Return a spacy pipeline with just the components the given features need,
+    loading it (and spacy itself) on first use. tags and titles go through
+    process(), which needs the tagger and the parser for sentence starts;
+    everything else only needs the tokenizer.
+    """
+    full = 'tags' in features or 'titles' in features
+    if full not in nlp_pipelines:
+        import spacy
+        disable = ['ner'] if full else ['parser', 'ner', 'tagger']
+        nlp_pipelines[full] = spacy.load('en', disable=disable)
+    return nlp_pipelines[full]
 
-        elements = enumerate(islice(etree.iterparse(fp, tag=tag), max_elements))
-        for i, (event, elem) in elements:
-            yield elem
-            elem.clear()
-            if progress_message and (i % 10 == 0): 
-                print(progress_message.format(i), file=sys.stderr, end='\r')
-        if progress_message: print(file=sys.stderr)
+def do_xml_parse(fps, tag, max_elements=None, progress_message=None, offset=0):
+    """ Parses cleaned up spacy-processed XML files, in constant memory """
+    progress = print_progress(progress_message) if progress_message else None
+    for elem in iter_elements(fps, tag, max_elements, offset, progress, progress_every=10):
+        yield elem
+    if progress_message: print(file=sys.stderr)
 
 
 class Article(object):
@@ -67,16 +79,26 @@ class Article(object):
 
 
 def repeated_unescape(line):
-    new = line
-    old = ''
-    while old != new:
+    """
+    html-unescape a string until it stops changing. Strings without an '&'
+    are returned untouched, and runs of escaped ampersands (&amp;amp;lt;) are
+    collapsed up front so nested entities decode in a single pass.
+    """
+    if '&' not in line:
+        return line
+    new = html.unescape(nested_amp_rgx.sub('&', line))
+    while '&' in new:
         old = new
         new = html.unescape(old)
+        if new == old:
+            break
     return new
 
 
-def process(article_tree, text, lower=False):
+def process(article_tree, text, lower=False, nlp=None):
     """ spacy tokenize, lemmatize and POS tag some text """
+    if nlp is None:
+        nlp = get_nlp(['tags'])
     if lower:
         doc = nlp(text.lower())
     else:
@@ -111,20 +133,24 @@ def process(article_tree, text, lower=False):
     return spacy_tree, tag_tree, lemma_tree, doc
 
 
-def spacy_tokenize(article_tree, article):
+def spacy_tokenize(article_tree, article, nlp=None):
     """
     spacy tokenize an article
     """
+    if nlp is None:
+        nlp = get_nlp()
     text = repeated_unescape(article.get_text())
     doc = nlp(text)
     spacy_tree = etree.SubElement(article_tree, 'spacy')
     spacy_tree.text = ' '.join([x.text for x in doc])
     return article_tree
 
-def save_links(article_tree, article):
+def save_links(article_tree, article, nlp=None):
     """
     extract the links in an article
     """
+    if nlp is None:
+        nlp = get_nlp()
     anchors = article.get_anchors() 
     for a in anchors:
         # if there is no text in the link it didn't show up(?)
@@ -138,10 +164,152 @@ def save_links(article_tree, article):
     return article_tree
 
 
-def process_articles(fp_ins, fp_out, features, start=None, end=None):
-    fp_out.write(b'<articles>\n')
-    
-    for a in do_xml_parse(fp_ins, 'article'): 
+#
+# Fast (spaCy-free) engine
+#
+# An approximation of the spaCy English tokenizer built from compiled regular
+# expressions. BERT re-tokenizes everything into WordPieces anyway, so all it
+# needs from preprocessing is whitespace/punctuation splitting and -EOS-
+# markers, which these regexes provide without loading a model.
+#
+
+fast_token_rgx = re.compile(r"""
+      https?://\S+                                  # urls stay whole
+    | (?:[A-Za-z]\.){2,}                            # initialisms: U.S.
+    | (?:Mr|Mrs|Ms|Dr|Prof|Sen|Rep|Gov|Gen|Lt|Col|St|Jr|Sr|Inc|Corp|Co|Ltd|vs)\.(?=\s)
+    | \d+(?:[.,:]\d+)*                              # numbers: 1,000.5 and 10:30
+    | \w+(?=n[’']t\b)                               # do|n't
+    | n[’']t\b
+    | [’'](?:s|re|ve|ll|d|m)\b                      # clitics: 's 're 've 'll 'd 'm
+    | \w+
+    | \.\.\.|--
+    | \S                                            # any other single symbol
+    """, re.VERBOSE | re.IGNORECASE)
+
+fast_sentence_rgx = re.compile(r"""
+    [.!?]+["'”’)\]]*                                # terminal punctuation and closers
+    (?=\s+["'“‘(\[]?[A-Z0-9])                       # followed by what starts a sentence
+    """, re.VERBOSE)
+
+fast_abbreviation_rgx = re.compile(r'(?:\b(?:[A-Za-z]\.){2,}|\b(?:Mr|Mrs|Ms|Dr|Prof|Sen|Rep|Gov|Gen|Lt|Col|St|Jr|Sr|vs)\.)$')
+
+
+def fast_sentences(text):
+    """ split text into sentences with a compiled regex instead of a parser """
+    sentences = []
+    start = 0
+    for match in fast_sentence_rgx.finditer(text):
+        # a short window is enough to see whether the period ends an abbreviation
+        if fast_abbreviation_rgx.search(text[max(start, match.start() - 12):match.end()]):
+            continue
+        sentences.append(text[start:match.end()])
+        start = match.end()
+    sentences.append(text[start:])
+    return sentences
+
+
+def fast_tokenize(text, eos=True):
+    """
+    regex tokenize some text, marking sentence starts and the end of the text
+    with -EOS- the same way process() does
+    """
+    if not eos:
+        return fast_token_rgx.findall(text)
+    output = []
+    for sentence in fast_sentences(text):
+        tokens = fast_token_rgx.findall(sentence)
+        if tokens:
+            output.append('-EOS-')
+            output.extend(tokens)
+    output.append('-EOS-')
+    return output
+
+
+def fast_spacy_tokenize(article_tree, article):
+    """
+    tokenize an article into the spacy field without spacy
+    """
+    text = repeated_unescape(article.get_text())
+    spacy_tree = etree.SubElement(article_tree, 'spacy')
+    spacy_tree.text = ' '.join(fast_tokenize(text))
+    return article_tree
+
+
+def fast_save_links(article_tree, article):
+    """
+    extract the links in an article, tokenizing their text without spacy
+    """
+    for a in article.get_anchors():
+        if a.text is None: continue
+        text = ' '.join(fast_tokenize(repeated_unescape(a.text), eos=False))
+        a.text = text
+        anchor_tree = etree.SubElement(article_tree, 'a')
+        anchor_tree.text = text
+        for (k,v) in a.items(): anchor_tree.set(k,v)
+    return article_tree
+
+
+def tokenization_agreement(reference, candidate):
+    """
+    fraction of reference tokens (ignoring -EOS- markers) that the candidate
+    tokenization reproduces, aligned with difflib
+    """
+    from difflib import SequenceMatcher
+    reference = [x for x in reference if x != '-EOS-']
+    candidate = [x for x in candidate if x != '-EOS-']
+    if not reference:
+        return 1.0 if not candidate else 0.0
+    matcher = SequenceMatcher(None, reference, candidate, autojunk=False)
+    matched = sum(block.size for block in matcher.get_matching_blocks())
+    return matched / len(reference)
+
+
+#
+# JSONL output
+#
+# One JSON object per line instead of pretty-printed XML, so readers get the
+# tokens without parsing XML. The token fields hold the space-separated
+# contents of the <spacy>, <tag> and <lemma> elements as single strings:
+# decoding one string per field is about 4x faster than a list of tokens,
+# and every reader joins them again anyway.
+#
+
+def article_record(article_tree, features):
+    """
+    the fields of a processed article as a dict: id, attributes, tokens,
+    tags and lemmas, links and title, as far as features produced them
+    """
+    def token_fields(tree):
+        fields = {}
+        for field, tag in [('tokens', 'spacy'), ('tags', 'tag'), ('lemmas', 'lemma')]:
+            elem = tree.find(tag)
+            if elem is not None:
+                fields[field] = ' '.join((elem.text or '').split())
+        return fields
+
+    record = {'id': article_tree.get('id'), 'attributes': dict(article_tree.items())}
+    record.update(token_fields(article_tree))
+    if 'links' in features:
+        record['links'] = [dict(a.items(), text=a.text) for a in article_tree.findall('a')]
+    if 'titles' in features:
+        record['title'] = token_fields(article_tree.find('title'))
+    return record
+
+
+def process_articles(fp_ins, fp_out, features, start=None, end=None, fast=False, output_format='xml'):
+    if fast and ('tags' in features or 'titles' in features):
+        raise ValueError("The fast engine has no tagger; it only supports the spacy and links features")
+    if output_format not in ('xml', 'jsonl'):
+        raise ValueError("Unknown output format %r, expected xml or jsonl" % output_format)
+    nlp = None if fast else get_nlp(features)
+
+    if output_format == 'xml':
+        fp_out.write(b'<articles>\n')
+
+    # start/end select a window of articles, e.g. for --range
+    offset = start or 0
+    max_elements = None if end is None else end - offset
+    for a in do_xml_parse(fp_ins, 'article', max_elements, offset=offset): 
         article = Article(a)
 
         article_tree = etree.Element('article')
@@ -151,20 +319,30 @@ def process_articles(fp_ins, fp_out, features, start=None, end=None):
             article_tree.set(k,v)
         if 'tags' in features:
             article_text = repeated_unescape(article.get_text())
-            spacy_tree, tag_tree, lemma_tree, doc = process(article_tree, article_text)
+            spacy_tree, tag_tree, lemma_tree, doc = process(article_tree, article_text, nlp=nlp)
         if 'spacy' in features and 'tags' not in features:
-            article_tree = spacy_tokenize(article_tree, article)
+            if fast:
+                article_tree = fast_spacy_tokenize(article_tree, article)
+            else:
+                article_tree = spacy_tokenize(article_tree, article, nlp=nlp)
         if 'links' in features:
-            article_tree = save_links(article_tree, article)
+            if fast:
+                article_tree = fast_save_links(article_tree, article)
+            else:
+                article_tree = save_links(article_tree, article, nlp=nlp)
         if 'titles' in features:
             title_text = article.get_title()
             title_tree = etree.SubElement(article_tree, 'title')
-            spacyT_tree, tagT_tree, lemmaT_tree, Tdoc = process(title_tree, title_text, lower=True)
+            spacyT_tree, tagT_tree, lemmaT_tree, Tdoc = process(title_tree, title_text, lower=True, nlp=nlp)
 
-        fp_out.write(etree.tostring(article_tree, pretty_print=True))
-    
-    fp_out.write(b'</articles>\n')
-    return open(fp_out.name, "rb")
+        if output_format == 'jsonl':
+            fp_out.write(json.dumps(article_record(article_tree, features)).encode('utf-8') + b'\n')
+        else:
+            fp_out.write(etree.tostring(article_tree, pretty_print=True))
+
+    if output_format == 'xml':
+        fp_out.write(b'</articles>\n')
+    fp_out.flush()
 
 if __name__=='__main__':
 
@@ -172,17 +350,16 @@ if __name__=='__main__':
     
     parser = argparse.ArgumentParser(description="Convert Semeval XML files to more usable XML files")
     parser.add_argument("infile", help="an XML file with articles")
-    parser.add_argument("outfile", help="an XML file with articles")
+    parser.add_argument("outfile", help="an XML (or, with --format jsonl, JSONL) file with articles")
     parser.add_argument("--spacy", action="store_true")
     parser.add_argument("--links", action="store_true")
     parser.add_argument("--tags", action="store_true")
     parser.add_argument("--titles", action="store_true")
     parser.add_argument("--range", nargs=2, default=(None, None), help="article range for distributed processing")
+    parser.add_argument("--fast", action="store_true", help="tokenize with compiled regexes instead of spacy (spacy and links only)")
+    parser.add_argument("--format", choices=["xml", "jsonl"], default=None,
+                        help="output format; defaults to jsonl if outfile ends in .jsonl, otherwise xml")
     args = parser.parse_args()
-    
-    if args.tags:
-        # Change nlp to do tagging, too...
-        nlp=spacy.load('en')
 
     features = []
     for arg, feature in [(args.links, "links"), (args.spacy, "spacy"), (args.tags, "tags"), 
@@ -191,14 +368,19 @@ if __name__=='__main__':
             features.append(feature)
 
     assert len(features) > 0
+    output_format = args.format or ('jsonl' if is_jsonl(args.outfile) else 'xml')
 
-    fp_in = open(args.infile, 'rb')
+    # either file may be gzip/xz/zstd-compressed, e.g. training.xml.xz
+    fp_in = open_corpus(args.infile, 'rb')
     if args.range == (None, None):
         (start, stop) = (None, None)
         outfile = args.outfile
     else:
         (start, stop) = [int(x) for x in args.range]
-        outfile = "%s.%d_%d.xml" % (args.outfile[:-4], start, stop)
-    fp_out = open(outfile, 'wb')
-    read_articles(fp_in, fp_out, features, start, stop)
+        suffix = compression_suffix(args.outfile)
+        base, ext = os.path.splitext(args.outfile[:len(args.outfile) - len(suffix)])
+        outfile = "%s.%d_%d%s%s" % (base, start, stop, ext, suffix)
+    fp_out = open_corpus(outfile, 'wb')
+    process_articles([fp_in], fp_out, features, start, stop, fast=args.fast, output_format=output_format)
+    fp_in.close()
     fp_out.close()
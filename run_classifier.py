@@ -19,30 +19,42 @@ from __future__ import division
 from __future__ import print_function
 
 import csv
+import json
 import os
 import logging
 import argparse
 import random
 import math
 import multiprocessing
-from itertools import count, repeat, islice
-from functools import reduce
-from lxml import etree
+import time
+from itertools import count, repeat
 from tqdm import tqdm, trange
 from html import unescape
 
-import preprocess
-import predict
 import numpy as np
 import torch
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import Dataset, TensorDataset, DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 
 from pytorch_pretrained_bert.tokenization import BertTokenizer
 from pytorch_pretrained_bert.modeling import BertForSequenceClassification
 from pytorch_pretrained_bert.optimization import BertAdam
 from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
-from bertaverager import BertForSplicedSequenceClassification
+from batch_tokenizer import CachedWordPieceTokenizer
+from cascade import (PREFILTER_NAME, add_cascade_arguments, band_report, bert_probabilities, load_prefilter,
+                     prefilter_probabilities, save_prefilter, train_prefilter, uncertain)
+from corpus_io import compression_suffix, find_corpus, is_jsonl, iter_records, open_corpus
+from bertaverager import BertForEarlyExitClassification, BertForSplicedSequenceClassification, enable_gradient_checkpointing
+from distributed_utils import (ShardedSampler, add_distributed_arguments, all_reduce_sum, barrier, get_rank,
+                               get_world_size, gradient_sync, is_main_process, setup_distributed, unwrap_model,
+                               wrap_model)
+from encoder_cache import FrozenEncoderHead, add_frozen_encoder_arguments, build_encoder_cache, encoder_cache_key
+from flat_optimizer import FlatBertAdam
+from mixed_precision import MixedPrecision, add_precision_arguments
+from prediction_cache import PredictionCache, add_prediction_cache_arguments, text_key
+from sentence_selection import SentenceSelector, add_sentence_selection_arguments
+from prefetch import DevicePrefetcher, add_prefetch_arguments
+from telemetry import StepMetrics, add_telemetry_arguments
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s', 
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -74,12 +86,15 @@ class InputExample(object):
 class InputFeatures(object):
     """A single set of features of data."""
 
-    def __init__(self, input_ids, input_mask, segment_ids, label_id, article_id=None):
+    def __init__(self, input_ids, input_mask, segment_ids, label_id, article_id=None, token_ids_a=None, token_ids_b=None):
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.segment_ids = segment_ids
         self.label_id = label_id
         self.article_id = article_id
+        # the untruncated WordPiece ids, kept for NgramPermutationDataset
+        self.token_ids_a = token_ids_a
+        self.token_ids_b = token_ids_b
 
 
 class DataProcessor(object):
@@ -206,6 +221,7 @@ class SemevalOfficialProcessor(DataProcessor):
     def __init__(self):
         super().__init__()
         self.examples = None
+        self.fast_preprocess = False
 
     """Processor for providing model with examples for inference during official competition"""
     def get_train_examples(self, data_dir):
@@ -213,42 +229,39 @@ class SemevalOfficialProcessor(DataProcessor):
 
     def get_dev_examples(self, data_dir):
         for f in os.listdir(data_dir):
-            if f.endswith(".xml"):
-                return self._create_examples(open(data_dir + "/" + f, "rb"), data_dir, "inference")
+            # articles already preprocessed to JSONL (preprocess.py --format jsonl) are read as they are
+            if is_jsonl(f):
+                return self._examples_from_records(iter_records(data_dir + "/" + f), "inference")
+            if f[:len(f) - len(compression_suffix(f))].endswith(".xml"):
+                return self._create_examples(open_corpus(data_dir + "/" + f, "rb"), data_dir, "inference")
 
     def get_labels(self):
         return ["false", "true"]
 
     def _create_examples(self, data_file, data_dir, set_type):
-        examples = []
-
         temp_dir = data_dir.rstrip("/") + "_preprocessed"
         if not(os.path.exists(temp_dir)): 
             os.mkdir(temp_dir)
-        temp_fname = os.path.join(temp_dir, "articles.xml")
+        temp_fname = os.path.join(temp_dir, "articles.jsonl")
         temp_fp = open(temp_fname, "wb")
-        temp_fp = predict.do_preprocess([data_file], temp_fp)
+        # only inference on raw XML needs the preprocessing pipeline, so keep it off the import path
+        import predict
+        # the JSONL intermediate is read back without another XML parse
+        records_fp = predict.do_preprocess([data_file], temp_fp, fast=self.fast_preprocess, output_format="jsonl")
+        examples = self._examples_from_records(iter_records(records_fp), set_type)
+        records_fp.close()
+        return examples
 
-        for index, article in enumerate(self._do_xml_parse(temp_fp, 'article')):
-            article_id = article.get('id')
-            article_guid = "%s-%s" % (set_type, article_id)
-            article_text = " ".join(self._extract_text(article).split())
+    def _examples_from_records(self, records, set_type):
+        examples = []
+        for record in records:
+            article_guid = "%s-%s" % (set_type, record["id"])
+            article_text = " ".join(self._extract_text(record).split())
             examples.append(InputExample(guid=article_guid, text_a=article_text, text_b=None, label=None))
         return examples
 
-    def _do_xml_parse(self, fp, tag, max_elements=None, progress_message=None):
-        print(type)
-        fp.seek(0)
-        elements = enumerate(islice(etree.iterparse(fp, tag=tag), max_elements))
-        for i, (event, elem) in elements:
-            yield elem   # Returns the current element.
-            elem.clear() # Empties out the list contained in elem to save memory.
-            if progress_message and (i % 1000 == 0):
-                print(progress_message.format(i), file=sys.stderr, end='\r')
-        if progress_message: print(file=sys.stderr)
-
-    def _extract_text(self, article):
-        return unescape("".join([x for x in article.find("spacy").itertext()]).lower())
+    def _extract_text(self, record):
+        return unescape(record["tokens"].lower())
 
 class SemevalProcessor(DataProcessor):
     def __init__(self):
@@ -275,8 +288,8 @@ class SemevalProcessor(DataProcessor):
 
     def _create_examples(self, data_dir):
         train_directory = os.path.join(data_dir, "training/preprocessed")
-        data_file = open(os.path.join(train_directory, "articles-training-byarticle-20181122.prep.txt"), "r")
-        label_file = open(os.path.join(train_directory, "ground-truth-training-byarticle-20181122.txt"), "r")
+        data_file = open_corpus(find_corpus(os.path.join(train_directory, "articles-training-byarticle-20181122.prep.txt")), "r")
+        label_file = open_corpus(find_corpus(os.path.join(train_directory, "ground-truth-training-byarticle-20181122.txt")), "r")
 
         examples = []
         for i, (text_line, label) in enumerate(zip(data_file, label_file)):
@@ -313,8 +326,8 @@ class SemevalProcessor2(DataProcessor):
         return ["false", "true"]
 
     def _create_examples(self, data_file, label_file, set_type):
-        data_file = open(data_file, "r")
-        label_file = open(label_file, "r")
+        data_file = open_corpus(find_corpus(data_file), "r")
+        label_file = open_corpus(find_corpus(label_file), "r")
 
         examples = []
         p = multiprocessing.Pool(multiprocessing.cpu_count())
@@ -334,42 +347,29 @@ def create_example_semeval2(inputs):
     label = label.strip()
     return InputExample(guid=guid, text_a=text_a, text_b=None, label=label)
 
-def permutation(tokens, permute_ngrams):
-    if permute_ngrams is None:
-        return tokens
-
-    ngrams = []
-    i = 0
-    num_tokens = len(tokens)
-
-    while i < num_tokens:
-        ngrams.append(tokens[i:i+permute_ngrams])
-        i += permute_ngrams
-
-    random.shuffle(ngrams)
-    return reduce(lambda a,b: a + b, ngrams, [])
-
+def permutation_index(num_tokens, permute_ngrams, rng=np.random):
+    """Positions that reorder num_tokens tokens as shuffled n-grams, in linear time."""
+    num_ngrams = -(-num_tokens // permute_ngrams)
+    starts = rng.permutation(num_ngrams) * permute_ngrams
+    index = (starts[:, None] + np.arange(permute_ngrams)).ravel()
+    # only the last n-gram can be short; drop the positions past its end
+    return index[index < num_tokens]
 
-def construct_features(inputs):
-    ex_index, example, max_seq_length, tokenizer, label_map, predict, permute_ngrams = inputs
-    
-    tokens_a = tokenizer.tokenize(example.text_a)
-    tokens_a = permutation(tokens_a, permute_ngrams)
 
-    tokens_b = None
-    if example.text_b:
-        tokens_b = tokenizer.tokenize(example.text_b)
-        tokens_b = permutation(tokens_b, permute_ngrams)
+def build_inputs(ids_a, ids_b, max_seq_length, cls_id, sep_id):
+    """Truncates, adds [CLS]/[SEP] and pads a sequence (pair) of ids.
 
-    if tokens_b:
-        # Modifies `tokens_a` and `tokens_b` in place so that the total
+    Returns input_ids, input_mask and segment_ids, each of length max_seq_length.
+    """
+    if ids_b:
+        # Modifies `ids_a` and `ids_b` in place so that the total
         # length is less than the specified length.
         # Account for [CLS], [SEP], [SEP] with "- 3"
-        _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
+        _truncate_seq_pair(ids_a, ids_b, max_seq_length - 3)
     else:
         # Account for [CLS] and [SEP] with "- 2"
-        if len(tokens_a) > max_seq_length - 2:
-            tokens_a = tokens_a[0:(max_seq_length - 2)]
+        if len(ids_a) > max_seq_length - 2:
+            ids_a = ids_a[0:(max_seq_length - 2)]
 
     # The convention in BERT is:
     # (a) For sequence pairs:
@@ -389,39 +389,66 @@ def construct_features(inputs):
     # For classification tasks, the first vector (corresponding to [CLS]) is
     # used as as the "sentence vector". Note that this only makes sense because
     # the entire model is fine-tuned.
-    tokens = []
-    segment_ids = []
-    tokens.append("[CLS]")
-    segment_ids.append(0)
-    for token in tokens_a:
-        tokens.append(token)
-        segment_ids.append(0)
-    tokens.append("[SEP]")
-    segment_ids.append(0)
-
-    if tokens_b:
-        for token in tokens_b:
-            tokens.append(token)
-            segment_ids.append(1)
-        tokens.append("[SEP]")
-        segment_ids.append(1)
-
-    input_ids = tokenizer.convert_tokens_to_ids(tokens)
+    input_ids = [cls_id] + ids_a + [sep_id]
+    segment_ids = [0] * len(input_ids)
+
+    if ids_b:
+        input_ids += ids_b + [sep_id]
+        segment_ids += [1] * (len(ids_b) + 1)
 
     # The mask has 1 for real tokens and 0 for padding tokens. Only real
     # tokens are attended to.
     input_mask = [1] * len(input_ids)
 
     # Zero-pad up to the sequence length.
-    while len(input_ids) < max_seq_length:
-        input_ids.append(0)
-        input_mask.append(0)
-        segment_ids.append(0)
+    padding = max_seq_length - len(input_ids)
+    input_ids += [0] * padding
+    input_mask += [0] * padding
+    segment_ids += [0] * padding
 
     assert len(input_ids) == max_seq_length
     assert len(input_mask) == max_seq_length
     assert len(segment_ids) == max_seq_length
 
+    return input_ids, input_mask, segment_ids
+
+
+# The tokenizer used by construct_features in this process. It is installed once
+# per pool worker by _init_feature_worker rather than pickled with every example,
+# so each worker keeps its WordPiece cache warm across the whole dataset.
+_feature_tokenizer = None
+_feature_selector = None
+
+def _init_feature_worker(tokenizer, selector=None):
+    global _feature_tokenizer, _feature_selector
+    _feature_tokenizer = tokenizer
+    _feature_selector = selector
+
+
+def construct_features(inputs):
+    ex_index, example, max_seq_length, label_map, predict, permute_ngrams = inputs
+    tokenizer = _feature_tokenizer
+    
+    ids_b = None
+    if example.text_b:
+        ids_b = tokenizer.encode(example.text_b)
+    if _feature_selector is not None:
+        # room for [CLS], [SEP] and text_b with its [SEP]
+        budget = max_seq_length - 2 - (len(ids_b) + 1 if ids_b else 0)
+        ids_a = _feature_selector.select_ids(example.text_a, tokenizer, max(budget, 1))
+    else:
+        ids_a = tokenizer.encode(example.text_a)
+
+    token_ids_a = token_ids_b = None
+    if permute_ngrams is not None:
+        # NgramPermutationDataset permutes the whole article afresh each epoch
+        # and truncates afterwards, so it needs the ids before truncation
+        token_ids_a = np.array(ids_a, dtype=np.int32)
+        token_ids_b = np.array(ids_b, dtype=np.int32) if ids_b else None
+
+    input_ids, input_mask, segment_ids = build_inputs(ids_a, ids_b, max_seq_length,
+                                                      tokenizer.vocab["[CLS]"], tokenizer.vocab["[SEP]"])
+
     if not predict:
         label_id = label_map[example.label]
     else: 
@@ -430,6 +457,7 @@ def construct_features(inputs):
     if ex_index < 1:
         logger.info("*** Example ***")
         logger.info("guid: %s" % (example.guid))
+        tokens = tokenizer.convert_ids_to_tokens(input_ids[:sum(input_mask)])
         logger.info("tokens: %s" % " ".join([str(x) for x in tokens]))
         logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
         logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
@@ -440,29 +468,75 @@ def construct_features(inputs):
             logger.info("id: %s" % label_id)
 
     if not predict:
-        return InputFeatures(input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids, label_id=label_id)
+        return InputFeatures(input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids, label_id=label_id,
+                             token_ids_a=token_ids_a, token_ids_b=token_ids_b)
     else:
-        return InputFeatures(input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids, label_id=label_id, article_id=(example.guid.split('-')[1]))
+        return InputFeatures(input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids, label_id=label_id, article_id=(example.guid.split('-')[1]),
+                             token_ids_a=token_ids_a, token_ids_b=token_ids_b)
+
 
+def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, predict=False, permute_ngrams=None,
+                                 selector=None):
+    """Loads a data file into a list of `InputBatch`s.
 
-def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, predict=False, permute_ngrams=None):
-    """Loads a data file into a list of `InputBatch`s."""
+    With a SentenceSelector, text_a is cut down to its most salient sentences rather than its first WordPieces.
+    """
     label_map = {}
     for (i, label) in enumerate(label_list):
         label_map[label] = i
 
-    features = [] 
-    p = multiprocessing.Pool(multiprocessing.cpu_count())
+    if not isinstance(tokenizer, CachedWordPieceTokenizer):
+        tokenizer = CachedWordPieceTokenizer(tokenizer)
 
-    for feature in tqdm(p.imap(construct_features, 
-                               zip(count(), examples, repeat(max_seq_length), repeat(tokenizer), repeat(label_map), 
-                                   repeat(predict), repeat(permute_ngrams)), chunksize=100), 
-                        desc="Example Creation"):
-        features.append(feature)
+    features = [] 
+    with multiprocessing.Pool(multiprocessing.cpu_count(), initializer=_init_feature_worker, initargs=(tokenizer, selector)) as p:
+        for feature in tqdm(p.imap(construct_features, 
+                                   zip(count(), examples, repeat(max_seq_length), repeat(label_map), 
+                                       repeat(predict), repeat(permute_ngrams)), chunksize=100), 
+                            desc="Example Creation"):
+            features.append(feature)
 
     return features
 
 
+class NgramPermutationDataset(Dataset):
+    """Serves features with their articles permuted at n-gram granularity.
+
+    Every access draws a new permutation of the untruncated ids, so each epoch
+    trains on a fresh augmentation. With `fixed=True` the permutation depends
+    only on the example index, which keeps evaluation repeatable. Items are the
+    same tuples a TensorDataset over the features would yield.
+    """
+
+    def __init__(self, features, max_seq_length, permute_ngrams, cls_id, sep_id, predict=False, fixed=False, seed=None):
+        self.features = features
+        self.max_seq_length = max_seq_length
+        self.permute_ngrams = permute_ngrams
+        self.cls_id = cls_id
+        self.sep_id = sep_id
+        self.predict = predict
+        self.fixed = fixed
+        self.rng = np.random.RandomState(seed)
+
+    def __len__(self):
+        return len(self.features)
+
+    def _permute(self, ids, rng):
+        if ids is None:
+            return None
+        return ids[permutation_index(len(ids), self.permute_ngrams, rng)].tolist()
+
+    def __getitem__(self, index):
+        feature = self.features[index]
+        rng = np.random.RandomState(index) if self.fixed else self.rng
+        input_ids, input_mask, segment_ids = build_inputs(self._permute(feature.token_ids_a, rng),
+                                                          self._permute(feature.token_ids_b, rng),
+                                                          self.max_seq_length, self.cls_id, self.sep_id)
+        target = int(feature.article_id) if self.predict else feature.label_id
+        return (torch.tensor(input_ids, dtype=torch.long), torch.tensor(input_mask, dtype=torch.long),
+                torch.tensor(segment_ids, dtype=torch.long), torch.tensor(target, dtype=torch.long))
+
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     """Truncates a sequence pair in place to the maximum length."""
 
@@ -480,7 +554,7 @@ def _truncate_seq_pair(tokens_a, tokens_b, max_length):
             tokens_b.pop()
 
 def copy_optimizer_params_to_model(named_params_model, named_params_optimizer):
-    """ Utility function for optimize_on_cpu and 16-bits training.
+    """ Utility function for optimize_on_cpu training.
         Copy the parameters optimized on CPU/RAM back to the model on GPU
     """
     for (name_opti, param_opti), (name_model, param_model) in zip(named_params_optimizer, named_params_model):
@@ -490,7 +564,7 @@ def copy_optimizer_params_to_model(named_params_model, named_params_optimizer):
         param_model.data.copy_(param_opti.data)
 
 def set_optimizer_params_grad(named_params_optimizer, named_params_model, test_nan=False):
-    """ Utility function for optimize_on_cpu and 16-bits training.
+    """ Utility function for optimize_on_cpu training.
         Copy the gradient of the GPU parameters to the CPU/RAMM copy of the model
     """
     is_nan = False
@@ -509,24 +583,129 @@ def set_optimizer_params_grad(named_params_optimizer, named_params_model, test_n
     return is_nan
 
 def compute_validation_accuracy(model, eval_dataloader, device):
+    """Accuracy over the eval set; with a sharded dataloader the counts of all ranks are summed."""
+    # shards can differ in length by a batch, so the DDP wrapper (whose forward may
+    # sync buffers across ranks) is bypassed
+    model = unwrap_model(model)
     model.eval()
     eval_accuracy = 0.0
     nb_eval_examples = 0
 
     for input_ids, input_mask, segment_ids, label_ids in tqdm(eval_dataloader, desc="Evaluation"):
-        input_ids = input_ids.to(device)
-        input_mask = input_mask.to(device)
-        segment_ids = segment_ids.to(device)
-        label_ids = label_ids.to(device)
-
         with torch.no_grad():
             logits = model(input_ids, segment_ids, input_mask)
 
         eval_accuracy += torch.sum(torch.argmax(logits, dim=1) == label_ids).item()
         nb_eval_examples += input_ids.size(0)
 
+    eval_accuracy, nb_eval_examples = all_reduce_sum([eval_accuracy, nb_eval_examples], device)
     return eval_accuracy / nb_eval_examples
 
+def train_from_encoder_cache(args, model, head, optimizer, precision, train_data, eval_data, device, output_eval_file):
+    """ --frozen_encoder training: the encoder runs once per dataset and the head trains from its cached outputs """
+    cache_dir = args.encoder_cache_dir or os.path.join(args.data_dir, "encoder_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    cached = []
+    for data in (train_data, eval_data):
+        key = encoder_cache_key(args.bert_model, args.model_path, data, args.trainable_layers)
+        encoded = build_encoder_cache(model.bert, data, os.path.join(cache_dir, "%s.npy" % key), args.trainable_layers,
+                                      args.eval_batch_size, device, precision)
+        # encoder outputs, input_mask and label_ids
+        cached.append(TensorDataset(torch.from_numpy(encoded), data.tensors[1], data.tensors[3]))
+    cached_train, cached_eval = cached
+    train_dataloader = DevicePrefetcher(DataLoader(cached_train, sampler=RandomSampler(cached_train),
+                                                   batch_size=args.train_batch_size), device, args.prefetch_batches)
+    eval_dataloader = DevicePrefetcher(DataLoader(cached_eval, sampler=SequentialSampler(cached_eval),
+                                                  batch_size=args.eval_batch_size), device, args.prefetch_batches)
+
+    for i in trange(int(args.num_train_epochs), desc="Epoch"):
+        head.train()
+        for step, (encoded, input_mask, label_ids) in enumerate(tqdm(train_dataloader, desc="Iteration")):
+            with precision.autocast():
+                loss = head(encoded, input_mask, label_ids)
+            if args.gradient_accumulation_steps > 1:
+                loss = loss / args.gradient_accumulation_steps
+            precision.backward(loss)
+            if (step + 1) % args.gradient_accumulation_steps == 0:
+                precision.step(optimizer)
+                if args.flat_optimizer:
+                    # keeps the gradients attached to the flat buffers
+                    optimizer.zero_grad()
+                else:
+                    head.zero_grad()
+        train_dataloader.log_waits()
+
+        head.eval()
+        correct = 0
+        for encoded, input_mask, label_ids in eval_dataloader:
+            with torch.no_grad(), precision.autocast():
+                logits = head(encoded, input_mask)
+            correct += torch.sum(torch.argmax(logits, dim=1) == label_ids).item()
+        val_accuracy = correct / len(cached_eval)
+        print("\nEpoch %d: Validation Accuracy=%.4f\n" % (i, val_accuracy))
+        output_eval_file.write("Epoch %d: Validation Accuracy=%.4f\n" % (i, val_accuracy))
+        output_eval_file.flush()
+
+def predict_labels(model, eval_dataloader, device, precision):
+    """Returns {article_id: "true"/"false"} for the articles in the (sharded) dataloader."""
+    model = unwrap_model(model)
+    model.eval()
+    predictions = {}
+    for input_ids, input_mask, segment_ids, article_ids in tqdm(eval_dataloader, desc="Evaluation"):
+        with torch.no_grad(), precision.autocast():
+            logits = model(input_ids, segment_ids, input_mask)
+
+        y_pred = logits.argmax(dim=1)
+        for article_id, pred in zip(article_ids.tolist(), y_pred.tolist()):
+            predictions[article_id] = ["false", "true"][pred]
+    return predictions
+
+def partial_predictions_path(output_dir, rank):
+    return os.path.join(output_dir, "predictions.rank%d.txt" % rank)
+
+def write_predictions(path, predictions, article_ids=None):
+    """Writes "<article id> <label>" lines, in the order of article_ids if given."""
+    with open(path, "w") as fp:
+        for article_id in (article_ids if article_ids is not None else predictions):
+            print(article_id, predictions[article_id], file=fp)
+
+def merge_predictions(output_dir, world_size, article_ids, cached=None):
+    """Merges the partial predictions of every rank into predictions.txt, in dataset order.
+
+    The partial files are read from output_dir, so with several nodes it has to be
+    on a shared file system. cached holds {article_id: label} that were not predicted
+    this run. Returns all the predictions.
+    """
+    predictions = dict(cached or {})
+    for rank in range(world_size):
+        path = partial_predictions_path(output_dir, rank)
+        with open(path) as fp:
+            for line in fp:
+                article_id, label = line.split()
+                predictions[int(article_id)] = label
+        os.remove(path)
+    # the same article can appear in several features; keep its first position
+    ordered = list(dict.fromkeys(article_ids))
+    missing = [article_id for article_id in ordered if article_id not in predictions]
+    if missing:
+        raise ValueError("No prediction for %d articles, e.g. %s" % (len(missing), missing[:5]))
+    write_predictions(os.path.join(output_dir, "predictions.txt"), predictions, ordered)
+    return predictions
+
+def write_cascade_report(args, model, prefilter, eval_examples, eval_data, eval_features, device, precision):
+    """ Writes cascade_report.json: BERT calls saved and cascade accuracy at each band width """
+    start = time.perf_counter()
+    probabilities = prefilter_probabilities(prefilter, [example.text_a for example in eval_examples])
+    prefilter_seconds = time.perf_counter() - start
+    bert_probs, bert_seconds = bert_probabilities(unwrap_model(model), eval_data, args.eval_batch_size, device, precision)
+    report = band_report(probabilities, prefilter_seconds, bert_probs, bert_seconds, [f.label_id for f in eval_features])
+    with open(os.path.join(args.output_dir, "cascade_report.json"), "w") as writer:
+        json.dump(report, writer, indent=2)
+    for band in report["bands"]:
+        logger.info("Cascade band %.1f: %.1f%% of articles to BERT, accuracy %.4f, %.1f articles/s",
+                    band["band_width"], 100 * band["bert_fraction"], band["accuracy"], band["articles_per_second"])
+    return report
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -561,7 +740,7 @@ def main():
                         default=None,
                         type=int,
                         help="At what granularity to permute the training articles. By default articles will not be permuted. The value n corresponds "
-                             " to the size of the n-grams to permute.")
+                             " to the size of the n-grams to permute. Training articles get a fresh permutation every epoch.")
     parser.add_argument("--do_train",
                         default=False,
                         action='store_true',
@@ -599,10 +778,7 @@ def main():
                         default=False,
                         action='store_true',
                         help="Whether not to use CUDA when available")
-    parser.add_argument("--local_rank",
-                        type=int,
-                        default=-1,
-                        help="local_rank for distributed training on gpus")
+    add_distributed_arguments(parser)
     parser.add_argument('--seed', 
                         type=int, 
                         default=42,
@@ -615,13 +791,28 @@ def main():
                         default=False,
                         action='store_true',
                         help="Whether to perform optimization and keep the optimizer averages on CPU")
-    parser.add_argument('--fp16',
+    parser.add_argument('--flat_optimizer',
+                        default=False,
+                        action='store_true',
+                        help="Whether to keep parameters, gradients and Adam moments in flat contiguous buffers. "
+                             "With --optimize_on_cpu the Adam state is offloaded to pinned host memory.")
+    parser.add_argument('--gradient_checkpointing',
                         default=False,
                         action='store_true',
-                        help="Whether to use 16-bit float precision instead of 32-bit")
-    parser.add_argument('--loss_scale',
-                        type=float, default=128,
-                        help='Loss scaling, positive power of 2 values can improve fp16 convergence.')
+                        help="Whether to recompute encoder activations in the backward pass instead of storing them. "
+                             "Costs about a third more compute but allows larger batches and fewer accumulation steps.")
+    add_precision_arguments(parser)
+    add_telemetry_arguments(parser)
+    add_prefetch_arguments(parser)
+    add_frozen_encoder_arguments(parser)
+    add_prediction_cache_arguments(parser)
+    add_cascade_arguments(parser)
+    add_sentence_selection_arguments(parser)
+    parser.add_argument('--early_exit_threshold',
+                        type=float,
+                        default=None,
+                        help="With a --model_path written by early_exit.py, stop each article at the first exit head "
+                             "whose confidence reaches this threshold.")
     parser.add_argument('--model_path',
                         default=None,
                         help='Model path if you want to use a previously saved model.')
@@ -629,6 +820,10 @@ def main():
                         default=False,
                         action='store_true',
                         help='Flag determines if we are running this on TIRA.') 
+    parser.add_argument('--fast_preprocess',
+                        default=False,
+                        action='store_true',
+                        help='Preprocess raw XML with the regex tokenizer instead of spacy (semevalofficial only).')
     parser.add_argument('--model_no_save',
                         default=False,
                         action='store_true',
@@ -645,23 +840,17 @@ def main():
         "semevalofficial": SemevalOfficialProcessor,
     }
 
-    if args.local_rank == -1 or args.no_cuda:
-        device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
-        n_gpu = torch.cuda.device_count()
-    else:
-        device = torch.device("cuda", args.local_rank)
-        n_gpu = 1
-        # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
-        torch.distributed.init_process_group(backend='nccl')
-        if args.fp16:
-            logger.info("16-bits training currently not supported in distributed training")
-            args.fp16 = False # (see https://github.com/pytorch/pytorch/pull/13496)
+    device, n_gpu = setup_distributed(args)
     logger.info("device %s n_gpu %d distributed training %r", device, n_gpu, bool(args.local_rank != -1))
 
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
                             args.gradient_accumulation_steps))
 
+    precision = MixedPrecision(device, fp16=args.fp16, bf16=args.bf16, loss_scale=args.loss_scale)
+    if precision.scaling and args.optimize_on_cpu and not args.flat_optimizer:
+        raise ValueError("`fp16` loss scaling needs the optimizer on the device, use `bf16` with `optimize_on_cpu`.")
+
     args.train_batch_size = int(args.train_batch_size / args.gradient_accumulation_steps)
 
     random.seed(args.seed)
@@ -676,8 +865,30 @@ def main():
     if args.do_train and args.do_eval:
         raise ValueError("`do_train` and `do_eval` together does not make much sense as training logs validation accuracy anyway.")
 
+    if args.frozen_encoder:
+        if not args.do_train:
+            raise ValueError("`frozen_encoder` only changes training, evaluate the saved model without it.")
+        if args.permute_ngrams is not None:
+            raise ValueError("`frozen_encoder` caches fixed inputs and cannot be combined with `permute_ngrams`.")
+        if args.local_rank != -1:
+            raise ValueError("`frozen_encoder` trains in a single process.")
+        if args.optimize_on_cpu and not args.flat_optimizer:
+            raise ValueError("`frozen_encoder` needs the optimizer on the device or `flat_optimizer`.")
+    if args.prediction_cache is not None and (args.do_train or not args.predict):
+        raise ValueError("`prediction_cache` only applies to `predict` with an already trained model.")
+    if args.select_sentences and args.sentence_scorer == "prefilter" and not (args.train_prefilter or args.prefilter_path):
+        raise ValueError("`sentence_scorer prefilter` needs `train_prefilter` or `prefilter_path`.")
+    if args.early_exit_threshold is not None and (args.do_train or args.model_path is None):
+        raise ValueError("`early_exit_threshold` evaluates a `model_path` checkpoint with exit heads from early_exit.py.")
+    if args.train_prefilter and not args.do_train:
+        raise ValueError("`train_prefilter` trains alongside the classifier and needs `do_train`.")
+    if args.cascade_band_width is not None and (not args.predict or args.do_train or args.prefilter_path is None):
+        raise ValueError("`cascade_band_width` applies to `predict` with an already trained model and `prefilter_path`.")
+
     if os.path.exists(args.output_dir) and os.listdir(args.output_dir):
         raise ValueError("Output directory ({}) already exists and is not empty.".format(args.output_dir))
+    # every rank checks the directory before any of them writes to it
+    barrier()
     os.makedirs(args.output_dir, exist_ok=True)
 
     task_name = args.task_name.lower()
@@ -686,6 +897,8 @@ def main():
         raise ValueError("Task not found: %s" % (task_name))
 
     processor = processors[task_name]()
+    if args.fast_preprocess:
+        processor.fast_preprocess = True
     label_list = processor.get_labels()
 
     tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
@@ -696,28 +909,50 @@ def main():
         train_examples = processor.get_train_examples(args.data_dir)
         num_train_steps = int(len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
 
+    prefilter = None
+    if args.train_prefilter:
+        # rank 0 fits the (cheap) linear model, every rank loads the same copy
+        prefilter_path = os.path.join(args.output_dir, PREFILTER_NAME)
+        if is_main_process():
+            label_map = dict((label, i) for i, label in enumerate(label_list))
+            save_prefilter(train_prefilter([example.text_a for example in train_examples],
+                                           [label_map[example.label] for example in train_examples],
+                                           len(label_list), args.prefilter_buckets, args.prefilter_epochs,
+                                           seed=args.seed),
+                           prefilter_path)
+        barrier()
+        prefilter = load_prefilter(prefilter_path)
+    elif args.prefilter_path is not None:
+        prefilter = load_prefilter(args.prefilter_path)
+
     # Prepare model
-    model = BertForSequenceClassification.from_pretrained(args.bert_model, cache_dir=PYTORCH_PRETRAINED_BERT_CACHE / 'distributed_{}'.format(args.local_rank))
+    # an early_exit.py checkpoint also holds the exit heads
+    model_class = BertForEarlyExitClassification if args.early_exit_threshold is not None else BertForSequenceClassification
+    model = model_class.from_pretrained(args.bert_model, cache_dir=PYTORCH_PRETRAINED_BERT_CACHE / 'distributed_{}'.format(args.local_rank))
     
     if args.model_path is not None:
-        model.load_state_dict(torch.load(args.model_path), strict=False)
-
-    if args.fp16:
-        model.half()
+        incompatible = model.load_state_dict(torch.load(args.model_path), strict=False)
+        if args.early_exit_threshold is not None and any(key.startswith("exit_heads.")
+                                                         for key in incompatible.missing_keys):
+            raise ValueError("%s has no exit heads; train them with early_exit.py before using `early_exit_threshold`."
+                             % args.model_path)
+    if args.early_exit_threshold is not None:
+        model.exit_threshold = args.early_exit_threshold
+
+    if args.gradient_checkpointing:
+        enable_gradient_checkpointing(model)
     model.to(device)
-    if args.local_rank != -1:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
-                                                          output_device=args.local_rank)
-    elif n_gpu > 1:
-        model = torch.nn.DataParallel(model)
+    if args.frozen_encoder:
+        # only the head is trained; it shares its modules with the model that gets saved
+        head = FrozenEncoderHead(model, args.trainable_layers)
+    model = wrap_model(model, device, n_gpu)
 
     # Prepare optimizer
-    if args.fp16:
-        param_optimizer = [(n, param.clone().detach().to('cpu').float().requires_grad_()) \
-                            for n, param in model.named_parameters()]
-    elif args.optimize_on_cpu:
+    if args.optimize_on_cpu and not args.flat_optimizer:
         param_optimizer = [(n, param.clone().detach().to('cpu').requires_grad_()) \
                             for n, param in model.named_parameters()]
+    elif args.frozen_encoder:
+        param_optimizer = list(head.named_parameters())
     else:
         param_optimizer = list(model.named_parameters())
     no_decay = ['bias', 'gamma', 'beta']
@@ -726,129 +961,198 @@ def main():
         {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.0}
         ]
     t_total = num_train_steps
-    if args.local_rank != -1:
+    if args.do_train and args.local_rank != -1:
         t_total = t_total // torch.distributed.get_world_size()
-    optimizer = BertAdam(optimizer_grouped_parameters,
-                         lr=args.learning_rate,
-                         warmup=args.warmup_proportion,
-                         t_total=t_total)
+    if args.flat_optimizer:
+        optimizer = FlatBertAdam(optimizer_grouped_parameters,
+                                 lr=args.learning_rate,
+                                 warmup=args.warmup_proportion,
+                                 t_total=t_total,
+                                 offload=args.optimize_on_cpu)
+    else:
+        optimizer = BertAdam(optimizer_grouped_parameters,
+                             lr=args.learning_rate,
+                             warmup=args.warmup_proportion,
+                             t_total=t_total)
 
     # In both training and evaluation you will use the validation dataset.
     eval_examples = processor.get_dev_examples(args.data_dir)
+    if args.predict:
+        predict_article_ids = [int(example.guid.split('-')[1]) for example in eval_examples]
+        cached_predictions = {}
+        prefilter_predictions = {}
+    if args.prediction_cache is not None:
+        # articles scored before by this model skip tokenization and the forward pass
+        prediction_cache = PredictionCache(args.prediction_cache, args.prediction_cache_size)
+        prediction_model = prediction_cache.model_key(args)
+        text_hashes = dict((article_id, text_key(example.text_a, args.do_lower_case))
+                           for article_id, example in zip(predict_article_ids, eval_examples))
+        cached_labels = prediction_cache.lookup(prediction_model, text_hashes.values())
+        cached_predictions = dict((article_id, cached_labels[text_hash]) for article_id, text_hash in text_hashes.items()
+                                  if text_hash in cached_labels)
+        eval_examples = [example for article_id, example in zip(predict_article_ids, eval_examples)
+                         if article_id not in cached_predictions]
+        logger.info("Prediction cache: %d of %d articles cached", len(cached_predictions), len(text_hashes))
+    if args.cascade_band_width is not None:
+        # confident prefilter labels are final; only the uncertain band goes on to BERT
+        probabilities = prefilter_probabilities(prefilter, [example.text_a for example in eval_examples])
+        routed = uncertain(probabilities, args.cascade_band_width)
+        for example, example_probabilities, to_bert in zip(eval_examples, probabilities, routed):
+            if not to_bert:
+                prefilter_predictions[int(example.guid.split('-')[1])] = label_list[example_probabilities.argmax()]
+        logger.info("Cascade: %d of %d articles sent to BERT", routed.sum(), len(eval_examples))
+        eval_examples = [example for example, to_bert in zip(eval_examples, routed) if to_bert]
+    selector = None
+    if args.select_sentences:
+        selector = SentenceSelector(args.sentence_scorer, prefilter)
     eval_features = convert_examples_to_features(eval_examples, label_list, args.max_seq_length, tokenizer, 
-                                                 args.predict, permute_ngrams=args.permute_ngrams)
+                                                 args.predict, permute_ngrams=args.permute_ngrams, selector=selector)
 
-    all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-
-    if not args.predict:    
-        all_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+    if args.permute_ngrams is not None:
+        eval_data = NgramPermutationDataset(eval_features, args.max_seq_length, args.permute_ngrams, cls_id, sep_id,
+                                            predict=args.predict, fixed=True)
     else:
-        all_article_ids = torch.tensor([int(f.article_id) for f in eval_features], dtype=torch.long)
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_article_ids)
+        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
+        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
+        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
 
-    eval_sampler = SequentialSampler(eval_data)
-    eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        if not args.predict:    
+            all_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
+            eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+        else:
+            all_article_ids = torch.tensor([int(f.article_id) for f in eval_features], dtype=torch.long)
+            eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_article_ids)
+
+    # every rank validates its own shard; compute_validation_accuracy sums the counts
+    eval_sampler = ShardedSampler(eval_data)
+    eval_dataloader = DevicePrefetcher(DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size),
+                                       device, args.prefetch_batches)
 
     if args.do_train:
-        train_features = convert_examples_to_features(train_examples, label_list, args.max_seq_length, tokenizer, permute_ngrams=args.permute_ngrams)
+        train_features = convert_examples_to_features(train_examples, label_list, args.max_seq_length, tokenizer, permute_ngrams=args.permute_ngrams,
+                                                      selector=selector)
         logger.info("***** Running training *****")
         logger.info("  Num examples = %d", len(train_examples))
         logger.info("  Batch size = %d", args.train_batch_size)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+        if args.permute_ngrams is not None:
+            train_data = NgramPermutationDataset(train_features, args.max_seq_length, args.permute_ngrams, cls_id, sep_id,
+                                                 seed=args.seed)
+        else:
+            all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
+            all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
+            all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
+            all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
+            train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
         if args.local_rank == -1:
             train_sampler = RandomSampler(train_data)
         else:
             train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
-        output_eval_file = open(os.path.join(args.output_dir, "eval_results.txt"), "w")
-
-        for i in trange(int(args.num_train_epochs), desc="Epoch"):
-
-            model.train()
-            for step, batch in enumerate(tqdm(train_dataloader, desc="Iteration")):
-                batch = tuple(t.to(device) for t in batch)
-                input_ids, input_mask, segment_ids, label_ids = batch
-                loss = model(input_ids, segment_ids, input_mask, label_ids)
-
-                if n_gpu > 1:
-                    loss = loss.mean() # mean() to average on multi-gpu.
-                if args.fp16 and args.loss_scale != 1.0:
-                    # rescale loss for fp16 training
-                    # see https://docs.nvidia.com/deeplearning/sdk/mixed-precision-training/index.html
-                    loss = loss * args.loss_scale
-                if args.gradient_accumulation_steps > 1:
-                    loss = loss / args.gradient_accumulation_steps
-                loss.backward()
-
-                if (step + 1) % args.gradient_accumulation_steps == 0:
-                    if args.fp16 or args.optimize_on_cpu:
-                        if args.fp16 and args.loss_scale != 1.0:
-                            # scale down gradients for fp16 training
-                            for param in model.parameters():
-                                if param.grad is not None:
-                                    param.grad.data = param.grad.data / args.loss_scale
-                        is_nan = set_optimizer_params_grad(param_optimizer, model.named_parameters(), test_nan=True)
-                        if is_nan:
-                            logger.info("FP16 TRAINING: Nan in gradients, reducing loss scaling")
-                            args.loss_scale = args.loss_scale / 2
-                            model.zero_grad()
-                            continue
-                        optimizer.step()
-                        copy_optimizer_params_to_model(model.named_parameters(), param_optimizer)
-                    else:
-                        optimizer.step()
-                    model.zero_grad()
-
-            val_accuracy = compute_validation_accuracy(model, eval_dataloader, device)
-            print("\nEpoch %d: Validation Accuracy=%.4f\n" % (i, val_accuracy))
-            output_eval_file.write("Epoch %d: Validation Accuracy=%.4f\n" % (i, val_accuracy))
-            output_eval_file.flush()
+        # batches are copied to the device while the previous step computes
+        train_dataloader = DevicePrefetcher(DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size,
+                                                       pin_memory=device.type == 'cuda'),
+                                            device, args.prefetch_batches)
+        if is_main_process():
+            output_eval_file = open(os.path.join(args.output_dir, "eval_results.txt"), "w")
+        # the step timings of rank 0 stand for every rank
+        metrics = StepMetrics(args.metrics_file if is_main_process() else None, device, args.profile_steps,
+                              trace_dir=args.output_dir)
+
+        if args.frozen_encoder:
+            train_from_encoder_cache(args, unwrap_model(model), head, optimizer, precision, train_data, eval_data, device,
+                                     output_eval_file)
+        else:
+            for i in trange(int(args.num_train_epochs), desc="Epoch"):
+                if isinstance(train_sampler, DistributedSampler):
+                    # reshuffles the shards each epoch
+                    train_sampler.set_epoch(i)
+
+                model.train()
+                for step, batch in enumerate(metrics.iterate(tqdm(train_dataloader, desc="Iteration"), epoch=i,
+                                                               prefetcher=train_dataloader)):
+                    input_ids, input_mask, segment_ids, label_ids = batch
+                    # gradients are only all-reduced on the last micro-batch before an update
+                    with gradient_sync(model, (step + 1) % args.gradient_accumulation_steps == 0):
+                        with metrics.phase("forward"), precision.autocast():
+                            loss = model(input_ids, segment_ids, input_mask, label_ids)
+
+                        if n_gpu > 1:
+                            loss = loss.mean() # mean() to average on multi-gpu.
+                        if args.gradient_accumulation_steps > 1:
+                            loss = loss / args.gradient_accumulation_steps
+                        with metrics.phase("backward"):
+                            precision.backward(loss)
+
+                    if (step + 1) % args.gradient_accumulation_steps == 0:
+                        with metrics.phase("optimizer"):
+                            if args.optimize_on_cpu and not args.flat_optimizer:
+                                set_optimizer_params_grad(param_optimizer, model.named_parameters())
+                                optimizer.step()
+                                copy_optimizer_params_to_model(model.named_parameters(), param_optimizer)
+                            else:
+                                # skips the update and lowers the loss scale if fp16 gradients overflowed
+                                precision.step(optimizer)
+                            if args.flat_optimizer:
+                                # keeps the gradients attached to the flat buffers
+                                optimizer.zero_grad()
+                            else:
+                                model.zero_grad()
+                    metrics.end_step(input_ids.size(0), input_mask, loss)
+                train_dataloader.log_waits()
+
+                with precision.autocast():
+                    val_accuracy = compute_validation_accuracy(model, eval_dataloader, device)
+                if is_main_process():
+                    print("\nEpoch %d: Validation Accuracy=%.4f\n" % (i, val_accuracy))
+                    output_eval_file.write("Epoch %d: Validation Accuracy=%.4f\n" % (i, val_accuracy))
+                    output_eval_file.flush()
 
         model_path = os.path.join(args.output_dir, "model.pth")
-        if n_gpu > 1:
-            if not args.model_no_save:
-                torch.save(model.module.state_dict(), model_path)
-        else:
-            if not args.model_no_save:
-                torch.save(model.state_dict(), model_path) 
+        # the replicas are identical, so rank 0 writes the only checkpoint
+        if is_main_process() and not args.model_no_save:
+            torch.save(unwrap_model(model).state_dict(), model_path)
 
-        output_eval_file.close()
+        metrics.close()
+        if is_main_process():
+            output_eval_file.close()
+        if prefilter is not None and not args.predict and is_main_process():
+            write_cascade_report(args, model, prefilter, eval_examples, eval_data, eval_features, device, precision)
 
-    if args.do_eval and (args.local_rank == -1 or torch.distributed.get_rank() == 0):
+    if args.do_eval:
         if args.predict:
-            outfile_path = os.path.join(args.output_dir, "predictions.txt")
-            with open(outfile_path, "w") as fp:
-                for input_ids, input_mask, segment_ids, article_ids in tqdm(eval_dataloader, desc="Evaluation"):
-                    input_ids = input_ids.to(device)
-                    input_mask = input_mask.to(device)
-                    segment_ids = segment_ids.to(device)
-                    article_ids = article_ids.to(device)
-
-                    with torch.no_grad():
-                        logits = model(input_ids, segment_ids, input_mask)
-
-                    y_pred = logits.argmax(dim=1)
-
-                    outfile = os.path.join(args.output_dir, "predictions.txt")
-                    for article_id, pred in zip(article_ids, y_pred):
-                        print(article_id.item(), end=" ", file=fp)
-                        print(["false", "true"][pred.item()], file=fp)
+            # every rank labels its shard of the articles, then rank 0 merges the shards
+            predictions = predict_labels(model, eval_dataloader, device, precision)
+            write_predictions(partial_predictions_path(args.output_dir, get_rank()), predictions)
+            barrier()
+            if is_main_process():
+                known_predictions = dict(cached_predictions)
+                known_predictions.update(prefilter_predictions)
+                predictions = merge_predictions(args.output_dir, get_world_size(), predict_article_ids,
+                                                known_predictions)
+                logger.info("Wrote predictions for %d articles from %d shards", len(predictions), get_world_size())
+                if args.prediction_cache is not None:
+                    # only BERT's own labels go into the cache
+                    prediction_cache.update(prediction_model,
+                                            dict((text_hashes[article_id], label) for article_id, label in predictions.items()
+                                                 if article_id not in known_predictions),
+                                            used=[text_hashes[article_id] for article_id in cached_predictions])
+                    prediction_cache.write_stats(os.path.join(args.output_dir, "prediction_cache.json"), prediction_model)
+            if args.prediction_cache is not None:
+                prediction_cache.close()
 
         else:
             output_eval_file = os.path.join(args.output_dir, "eval_results.txt")
-            val_accuracy = compute_validation_accuracy(model, eval_dataloader, device)
+            with precision.autocast():
+                val_accuracy = compute_validation_accuracy(model, eval_dataloader, device)
+
+            if is_main_process():
+                with open(output_eval_file, "w") as writer:
+                    logger.info("***** Eval results *****")
+                    logger.info("Validation Accuracy = %.4f", val_accuracy)
+                    writer.write("Validation Accuracy = %.4f\n" % (val_accuracy,))
 
-            with open(output_eval_file, "w") as writer:
-                logger.info("***** Eval results *****")
-                logger.info("Validation Accuracy = %.4f", val_accuracy)
-                writer.write("Validation Accuracy = %.4f\n" % (val_accuracy,))
+            if prefilter is not None and is_main_process():
+                write_cascade_report(args, model, prefilter, eval_examples, eval_data, eval_features, device, precision)
 
 if __name__ == "__main__":
     main()
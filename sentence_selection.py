@@ -0,0 +1,129 @@
+# coding=utf-8
+"""Salient-sentence selection: fit the best sentences of an article into a short input.
+
+construct_features keeps the first max_seq_length WordPieces of an article, so a
+long article spends its whole budget on the lede and whatever boilerplate comes
+first. With a SentenceSelector the article is split on its -eos- sentence
+markers, every sentence is scored by a cheap lexical model, and the
+highest-scoring sentences are packed into the budget and put back in their
+original order. The inputs get much shorter (128-256 WordPieces instead of
+500), which cuts the quadratic attention cost by 4x or more.
+
+Two scorers:
+
+* "centroid" (no training): a sentence scores by how often its content words
+  occur in the rest of the article, normalised by the square root of its
+  length, so sentences about the article's main topic win over asides;
+* "prefilter": with the hashed n-gram prefilter from cascade.py, a sentence
+  scores by the total weight difference between the labels of its n-grams,
+  i.e. by how much label evidence it carries.
+"""
+
+import logging
+import math
+from collections import Counter
+
+import numpy as np
+
+from cascade import hash_ngrams
+
+logger = logging.getLogger(__name__)
+
+SCORERS = ["centroid", "prefilter"]
+SENTENCE_MARKER = "-eos-"
+
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both
+but by can could did do does doing down during each few for from further had has have having he her here hers
+him his how i if in into is it its itself just me more most my no nor not now of off on once only or other our
+ours out over own same she should so some such than that the their theirs them then there these they this those
+through to too under until up very was we were what when where which while who whom why will with would you your
+said says say also one two new like get got
+""".split())
+
+
+def add_sentence_selection_arguments(parser):
+    """Adds the --select_sentences/--sentence_scorer flags to an argparse parser."""
+    parser.add_argument('--select_sentences',
+                        default=False,
+                        action='store_true',
+                        help="Whether to fill max_seq_length with the most salient -eos- delimited sentences of each "
+                             "article instead of its first WordPieces.")
+    parser.add_argument('--sentence_scorer',
+                        default="centroid",
+                        choices=SCORERS,
+                        help="How --select_sentences scores sentences: content-word overlap with the article, or the "
+                             "label evidence of the --train_prefilter/--prefilter_path prefilter.")
+
+
+def split_sentences(text):
+    """The sentences of a preprocessed article, each starting with its -eos- marker.
+
+    Marker-only pieces (the article's final -eos-) are dropped.
+    """
+    sentences = []
+    current = []
+    for token in text.split():
+        if token.lower() == SENTENCE_MARKER and current:
+            sentences.append(current)
+            current = []
+        current.append(token)
+    if current:
+        sentences.append(current)
+    return [" ".join(tokens) for tokens in sentences
+            if any(token.lower() != SENTENCE_MARKER for token in tokens)]
+
+
+def _content_words(sentence):
+    return [word for word in sentence.lower().split()
+            if len(word) > 2 and word.isalpha() and word not in STOPWORDS]
+
+
+class SentenceSelector(object):
+    """Scores sentences and packs the best into a WordPiece budget. Picklable, for the feature workers."""
+
+    def __init__(self, scorer="centroid", prefilter=None):
+        if scorer not in SCORERS:
+            raise ValueError("Unknown sentence scorer %r, expected one of %s" % (scorer, SCORERS))
+        if scorer == "prefilter":
+            if prefilter is None:
+                raise ValueError("The prefilter sentence scorer needs a trained prefilter.")
+            weights = prefilter.weights.weight.detach().cpu().numpy()
+            # how strongly each n-gram bucket separates the labels
+            self.evidence = np.abs(weights.max(axis=1) - weights.min(axis=1)).astype(np.float32)
+            self.num_buckets = prefilter.num_buckets
+            self.ngram_range = prefilter.ngram_range
+        self.scorer = scorer
+
+    def scores(self, sentences):
+        if self.scorer == "prefilter":
+            return [self.evidence[hash_ngrams(sentence, self.num_buckets, self.ngram_range)].sum()
+                    / math.sqrt(len(sentence.split())) for sentence in sentences]
+        words = [_content_words(sentence) for sentence in sentences]
+        counts = Counter(word for sentence_words in words for word in sentence_words)
+        # a sentence's own words do not count towards its overlap with the article
+        return [sum(counts[word] - sentence_words.count(word) for word in set(sentence_words))
+                / math.sqrt(len(sentence.split())) for sentence, sentence_words in zip(sentences, words)]
+
+    def select_ids(self, text, tokenizer, max_tokens):
+        """WordPiece ids of the best sentences that fit in max_tokens, in article order."""
+        # articles that already fit are left exactly as they are
+        all_ids = tokenizer.encode(text)
+        if len(all_ids) <= max_tokens:
+            return all_ids
+        sentences = split_sentences(text)
+        ids = [tokenizer.encode(sentence) for sentence in sentences]
+
+        ranked = sorted(range(len(sentences)), key=self.scores(sentences).__getitem__, reverse=True)
+        chosen = []
+        remaining = max_tokens
+        for index in ranked:
+            if len(ids[index]) <= remaining:
+                chosen.append(index)
+                remaining -= len(ids[index])
+            if remaining == 0:
+                break
+        if not chosen:
+            # every sentence is longer than the budget: truncate the best one
+            return ids[ranked[0]][:max_tokens]
+        return [i for index in sorted(chosen) for i in ids[index]]
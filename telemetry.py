@@ -0,0 +1,185 @@
+# coding=utf-8
+"""Per-step timing and throughput metrics for the training loops.
+
+Each training step (one micro-batch) is split into phases (data-loading wait,
+host-to-device copy, forward, backward, optimizer) and written as one record
+to a JSONL or CSV file, together with examples/sec, real vs padding
+tokens/sec and peak memory. An optional window of steps can be captured with
+the torch profiler as a Chrome trace. Loops that iterate over a
+DevicePrefetcher pass it to `iterate`, and h2d is then how long the step was
+held up by the copy of its batch (see prefetch.py); that time is also part of
+data_wait for synchronous copies, or of forward for prefetched ones.
+
+When no metrics file is given every hook is a no-op, so the loops pay nothing.
+Timing a CUDA phase needs a synchronize at each boundary, which costs a little
+throughput while metrics are being recorded.
+"""
+
+import contextlib
+import csv
+import json
+import logging
+import os
+import resource
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+PHASES = ["data_wait", "h2d", "forward", "backward", "optimizer"]
+FIELDS = (["epoch", "step", "step_time"] + PHASES +
+          ["examples", "examples_per_sec", "real_tokens", "padding_tokens", "real_tokens_per_sec",
+           "padding_tokens_per_sec", "peak_memory_mb", "loss"])
+
+
+def add_telemetry_arguments(parser):
+    """Adds the --metrics_file/--profile_steps flags to an argparse parser."""
+    parser.add_argument('--metrics_file',
+                        default=None,
+                        type=str,
+                        help="Write per-step timings and throughput to this .jsonl or .csv file.")
+    parser.add_argument('--profile_steps',
+                        default=None,
+                        type=int,
+                        nargs=2,
+                        metavar=('START', 'END'),
+                        help="Capture a torch profiler trace of training steps [START, END) into the output directory.")
+
+
+class StepMetrics(object):
+    """Collects phase timings for each training step and writes them to a sink."""
+
+    def __init__(self, path=None, device=None, profile_steps=None, trace_dir=None):
+        self.enabled = path is not None
+        self.device = device
+        self.profile_steps = profile_steps
+        self.trace_dir = trace_dir
+        self.profiler = None
+        self.global_step = 0
+        self.epoch = 0
+        self.totals = dict((phase, 0.0) for phase in PHASES)
+        self.steps_recorded = 0
+        self.prefetcher = None
+        self._reset()
+
+        self.fp = None
+        if self.enabled:
+            self.fp = open(path, "w")
+            self.csv = path.endswith(".csv")
+            if self.csv:
+                self.writer = csv.DictWriter(self.fp, fieldnames=FIELDS)
+                self.writer.writeheader()
+
+    def _reset(self):
+        self.current = dict((phase, 0.0) for phase in PHASES)
+        self.step_start = time.perf_counter()
+
+    def _synchronize(self):
+        if self.device is not None and self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        self._synchronize()
+        start = time.perf_counter()
+        yield
+        self._synchronize()
+        self.current[name] += time.perf_counter() - start
+
+    def phase(self, name):
+        """Context manager timing one phase of the current step."""
+        if not self.enabled:
+            return contextlib.suppress()
+        return self._timed(name)
+
+    def iterate(self, batches, epoch=None, prefetcher=None):
+        """Wraps a batch iterator, timing how long each step waits for its batch.
+
+        With the DevicePrefetcher behind the iterator, each step's copy wait becomes its h2d phase.
+        """
+        if epoch is not None:
+            self.epoch = epoch
+        self.prefetcher = prefetcher
+        iterator = iter(batches)
+        while True:
+            if self.enabled:
+                self._reset()
+            with self.phase("data_wait"):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            self._start_profiler()
+            yield batch
+
+    def end_step(self, examples, input_mask=None, loss=None):
+        """Finishes the current step, writing its record and driving the profiler window."""
+        self._stop_profiler()
+        self.global_step += 1
+        if not self.enabled:
+            return
+
+        self._synchronize()
+        step_time = time.perf_counter() - self.step_start
+        if self.prefetcher is not None:
+            self.current["h2d"] = self.prefetcher.transfer_wait()
+        record = dict(self.current, epoch=self.epoch, step=self.global_step - 1, step_time=step_time,
+                      examples=examples, examples_per_sec=examples / step_time)
+        if input_mask is not None:
+            real_tokens = int(input_mask.sum().item())
+            padding_tokens = input_mask.numel() - real_tokens
+            record.update(real_tokens=real_tokens, padding_tokens=padding_tokens,
+                          real_tokens_per_sec=real_tokens / step_time,
+                          padding_tokens_per_sec=padding_tokens / step_time)
+        if loss is not None:
+            record["loss"] = loss.item()
+        record["peak_memory_mb"] = self._peak_memory_mb()
+
+        for phase in PHASES:
+            self.totals[phase] += self.current[phase]
+        self.steps_recorded += 1
+
+        if self.csv:
+            self.writer.writerow(record)
+        else:
+            self.fp.write(json.dumps(record) + "\n")
+        self.fp.flush()
+
+    def _peak_memory_mb(self):
+        if self.device is not None and self.device.type == 'cuda':
+            peak = torch.cuda.max_memory_allocated(self.device)
+            torch.cuda.reset_max_memory_allocated(self.device)
+            return peak / 2 ** 20
+        # ru_maxrss is the peak resident set of the whole process, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+    def _start_profiler(self):
+        if self.profile_steps is None or self.profiler is not None or self.global_step != self.profile_steps[0]:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device is not None and self.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self.profiler.__enter__()
+
+    def _stop_profiler(self):
+        if self.profiler is None or self.global_step + 1 < self.profile_steps[1]:
+            return
+        self.profiler.__exit__(None, None, None)
+        trace_path = os.path.join(self.trace_dir or ".", "trace_steps_%d_%d.json" % tuple(self.profile_steps))
+        self.profiler.export_chrome_trace(trace_path)
+        logger.info("Wrote profiler trace to %s", trace_path)
+        self.profiler = None
+
+    def close(self):
+        if self.profiler is not None:
+            self.profile_steps = (self.profile_steps[0], self.global_step)
+            self._stop_profiler()
+        if not self.enabled:
+            return
+        self.fp.close()
+        if self.steps_recorded:
+            logger.info("***** Step timings (mean over %d steps) *****", self.steps_recorded)
+            for phase in PHASES:
+                logger.info("  %s = %.2f ms", phase, 1000 * self.totals[phase] / self.steps_recorded)
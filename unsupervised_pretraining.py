@@ -25,7 +25,6 @@ import argparse
 import random
 import math
 import multiprocessing
-import spacy
 from pathlib import Path
 from itertools import count, repeat
 from tqdm import tqdm, trange
@@ -40,12 +39,20 @@ from pytorch_pretrained_bert.tokenization import BertTokenizer
 from pytorch_pretrained_bert.modeling import BertForPreTraining
 from pytorch_pretrained_bert.optimization import BertAdam
 from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
+from batch_tokenizer import CachedWordPieceTokenizer
+from corpus_io import find_corpus, open_corpus
+from bertaverager import BertForPackedPreTraining, enable_gradient_checkpointing
+from distributed_utils import (add_distributed_arguments, gradient_sync, is_main_process, setup_distributed,
+                               unwrap_model, wrap_model)
+from flat_optimizer import FlatBertAdam
+from mixed_precision import MixedPrecision, add_precision_arguments
+from prefetch import DevicePrefetcher, add_prefetch_arguments
+from telemetry import StepMetrics, add_telemetry_arguments
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s', 
                     datefmt = '%m/%d/%Y %H:%M:%S',
                     level = logging.INFO)
 logger = logging.getLogger(__name__)
-nlp_basic = spacy.load('en', pipeline=[])
 wordRE = re.compile(r'\w')
 
 class InputExample(object):
@@ -113,7 +120,7 @@ class SemevalProcessor(DataProcessor):
     """Processor for the Semeval data set."""
     def get_train_examples(self, data_dir):
         train_directory = os.path.join(data_dir, "training/preprocessed")
-        data_file = open(os.path.join(train_directory, "articles-training-bypublisher-20181122.prep.txt"), "r")
+        data_file = open_corpus(find_corpus(os.path.join(train_directory, "articles-training-bypublisher-20181122.prep.txt")), "r")
 
         examples = []
 
@@ -127,18 +134,42 @@ class SemevalProcessor(DataProcessor):
         return examples
 
 class PretrainingDataset(Dataset):
-    def __init__(self, examples, max_seq_length, tokenizer):
+    """Next-sentence/MLM features of sentence pairs.
+
+    With pack_sequences, several pairs share one max_seq_length sequence, so
+    short pairs no longer pay for a row of padding each. Every token then
+    carries the 1-based number of its pair in the pack (0 for padding) in place
+    of the input mask, its position restarts at 0 with each pair, and the
+    [CLS] positions and next-sentence labels of up to max_pairs_per_sequence
+    pairs come with it; BertForPackedPreTraining turns these into a
+    block-diagonal attention mask, so the pairs stay independent.
+    """
+    def __init__(self, examples, max_seq_length, tokenizer, pack_sequences=False, max_pairs_per_sequence=8):
         self.examples = examples
         self.max_seq_length = max_seq_length
         self.tokenizer = tokenizer
+        self.max_pairs_per_sequence = max_pairs_per_sequence
+        self.packs = None
+        if pack_sequences:
+            lengths = [len(self.pair_tokens(example)[0]) for example in tqdm(examples, desc="Packing")]
+            self.packs = pack_examples(lengths, max_seq_length, max_pairs_per_sequence)
+            real_tokens = sum(lengths)
+            logger.info("Packed %d pairs into %d sequences: %.1f%% of tokens are real, %.1f%% without packing",
+                        len(examples), len(self.packs), 100.0 * real_tokens / max(1, len(self.packs) * max_seq_length),
+                        100.0 * real_tokens / max(1, len(examples) * max_seq_length))
 
     def __len__(self):
+        if self.packs is not None:
+            return len(self.packs)
         return len(self.examples)
 
     def __getitem__(self, idx):
+        if self.packs is not None:
+            return self.construct_packed_features([self.examples[i] for i in self.packs[idx]])
         return self.construct_features(self.examples[idx])
 
-    def construct_features(self, example):
+    def pair_tokens(self, example):
+        """The [CLS] a [SEP] b [SEP] tokens of an example, truncated to max_seq_length, and their segment ids."""
         tokens_a = self.tokenizer.tokenize(example.text_a)
         tokens_b = None
         if example.text_b:
@@ -190,11 +221,10 @@ class PretrainingDataset(Dataset):
             tokens.append("[SEP]")
             segment_ids.append(1)
 
-        input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
-    
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1] * len(input_ids)
+        return tokens, segment_ids
+
+    def mask_tokens(self, input_ids):
+        """Applies the masked LM corruption to input_ids in place and returns the labels."""
         masked_lm_labels = list(input_ids)
         vocab_size = len(self.tokenizer.vocab)
         possible_changes = ['mask', 'random', 'same']
@@ -212,6 +242,17 @@ class PretrainingDataset(Dataset):
             else:
                 masked_lm_labels[i] = -1
 
+        return masked_lm_labels
+
+    def construct_features(self, example):
+        tokens, segment_ids = self.pair_tokens(example)
+        input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
+
+        # The mask has 1 for real tokens and 0 for padding tokens. Only real
+        # tokens are attended to.
+        input_mask = [1] * len(input_ids)
+        masked_lm_labels = self.mask_tokens(input_ids)
+
         # Zero-pad up to the sequence length.
         while len(input_ids) < self.max_seq_length:
             input_ids.append(0)
@@ -228,6 +269,68 @@ class PretrainingDataset(Dataset):
 
         return torch.tensor(input_ids, dtype=torch.long), torch.tensor(input_mask, dtype=torch.long), torch.tensor(segment_ids, dtype=torch.long), torch.tensor(masked_lm_labels, dtype=torch.long), torch.tensor(next_sentence_label, dtype=torch.long)
 
+    def construct_packed_features(self, examples):
+        input_ids = []
+        pack_ids = []
+        segment_ids = []
+        position_ids = []
+        masked_lm_labels = []
+        cls_positions = []
+        for number, example in enumerate(examples, 1):
+            tokens, pair_segment_ids = self.pair_tokens(example)
+            pair_ids = self.tokenizer.convert_tokens_to_ids(tokens)
+            pair_labels = self.mask_tokens(pair_ids)
+            cls_positions.append(len(input_ids))
+            input_ids.extend(pair_ids)
+            pack_ids.extend([number] * len(pair_ids))
+            segment_ids.extend(pair_segment_ids)
+            position_ids.extend(range(len(pair_ids)))
+            masked_lm_labels.extend(pair_labels)
+        next_sentence_labels = [example.next_sentence_label for example in examples]
+
+        # Padding belongs to no pair and is left out of both losses.
+        padding = self.max_seq_length - len(input_ids)
+        input_ids.extend([0] * padding)
+        pack_ids.extend([0] * padding)
+        segment_ids.extend([0] * padding)
+        position_ids.extend([0] * padding)
+        masked_lm_labels.extend([-1] * padding)
+        missing_pairs = self.max_pairs_per_sequence - len(examples)
+        cls_positions.extend([0] * missing_pairs)
+        next_sentence_labels.extend([-1] * missing_pairs)
+
+        assert len(input_ids) == self.max_seq_length
+
+        return (torch.tensor(input_ids, dtype=torch.long), torch.tensor(pack_ids, dtype=torch.long),
+                torch.tensor(segment_ids, dtype=torch.long), torch.tensor(position_ids, dtype=torch.long),
+                torch.tensor(masked_lm_labels, dtype=torch.long), torch.tensor(cls_positions, dtype=torch.long),
+                torch.tensor(next_sentence_labels, dtype=torch.long))
+
+def pack_examples(lengths, max_seq_length, max_pairs):
+    """Groups example indices into packs of at most max_pairs whose lengths sum to at most max_seq_length.
+
+    Best-fit decreasing: the longest examples are placed first, each into the
+    open pack with the least room left that still fits it.
+    """
+    packs = []
+    # the open packs by the number of tokens they have left
+    open_packs = [[] for _ in range(max_seq_length + 1)]
+    for index in sorted(range(len(lengths)), key=lengths.__getitem__, reverse=True):
+        length = lengths[index]
+        for room in range(length, max_seq_length + 1):
+            if open_packs[room]:
+                pack = open_packs[room].pop()
+                break
+        else:
+            pack = len(packs)
+            packs.append([])
+            room = max_seq_length
+        packs[pack].append(index)
+        room -= length
+        if room > 0 and len(packs[pack]) < max_pairs:
+            open_packs[room].append(pack)
+    return packs
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     """Truncates a sequence pair in place to the maximum length."""
 
@@ -245,7 +348,7 @@ def _truncate_seq_pair(tokens_a, tokens_b, max_length):
             tokens_b.pop()
 
 def copy_optimizer_params_to_model(named_params_model, named_params_optimizer):
-    """ Utility function for optimize_on_cpu and 16-bits training.
+    """ Utility function for optimize_on_cpu training.
         Copy the parameters optimized on CPU/RAM back to the model on GPU
     """
     for (name_opti, param_opti), (name_model, param_model) in zip(named_params_optimizer, named_params_model):
@@ -255,7 +358,7 @@ def copy_optimizer_params_to_model(named_params_model, named_params_optimizer):
         param_model.data.copy_(param_opti.data)
 
 def set_optimizer_params_grad(named_params_optimizer, named_params_model, test_nan=False):
-    """ Utility function for optimize_on_cpu and 16-bits training.
+    """ Utility function for optimize_on_cpu training.
         Copy the gradient of the GPU parameters to the CPU/RAMM copy of the model
     """
     is_nan = False
@@ -328,10 +431,7 @@ def main():
                         default=False,
                         action='store_true',
                         help="Whether not to use CUDA when available")
-    parser.add_argument("--local_rank",
-                        type=int,
-                        default=-1,
-                        help="local_rank for distributed training on gpus")
+    add_distributed_arguments(parser)
     parser.add_argument('--seed', 
                         type=int, 
                         default=42,
@@ -344,35 +444,44 @@ def main():
                         default=False,
                         action='store_true',
                         help="Whether to perform optimization and keep the optimizer averages on CPU")
-    parser.add_argument('--fp16',
+    parser.add_argument('--flat_optimizer',
+                        default=False,
+                        action='store_true',
+                        help="Whether to keep parameters, gradients and Adam moments in flat contiguous buffers. "
+                             "With --optimize_on_cpu the Adam state is offloaded to pinned host memory.")
+    parser.add_argument('--gradient_checkpointing',
+                        default=False,
+                        action='store_true',
+                        help="Whether to recompute encoder activations in the backward pass instead of storing them. "
+                             "Costs about a third more compute but allows larger batches and fewer accumulation steps.")
+    parser.add_argument('--pack_sequences',
                         default=False,
                         action='store_true',
-                        help="Whether to use 16-bit float precision instead of 32-bit")
-    parser.add_argument('--loss_scale',
-                        type=float, default=128,
-                        help='Loss scaling, positive power of 2 values can improve fp16 convergence.')
+                        help="Whether to pack several sentence pairs into each max_seq_length sequence, with a "
+                             "block-diagonal attention mask that keeps them independent, instead of padding each pair.")
+    parser.add_argument('--max_pairs_per_sequence',
+                        type=int,
+                        default=8,
+                        help="The most sentence pairs --pack_sequences puts into one sequence.")
+    add_precision_arguments(parser)
+    add_telemetry_arguments(parser)
+    add_prefetch_arguments(parser)
 
     args = parser.parse_args()
 
     processors = {"semeval": SemevalProcessor}
 
-    if args.local_rank == -1 or args.no_cuda:
-        device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
-        n_gpu = torch.cuda.device_count()
-    else:
-        device = torch.device("cuda", args.local_rank)
-        n_gpu = 1
-        # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
-        torch.distributed.init_process_group(backend='nccl')
-        if args.fp16:
-            logger.info("16-bits training currently not supported in distributed training")
-            args.fp16 = False # (see https://github.com/pytorch/pytorch/pull/13496)
+    device, n_gpu = setup_distributed(args)
     logger.info("device %s n_gpu %d distributed training %r", device, n_gpu, bool(args.local_rank != -1))
 
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
                             args.gradient_accumulation_steps))
 
+    precision = MixedPrecision(device, fp16=args.fp16, bf16=args.bf16, loss_scale=args.loss_scale)
+    if precision.scaling and args.optimize_on_cpu and not args.flat_optimizer:
+        raise ValueError("`fp16` loss scaling needs the optimizer on the device, use `bf16` with `optimize_on_cpu`.")
+
     args.train_batch_size = int(args.train_batch_size // args.gradient_accumulation_steps)
 
     random.seed(args.seed)
@@ -389,33 +498,29 @@ def main():
         raise ValueError("Task not found: %s" % (task_name))
 
     processor = processors[task_name]()
-    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    tokenizer = CachedWordPieceTokenizer(BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case))
 
     train_examples = processor.get_train_examples(args.data_dir)
-    num_train_steps = int(len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
+    train_data = PretrainingDataset(train_examples, args.max_seq_length, tokenizer, args.pack_sequences,
+                                    args.max_pairs_per_sequence)
+    num_train_steps = int(len(train_data) / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
 
     # Prepare model
-    model = BertForPreTraining.from_pretrained(args.bert_model, 
+    model_class = BertForPackedPreTraining if args.pack_sequences else BertForPreTraining
+    model = model_class.from_pretrained(args.bert_model, 
                 cache_dir=PYTORCH_PRETRAINED_BERT_CACHE / 'distributed_{}'.format(args.local_rank))
     model_path = Path(args.output_dir, "model.pth")
 
     if model_path.exists():
         model.load_state_dict(torch.load(model_path))
 
-    if args.fp16:
-        model.half()
+    if args.gradient_checkpointing:
+        enable_gradient_checkpointing(model)
     model.to(device)
-    if args.local_rank != -1:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
-                                                          output_device=args.local_rank)
-    elif n_gpu > 1:
-        model = torch.nn.DataParallel(model)
+    model = wrap_model(model, device, n_gpu)
 
     # Prepare optimizer
-    if args.fp16:
-        param_optimizer = [(n, param.clone().detach().to('cpu').float().requires_grad_()) \
-                            for n, param in model.named_parameters()]
-    elif args.optimize_on_cpu:
+    if args.optimize_on_cpu and not args.flat_optimizer:
         param_optimizer = [(n, param.clone().detach().to('cpu').requires_grad_()) \
                             for n, param in model.named_parameters()]
     else:
@@ -428,15 +533,22 @@ def main():
     t_total = num_train_steps
     if args.local_rank != -1:
         t_total = t_total // torch.distributed.get_world_size()
-    optimizer = BertAdam(optimizer_grouped_parameters,
-                         lr=args.learning_rate,
-                         warmup=args.warmup_proportion,
-                         t_total=t_total)
-    
-    train_data = PretrainingDataset(train_examples, args.max_seq_length, tokenizer)
+    if args.flat_optimizer:
+        optimizer = FlatBertAdam(optimizer_grouped_parameters,
+                                 lr=args.learning_rate,
+                                 warmup=args.warmup_proportion,
+                                 t_total=t_total,
+                                 offload=args.optimize_on_cpu)
+    else:
+        optimizer = BertAdam(optimizer_grouped_parameters,
+                             lr=args.learning_rate,
+                             warmup=args.warmup_proportion,
+                             t_total=t_total)
 
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", len(train_examples))
+    if args.pack_sequences:
+        logger.info("  Num packed sequences = %d", len(train_data))
     logger.info("  Batch size = %d", args.train_batch_size)
     logger.info("  Num steps = %d", num_train_steps)
     
@@ -444,52 +556,67 @@ def main():
         train_sampler = RandomSampler(train_data)
     else:
         train_sampler = DistributedSampler(train_data)
-    train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size, num_workers=0, pin_memory=True)
+    # batches are copied to the device while the previous step computes
+    train_dataloader = DevicePrefetcher(DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size,
+                                                   num_workers=0, pin_memory=device.type == 'cuda'),
+                                        device, args.prefetch_batches)
+
+    # the step timings of rank 0 stand for every rank
+    metrics = StepMetrics(args.metrics_file if is_main_process() else None, device, args.profile_steps,
+                          trace_dir=args.output_dir)
 
     model.train()
-    for _ in trange(int(args.num_train_epochs), desc="Epoch"):
+    for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
+        if isinstance(train_sampler, DistributedSampler):
+            # reshuffles the shards each epoch
+            train_sampler.set_epoch(epoch)
         tr_loss = 0
         nb_tr_examples, nb_tr_steps = 0, 0
         with tqdm(train_dataloader, desc="Iteration") as pbar:
-            for step, batch in enumerate(pbar):
-                input_ids, input_mask, segment_ids, masked_lm_labels, next_sentence_labels = batch
-                loss = model(input_ids, segment_ids, input_mask, masked_lm_labels, next_sentence_labels)
-                if n_gpu > 1:
-                    loss = loss.mean() # mean() to average on multi-gpu.
-                if args.fp16 and args.loss_scale != 1.0:
-                    # rescale loss for fp16 training
-                    # see https://docs.nvidia.com/deeplearning/sdk/mixed-precision-training/index.html
-                    loss = loss * args.loss_scale
-                if args.gradient_accumulation_steps > 1:
-                    loss = loss / args.gradient_accumulation_steps
-                loss.backward()
+            for step, batch in enumerate(metrics.iterate(pbar, epoch=epoch, prefetcher=train_dataloader)):
+                if args.pack_sequences:
+                    input_ids, input_mask, segment_ids, position_ids, masked_lm_labels, cls_positions, next_sentence_labels = batch
+                    extra_inputs = dict(position_ids=position_ids, cls_positions=cls_positions)
+                else:
+                    input_ids, input_mask, segment_ids, masked_lm_labels, next_sentence_labels = batch
+                    extra_inputs = {}
+                # gradients are only all-reduced on the last micro-batch before an update
+                with gradient_sync(model, (step + 1) % args.gradient_accumulation_steps == 0):
+                    with metrics.phase("forward"), precision.autocast():
+                        loss = model(input_ids, segment_ids, input_mask, masked_lm_labels, next_sentence_labels, **extra_inputs)
+                    if n_gpu > 1:
+                        loss = loss.mean() # mean() to average on multi-gpu.
+                    if args.gradient_accumulation_steps > 1:
+                        loss = loss / args.gradient_accumulation_steps
+                    with metrics.phase("backward"):
+                        precision.backward(loss)
                 tr_loss += loss.item()
                 nb_tr_examples += input_ids.size(0)
                 nb_tr_steps += 1
                 if (step + 1) % args.gradient_accumulation_steps == 0:
-                    if args.fp16 or args.optimize_on_cpu:
-                        if args.fp16 and args.loss_scale != 1.0:
-                            # scale down gradients for fp16 training
-                            for param in model.parameters():
-                                if param.grad is not None:
-                                    param.grad.data = param.grad.data / args.loss_scale
-                        is_nan = set_optimizer_params_grad(param_optimizer, model.named_parameters(), test_nan=True)
-                        if is_nan:
-                            logger.info("FP16 TRAINING: Nan in gradients, reducing loss scaling")
-                            args.loss_scale = args.loss_scale / 2
+                    with metrics.phase("optimizer"):
+                        if args.optimize_on_cpu and not args.flat_optimizer:
+                            set_optimizer_params_grad(param_optimizer, model.named_parameters())
+                            optimizer.step()
+                            copy_optimizer_params_to_model(model.named_parameters(), param_optimizer)
+                        else:
+                            # skips the update and lowers the loss scale if fp16 gradients overflowed
+                            precision.step(optimizer)
+                        if args.flat_optimizer:
+                            # keeps the gradients attached to the flat buffers
+                            optimizer.zero_grad()
+                        else:
                             model.zero_grad()
-                            continue
-                        optimizer.step()
-                        copy_optimizer_params_to_model(model.named_parameters(), param_optimizer)
-                    else:
-                        optimizer.step()
-                    model.zero_grad()
                     pbar.set_postfix(loss="%.3f" % loss.item())
+                # packed masks hold pair numbers, so count the tokens that belong to any
+                metrics.end_step(input_ids.size(0), input_mask > 0, loss)
+        train_dataloader.log_waits()
 
-    if n_gpu > 1:
-        torch.save(model.module.state_dict(), model_path)
-    else:
-        torch.save(model.state_dict(), model_path)
+    metrics.close()
+
+    # the replicas are identical, so rank 0 writes the only checkpoint
+    if is_main_process():
+        torch.save(unwrap_model(model).state_dict(), model_path)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,68 @@
+import sys
+from lxml import etree
+
+from corpus_io import open_corpus
+
+#
+# xml_stream.py: Stream elements out of (multi-GB) SemEval XML files
+#
+# etree.iterparse still builds the tree as it goes, so clearing an element
+# after use is not enough: the emptied element stays attached to the root and
+# the root's child list grows with every article. iter_elements also deletes
+# the siblings that came before the current element, which keeps resident
+# memory flat however long the file is.
+#
+
+def iter_elements(fps, tag, max_elements=None, offset=0, progress=None, progress_every=1000):
+    """
+    Yields every <tag> element of one or more XML files (file objects opened in
+    binary mode, or paths, which may be gzip/xz/zstd-compressed; see
+    corpus_io). The element is only valid until the next one is requested: it
+    is cleared, and unlinked from its parent, as soon as the consumer moves on.
+
+    offset skips that many elements and max_elements stops after yielding that
+    many, counting across all the files, so (offset, max_elements) selects a
+    window, e.g. for splitting a corpus between processes. progress, if given,
+    is called with the number of elements seen so far every progress_every
+    elements.
+    """
+    if not isinstance(fps, (list, tuple)):
+        fps = [fps]
+
+    seen = 0
+    yielded = 0
+    for fp in fps:
+        if max_elements is not None and yielded >= max_elements:
+            return
+        opened = isinstance(fp, str)
+        if opened:
+            fp = open_corpus(fp, 'rb')
+        elif fp.seekable():
+            fp.seek(0)
+        try:
+            for event, elem in etree.iterparse(fp, events=('end',), tag=tag):
+                if seen >= offset:
+                    yield elem
+                    yielded += 1
+                seen += 1
+                if progress and seen % progress_every == 0:
+                    progress(seen)
+
+                # Free the element and everything parsed before it
+                elem.clear(keep_tail=True)
+                parent = elem.getparent()
+                if parent is not None:
+                    while elem.getprevious() is not None:
+                        del parent[0]
+
+                if max_elements is not None and yielded >= max_elements:
+                    return
+        finally:
+            if opened:
+                fp.close()
+
+def print_progress(message):
+    """ A progress callback that overwrites message.format(count) on stderr """
+    def progress(count):
+        print(message.format(count), file=sys.stderr, end='\r')
+    return progress